@@ -6,11 +6,21 @@ useful functions for sharing images and tracking changes.
 """
 
 import os,sys,subprocess,glob,re,shutil,datetime,time
-import yaml
+import functools
 
 #---the parser does all of the work
 if 'cas/parser' not in sys.path: sys.path.insert(0,'cas/parser')
 from parselib import TexDocument
+from scheduler import Scheduler
+from combos import make_combos
+from tiler import make_galleries
+from dissertation import make_dissertation
+from timings import record_timings,scheduler_timings,estimate,makespan
+from project import get_project
+from indexer import make_index
+from preview import serve_previews
+from regexguard import benchmark
+from jobqueue import JobQueue,run_worker
 
 #---this script is a peer of makeface
 from makeface import asciitree,fab,bash,str_or_list,command_check
@@ -21,7 +31,8 @@ siloname = 'history'
 important_file = 'cas/parser/parselib.py'
 
 #---this script is imported by makeface.py so we only expose relevant functions
-__all__ = ['init','remake','pull','index','dev','bootstrap','demo']
+__all__ = ['init','remake','plan','serve','pull','combos','gallery','dissertation','index','dev','bootstrap',
+	'demo','regex_benchmark','worker','jobs']
 
 ###---INITIALIZATION
 
@@ -67,14 +78,13 @@ def init():
 			important_file+'so we cannot init')
 	else: print('[WARNING] already initialized')
 
-def index():
-	"""Run the script to make the index."""
-	bash('python cas/parser/indexer.py')
-	print("[INDEX] file:///%s/index.html"%os.getcwd())
+def index(root='./',output=None):
+	"""Make the index."""
+	print("[INDEX] file:///%s"%make_index(root=root,output_root=output))
 
 ###---DOCUMENT PROCESSING
 
-def docket():
+def docket(project=None):
 	"""
 	Figure out what needs to be done.
 
@@ -86,72 +96,178 @@ def docket():
 	"""
 	#---in the previous makefile we recompiled documents with target "%.html: %md" which means that all 
 	#---...markdown files must be compiled to HTML on an update
-	check_files = lambda y: map(lambda x:re.match('^(.*?)\.%s$'%y,x).group(1),glob.glob('*.%s'%y))
-	targets = check_files('md')
-	results = check_files('html')
+	#---sources are in the project root and the HTML in the output root
+	project = project or get_project()
+	check_files = lambda y,dn: [re.match('^(.*?)\.%s$'%y,os.path.basename(x)).group(1) 
+		for x in glob.glob(os.path.join(dn,'*.%s'%y))]
+	targets = check_files('md',project.root)
+	results = check_files('html',project.output_root)
 	instructions = dict()
 	for base in targets:
 		if base not in results: instructions[base] = 'new'
 		else:
-			if os.path.getmtime('%s.md'%base)>os.path.getmtime('%s.html'%base): instructions[base] = 'update'
+			if (os.path.getmtime(project.path('%s.md'%base))>
+				os.path.getmtime(project.output('%s.html'%base))): instructions[base] = 'update'
 			else: print('[STATUS] %s is up to date'%base)
 	return instructions
 
-def remake_single(name):
-	"""Rerender a document and track it."""
-	global siloname
-	#---we can only run the parser if we have a silo
-	if not os.path.isdir(siloname): 
-		raise Exception('cannot find `%s` repo. you may need to run `make init` once!'%siloname)
-	#---parse and render the document
-	doc = TexDocument('%s.md'%name)
-	print('[STATUS] compiled %s.md'%name)
-	print('[VIEW] file:///%s.html'%os.path.join(os.getcwd(),name))
-	print('[STATUS] saving %s.md'%name)
+def commit_silo(name,root='./'):
+	"""Commit the sentence-split copy of a document to the silo in the project root."""
 	fn_rel = os.path.join(siloname,name+'.pure')
 	was_committed = command_check(
 		'git --git-dir=./%s/.git --work-tree=%s/ ls-files %s.pure --error-unmatch'%(
-			siloname,siloname,name))
+			siloname,siloname,name),cwd=root)
 	if not was_committed:
 		print('[STATUS] adding %s to the silo'%(fn_rel))
 		bash('git --git-dir=./%s/.git --work-tree=%s/ add %s.pure'%(
-			siloname,siloname,name))
+			siloname,siloname,name),cwd=root)
 		bash('git --git-dir=./%s/.git --work-tree=%s/ commit -m "added %s"'%(
-			siloname,siloname,name+'.pure'),catch=False)
+			siloname,siloname,name+'.pure'),cwd=root,catch=False)
 	has_changes = not command_check(
-		'git --git-dir=./%s/.git --work-tree=%s/ diff --exit-code'%(siloname,siloname))
+		'git --git-dir=./%s/.git --work-tree=%s/ diff --exit-code'%(siloname,siloname),cwd=root)
 	if has_changes:
 		timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y.%m.%d.%H%M')
 		message = "%s +%s.md"%(timestamp,name)
 		cmd = 'git --git-dir ./%s/.git --work-tree=%s commit -a -m "%s"'%(siloname,siloname,message)
 		print('[STATUS] detected changes so we are committing via `%s`'%cmd)
-		bash(cmd,catch=False)
+		bash(cmd,cwd=root,catch=False)
 	else: print('[STATUS] no changes to %s'%fn_rel)
 
-def remake():
+def remake_single(name,scheduler=None,priority=0,project=None,draft=False,profile=False,queue=None,
+	publish=False):
+	"""
+	Rerender a document and track it.
+	If we receive a scheduler, the build steps are only queued and the caller must run it.
+	Returns the durations of the stages which ran while parsing.
+	Send draft to compile quick drafts of the PDFs (see TexDocument.draft_sections) and profile to time each
+	substitution rule (see profiler.py). Send a JobQueue to leave the PDFs to the workers. Send publish to
+	write minified and precompressed HTML (see publish.py).
+	"""
+	global siloname
+	project = project or get_project()
+	#---we can only run the parser if we have a silo
+	if not os.path.isdir(project.path(siloname)): 
+		raise Exception('cannot find `%s` repo. you may need to run `make init` once!'%project.path(siloname))
+	owns_scheduler = scheduler==None
+	if owns_scheduler: scheduler = Scheduler()
+	#---parse the document and queue the build steps
+	doc = TexDocument('%s.md'%name,scheduler=scheduler,priority=priority,project=project,draft=draft,
+		profile=profile,pdf_queue=queue,publish=publish)
+	print('[STATUS] parsed %s.md'%name)
+	print('[VIEW] file:///%s'%project.output('%s.html'%name))
+	print('[STATUS] saving %s.md'%name)
+	#---commits to the silo share one git index so they run one at a time
+	#---...and each project has its own silo so the group is named for it
+	scheduler.submit('%s:silo'%name,functools.partial(commit_silo,name,root=project.root),
+		group='silo:%s'%project.root,priority=priority,tags={'document':name,'stage':'git'})
+	rows = [(name,fmt,stage,duration,True) for fmt,stage,duration in doc.timings]
+	if owns_scheduler: 
+		try: scheduler.run()
+		finally: record_timings(rows+scheduler_timings(scheduler),fn=project.hold('timings.db'))
+	return rows
+
+def remake(workers=None,root='./',output=None,draft=False,profile=False,queue=False,publish=False):
 	"""
 	Coordinating function which renders documents that have changes.
+	Build steps from every document share one scheduler with a limit of ``workers`` concurrent steps.
+	Documents which took the longest last time start first. Stage durations are saved for `make plan`.
+	Send ``root`` to build a project in another directory and ``output`` to write the HTML and printed 
+	folders somewhere other than the project root. Use ``make remake draft`` for quick drafts of the PDFs
+	which only compile the sections that changed and ``make remake profile`` to find slow rules and aliases.
+	Use ``make remake queue`` to write the HTML here and leave the PDFs to ``make worker`` processes on any 
+	machine which shares the project folder. Use ``make remake publish`` to write minified pages with the critical
+	CSS inline and gzip and brotli copies of the pages and their stylesheets and SVG images for static hosting.
 	"""
 	print('[STATUS] running remake')
-	instructions = docket()
+	#---read the project settings once up front so mistakes in dispatch.yaml stop us before any work
+	project = get_project(root=root,output_root=output)
+	project.dispatch
+	instructions = docket(project)
 	for key,val in instructions.items():
-		if val=='new': print('[RENDER] writing %s for the first time'%key)
-		if val in ['update','new']: 
+		if val not in ['update','new']: raise Exception('invalid state %s for %s'%(val,key))
+	#---documents we have never built are probably slow so they go first
+	timings_fn = project.hold('timings.db')
+	estimates = dict([(key,estimate(key,fn=timings_fn)) for key in instructions])
+	order = sorted(instructions,key=lambda x:-(estimates[x] if estimates[x]!=None else float('inf')))
+	scheduler,rows = Scheduler(workers=workers),[]
+	pdf_queue = JobQueue(project) if queue else None
+	try:
+		for key in order:
+			if instructions[key]=='new': print('[RENDER] writing %s for the first time'%key)
 			print('[RENDER] updating %s'%key)
-			remake_single(key)
-		else: raise Exception('invalid state %s for %s'%(val,key))
+			rows.extend(remake_single(key,scheduler=scheduler,project=project,draft=draft,profile=profile,
+				priority=estimates[key] if estimates[key]!=None else float('inf'),queue=pdf_queue,publish=publish))
+		scheduler.run()
+	finally: record_timings(rows+scheduler_timings(scheduler),fn=timings_fn)
+	if pdf_queue: print('[STATUS] the PDFs are in the queue. run `make worker` to compile them and `make jobs` '
+		'to follow them')
+
+def plan(workers=None,root='./',output=None):
+	"""
+	Show which documents would be rebuilt and estimate the time from previous builds.
+	"""
+	project = get_project(root=root,output_root=output)
+	instructions = docket(project)
+	if not instructions: 
+		print('[STATUS] nothing to rebuild')
+		return
+	workers = int(workers) if workers else (os.cpu_count() or 1)
+	estimates = dict([(key,estimate(key,fn=project.hold('timings.db'))) for key in instructions])
+	order = sorted(instructions,key=lambda x:-(estimates[x] if estimates[x]!=None else float('inf')))
+	print('[PLAN] %d documents would be rebuilt (longest first):'%len(order))
+	for key in order:
+		print('[PLAN] %-30s %-8s %s'%(key,instructions[key],
+			'%.1fs'%estimates[key] if estimates[key]!=None else 'no history'))
+	known = [i for i in estimates.values() if i!=None]
+	if known: 
+		print('[PLAN] estimated %.1fs in total or about %.1fs with %d workers'%(
+			sum(known),makespan(known,workers),workers))
+	unknown = len(estimates)-len(known)
+	if unknown: print('[PLAN] %d documents have no build history and are not included in the estimate'%unknown)
+
+def serve(port=8000,host='127.0.0.1',root='./'):
+	"""
+	Preview the documents at http://host:port/ while you edit them. Pages are rendered in memory on request
+	and reload in the browser when their sources change. Use host=0.0.0.0 to share the previews on the network.
+	Only the previews, the shared sources and the figures are served.
+	"""
+	serve_previews(root=root,host=host,port=int(port))
+
+def regex_benchmark(sizes='1000,2000,4000',limit=5.,verbose=False):
+	"""
+	Time the parser rules on adversarial inputs at several sizes and report the ones which grow faster than linear.
+	Use verbose to list every case.
+	"""
+	#---sizes arrive from make as a comma-separated string
+	if type(sizes)==str: sizes = sizes.split(',')
+	results = benchmark(sizes=tuple(int(i) for i in sizes),limit=float(limit),verbose=bool(verbose))
+	if any(i['superlinear'] for i in results): 
+		print('[WARNING] some rules grow faster than linear and may hang on unbalanced markup')
 
-def read_dispatch():
+def worker(workers=None,root='./',output=None,drain=False,poll=2):
+	"""
+	Compile the PDFs queued by ``make remake queue`` until interrupted. Start as many workers as you like on any
+	machine which shares the project folder. Use ``make worker drain`` to stop when the queue is empty.
+	"""
+	failures = run_worker(get_project(root=root,output_root=output),workers=workers,drain=bool(drain),
+		poll=float(poll))
+	if failures: raise Exception('%d jobs failed. see `make jobs` for details'%failures)
+
+def jobs(root='./',output=None):
+	"""
+	Show the PDF jobs which are waiting, running and finished.
+	"""
+	JobQueue(get_project(root=root,output_root=output)).report()
+
+def read_dispatch(root='./'):
 	"""
 	Read the dispatch.yaml for functions that use it, which functions were formerly housed together and 
 	completed tasks like rendering the tiler and 
 	"""
-	#---parse a dispatch.yaml if exists
-	dispatch_fn = 'dispatch.yaml'
-	if os.path.isfile(dispatch_fn): 
-		with open(dispatch_fn) as fp: dispatch = yaml.load(fp.read())
-		return dispatch
-	else: raise Exception('cannot read dispatch.yaml')
+	#---the project reads dispatch.yaml once per run and shares it with the documents
+	project = get_project(root=root)
+	if not project.has_dispatch: raise Exception('cannot read dispatch.yaml')
+	return project.dispatch
 
 def sync_pull(**val):
 	"""
@@ -215,6 +331,32 @@ def pull(which='all'):
 		print(fab('[PULL]','cyan_black')+' according to "%s"'%key)
 		sync_pull(**dict(dis[key],pull_name=key))
 
+def combos(which=None,root='./',output=None):
+	"""
+	Concatenate printed PDFs into the combinations listed under ``type: combos`` in ``dispatch.yaml``.
+	Send the name of a combination to build only that one.
+	"""
+	project = get_project(root=root,output_root=output)
+	dis = read_dispatch(root=root)
+	make_combos(dis,print_dn=project.output('printed'),which=which,root=project.root)
+
+def gallery(which=None):
+	"""
+	Make thumbnail galleries for the ``type: image-link`` entries in ``dispatch.yaml``.
+	Send the name of an entry to make only that gallery.
+	"""
+	dis = read_dispatch()
+	make_galleries(dis,which=which)
+
+def dissertation(workers=None):
+	"""
+	Render the chapters listed under ``dissertation`` in ``dispatch.yaml`` and compile the dissertation.
+	Only chapters whose sources changed are rendered again (in parallel).
+	"""
+	dis = read_dispatch()
+	if 'dissertation' not in dis: raise Exception('cannot find a dissertation entry in dispatch.yaml')
+	make_dissertation(dis['dissertation'],workers=int(workers) if workers else None)
+
 def dev(*args,**kwargs):
 	"""
 	Shortcut to interface with the cassette codes after an init.
@@ -25,6 +25,11 @@ this sense, the ``makeface.py`` scheme provides both a systematic interface to t
 import os,sys,re,glob
 import inspect,traceback,subprocess
 import pprint
+#---external commands are run by the cassette runner which lives with the parser
+try: from runner import run
+except ImportError:
+	sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'parser'))
+	from runner import run
 
 #---set the local configuration file
 config_fn = 'config.py'
@@ -133,51 +138,28 @@ def tracebacker(e):
 	print(fab(tracetext))
 	print(fab('[ERROR]','red_black')+' '+fab('%s'%e,'cyan_black'))
 
-def bash(command,log=None,cwd=None,inpipe=None,catch=True):
+def bash(command,log=None,cwd=None,inpipe=None,catch=True,timeout=None):
 	"""
-	Run a bash command
+	Run a bash command.
+	The output is streamed to the terminal and captured at the same time by the cassette runner (which uses
+	one thread per stream to tee the output) and also written to the log if one is given. Errors always report
+	the end of stderr. If we catch errors then anything on stderr also counts as an error. Commands which do not
+	catch errors are interactive (ssh, git, rsync) so they keep the terminal and can ask for passwords.
 	"""
 	if not cwd: cwd = './'
-	if log == None: 
-		if inpipe: raise Exception('under development')
-		kwargs = dict(cwd=cwd,shell=True,executable='/bin/bash')
-		#---note that you can either catch errors and raise exceptions if anything comes out in stderr and 
-		#---...then later print up the stdout with a delay or you can pipe the stdout directly to output and
-		#---...only later observe the error state when the program returns nonzero. you cannot do both without
-		#---...some kind of tee-like solution that would require asynchronous I/O or threading, so anytime you 
-		#---...need to invoke python you should obviously just import it and run it and reserve bash for 
-		#---...running non-python binaries
-		if catch: kwargs.update(stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-		proc = subprocess.Popen(command,**kwargs)
-		stdout,stderr = proc.communicate()
-	else:
-		#---if the log is not in cwd we see if it is accessible from the calling directory
-		if not os.path.isdir(os.path.dirname(os.path.join(cwd,log))): 
-			output = open(os.path.join(os.getcwd(),log),'w')
-		else: output = open(os.path.join(cwd,log),'w')
-		kwargs = dict(cwd=cwd,shell=True,executable='/bin/bash',
-			stdout=output,stderr=output)
-		if inpipe: kwargs['stdin'] = subprocess.PIPE
-		proc = subprocess.Popen(command,**kwargs)
-		if not inpipe: stdout,stderr = proc.communicate()
-		else: stdout,stderr = proc.communicate(input=inpipe)
-	if stderr: raise Exception('[ERROR] bash returned error state: %s'%stderr)
-	if proc.returncode: 
-		if log: raise Exception('bash error, see %s'%log)
-		else: 
-			extra = '\n'.join([i for i in [stdout,stderr] if i])
-			raise Exception('bash error with returncode %d. stdout: "%s"\nstderr: "%s"'%(proc.returncode,
-				stdout,stderr))
-	return {'stdout':stdout,'stderr':stderr}
-
-def command_check(command):
+	#---if the log is not in cwd we see if it is accessible from the calling directory
+	if log != None:
+		if not os.path.isdir(os.path.dirname(os.path.join(cwd,log))): log = os.path.join(os.getcwd(),log)
+		else: log = os.path.join(cwd,log)
+	job = run(command,check=False,cwd=cwd,log=log,inpipe=inpipe,timeout=timeout,interactive=not catch)
+	if catch and job.stderr: raise Exception('[ERROR] bash returned error state: %s'%job.stderr)
+	job.check()
+	return {'stdout':job.stdout,'stderr':job.stderr}
+
+def command_check(command,cwd=None):
 	"""Run a command and see if it completes with returncode zero."""
 	print('[STATUS] checking command "%s"'%command)
-	try:
-		with open(os.devnull,'w') as FNULL:
-			proc = subprocess.Popen(command,stdout=FNULL,stderr=FNULL,shell=True,executable='/bin/bash')
-			proc.communicate()
-			return proc.returncode==0
+	try: return run(command,cwd=cwd,check=False,echo=False).returncode==0
 	except Exception as e: 
 		print('[WARNING] caught exception on command_check: %s'%e)
 		return False
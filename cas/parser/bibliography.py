@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+"""
+Write the bbl file for a LaTeX document without running bibtex.
+
+We read the bib database in python and format the cited entries the way the standard unsrt and plain styles do,
+so the bibliography can be embedded before the first LaTeX pass. This removes the bibtex run and a LaTeX pass
+from every cited document. Other styles (for example the journal bst files) still go through bibtex.
+Results are cached in the hold directory by style, cited keys and the hash of the bib file, and the parsed
+entries by the hash of the bib file alone.
+"""
+
+import os,re,json,hashlib
+from cache import checksum,write_if_changed,read_manifest
+
+month_names = dict(zip(['jan','feb','mar','apr','may','jun','jul','aug','sep','oct','nov','dec'],
+	['January','February','March','April','May','June','July','August','September','October',
+	'November','December']))
+
+###---PARSING
+
+#---the parser matches these at a position in the text instead of slicing it, which would copy the rest of the
+#---...file for every field
+regex_entry = re.compile(r'@\s*([A-Za-z]+)\s*[\{\(]')
+regex_word = re.compile(r'[^\s,#\}\)]+')
+regex_string = re.compile(r'\s*([^\s=]+)\s*=')
+regex_key = re.compile(r'\s*([^\s,]+)\s*,')
+regex_field = re.compile(r'\s*([A-Za-z0-9_\-]+)\s*=')
+regex_trailing = re.compile(r'\s*,')
+
+def read_value(text,pos,strings):
+	"""Read one field value (braces, quotes, numbers, macros, joined by #) and return it with the position."""
+	parts = []
+	while True:
+		while text[pos].isspace(): pos += 1
+		if text[pos]=='{':
+			depth,start = 0,pos
+			while True:
+				if text[pos]=='{': depth += 1
+				elif text[pos]=='}':
+					depth -= 1
+					if depth==0: break
+				pos += 1
+			parts.append(text[start+1:pos])
+			pos += 1
+		elif text[pos]=='"':
+			depth,start = 0,pos+1
+			pos += 1
+			while text[pos]!='"' or depth>0:
+				if text[pos]=='{': depth += 1
+				elif text[pos]=='}': depth -= 1
+				pos += 1
+			parts.append(text[start:pos])
+			pos += 1
+		else:
+			word = regex_word.match(text,pos).group(0)
+			parts.append(strings.get(word.lower(),month_names.get(word.lower(),word)))
+			pos += len(word)
+		while pos<len(text) and text[pos].isspace(): pos += 1
+		if pos<len(text) and text[pos]=='#': pos += 1
+		else: return ''.join(parts),pos
+
+def read_bib(fn,cache_dn=None):
+	"""
+	Read the entries in a bib file into a dictionary of entry types and fields by key.
+	Send cache_dn to keep the entries for each version of the file.
+	"""
+	if cache_dn:
+		if not os.path.isdir(cache_dn): os.makedirs(cache_dn)
+		cache_fn = os.path.join(cache_dn,'%s.json'%checksum(fn))
+		if os.path.isfile(cache_fn): return read_manifest(cache_fn)
+	with open(fn) as fp: text = fp.read()
+	entries,strings = {},{}
+	for match in regex_entry.finditer(text):
+		kind,pos = match.group(1).lower(),match.end()
+		if kind in ['comment','preamble']: continue
+		try:
+			if kind=='string':
+				name = regex_string.match(text,pos)
+				strings[name.group(1).lower()],pos = read_value(text,name.end(),strings)
+				continue
+			key = regex_key.match(text,pos)
+			if not key: continue
+			pos,fields = key.end(),{}
+			while True:
+				field = regex_field.match(text,pos)
+				if not field: break
+				fields[field.group(1).lower()],pos = read_value(text,field.end(),strings)
+				trailing = regex_trailing.match(text,pos)
+				if not trailing: break
+				pos = trailing.end()
+			entries[key.group(1)] = dict(fields,kind=kind)
+		except (IndexError,AttributeError):
+			print('[WARNING] cannot parse the entry at character %d in %s'%(match.start(),fn))
+	#---the entries keep the order of the file
+	if cache_dn: write_if_changed(cache_fn,json.dumps(entries))
+	return entries
+
+###---FORMATTING
+
+def split_top(text,regex):
+	"""Split on a pattern only outside of braces."""
+	pieces,depth,last = [],0,0
+	for match in re.finditer(r'\{|\}|%s'%regex,text):
+		if match.group(0)=='{': depth += 1
+		elif match.group(0)=='}': depth -= 1
+		elif depth==0:
+			pieces.append(text[last:match.start()])
+			last = match.end()
+	return pieces+[text[last:]]
+
+def format_name(name):
+	"""Turn "Last, First" or "First Last" into "First Last" as the standard styles do."""
+	parts = [i.strip() for i in split_top(name,',')]
+	if len(parts)==1:
+		words = split_top(parts[0].strip(),r'\s+')
+		return ' '.join(words)
+	elif len(parts)==2: return ('%s %s'%(parts[1],parts[0])).strip()
+	else: return ('%s %s, %s'%(parts[2],parts[0],parts[1])).strip()
+
+def format_names(names):
+	"""Join a list of authors with commas and a final "and"."""
+	names = [i for i in split_top(re.sub(r'\s+',' ',names.strip()),r'\s+and\s+') if i.strip()]
+	others = names and names[-1].strip()=='others'
+	names = [format_name(i) for i in names if i.strip()!='others']
+	if others: return '%s et~al.'%', '.join(names) if len(names)>1 else '%s et~al.'%names[0]
+	if len(names)<=2: return ' and '.join(names)
+	return ', '.join(names[:-1])+', and '+names[-1]
+
+def title_case(title):
+	"""Lowercase a title outside of braces except for the first letter and after colons (bibtex "t")."""
+	out,depth,first,after_colon,command = [],0,True,False,False
+	for char in title:
+		if char=='{': depth += 1
+		elif char=='}': depth -= 1
+		elif char=='\\': command = True
+		elif not char.isalpha(): command = False
+		if depth==0 and char.isalpha() and not command:
+			if not (first or after_colon): char = char.lower()
+			first = after_colon = False
+		if char==':': after_colon = True
+		elif not char.isspace() and char!=':' and not char.isalpha(): after_colon = False
+		out.append(char)
+	return ''.join(out)
+
+def dashify(pages): return re.sub(r'(?<!-)-(?!-)','--',pages)
+
+def sentence(*items):
+	"""Join the non-empty items with commas and end with a period."""
+	text = ', '.join(i for i in items if i)
+	return text+'.' if text and not text.endswith('.') else text
+
+def format_entry(key,entry):
+	"""Format one entry as a bibitem in the manner of unsrt.bst."""
+	blocks = []
+	authors = entry.get('author',entry.get('editor',''))
+	if authors:
+		blocks.append(sentence(format_names(authors)+(', editors' if 'author' not in entry else '')))
+	date = ' '.join(i for i in [entry.get('month',''),entry.get('year','')] if i)
+	pages = dashify(entry.get('pages',''))
+	kind = entry['kind']
+	if kind=='article':
+		blocks.append(sentence(title_case(entry.get('title',''))))
+		volume = entry.get('volume','')+('(%s)'%entry['number'] if 'number' in entry else '')
+		vol_pages = ('%s:%s'%(volume,pages) if pages else volume) if volume else \
+			('pages %s'%pages if pages else '')
+		blocks.append(sentence(r'{\em %s}'%entry['journal'] if 'journal' in entry else '',vol_pages,date))
+	elif kind in ['book','booklet','manual','phdthesis','mastersthesis','techreport']:
+		title = r'{\em %s}'%entry.get('title','') if kind in ['book','booklet','manual'] else \
+			title_case(entry.get('title',''))
+		blocks.append(sentence(title))
+		extra = {'phdthesis':'PhD thesis','mastersthesis':"Master's thesis",
+			'techreport':entry.get('type','Technical Report')+(' %s'%entry['number'] if 'number' in entry else '')}
+		blocks.append(sentence(extra.get(kind,''),entry.get('publisher',entry.get('school',entry.get(
+			'institution',entry.get('organization','')))),entry.get('address',''),entry.get('edition',''),date))
+	elif kind in ['inproceedings','incollection','conference']:
+		blocks.append(sentence(title_case(entry.get('title',''))))
+		blocks.append(sentence(r'In {\em %s}'%entry['booktitle'] if 'booktitle' in entry else '',
+			'pages %s'%pages if pages else '',entry.get('publisher',''),date))
+	else:
+		blocks.append(sentence(title_case(entry.get('title',''))))
+		blocks.append(sentence(entry.get('howpublished',''),date))
+	if entry.get('note',''): blocks.append(sentence(entry['note']))
+	blocks = [i for i in blocks if i]
+	return '\\bibitem{%s}\n%s\n'%(key,'\n\\newblock '.join(blocks))
+
+def sort_key_plain(key,entry):
+	"""Sort by author last names, year and title as plain.bst does."""
+	names = split_top(re.sub(r'\s+',' ',entry.get('author',entry.get('editor',key))),r'\s+and\s+')
+	last = [(i.split(',')[0] if ',' in i else i.split(' ')[-1]).strip('{} ').lower() for i in names]
+	return (last,entry.get('year',''),entry.get('title','').lower())
+
+#---each supported style gives the order of the cited keys
+styles = {
+	'unsrt':lambda keys,entries:keys,
+	'plain':lambda keys,entries:sorted(keys,key=lambda x:sort_key_plain(x,entries[x])),}
+
+def write_bbl(bibfile,keys,style,cache_dn='cas/hold/bbl'):
+	"""
+	Return the lines of a bbl file for the cited keys or None if the style is not supported.
+	"""
+	if style not in styles: return None
+	if not os.path.isdir(cache_dn): os.makedirs(cache_dn)
+	signature = hashlib.sha1(('\n'.join([style,checksum(bibfile)]+keys)).encode()).hexdigest()
+	cache_fn = os.path.join(cache_dn,'%s.bbl'%signature)
+	if os.path.isfile(cache_fn):
+		with open(cache_fn) as fp: return fp.readlines()
+	entries = read_bib(bibfile,cache_dn=cache_dn)
+	missing = [i for i in keys if i not in entries]
+	for key in missing: print('[WARNING] cannot find "%s" in %s'%(key,bibfile))
+	keys = styles[style]([i for i in keys if i in entries],entries)
+	text = '\\begin{thebibliography}{%d}\n\n'%len(keys)+\
+		'\n'.join(format_entry(key,entries[key]) for key in keys)+'\n\\end{thebibliography}\n'
+	write_if_changed(cache_fn,text)
+	return text.splitlines(True)
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+"""
+Content hashes and small manifest files which let cassette skip work when the inputs are unchanged.
+"""
+
+import os,json,hashlib,shutil
+
+def checksum(fn,blocksize=2**20):
+	"""Hash the contents of a file in blocks so large PDFs and images do not fill memory."""
+	hasher = hashlib.sha1()
+	with open(fn,'rb') as fp:
+		for block in iter(lambda:fp.read(blocksize),b''): hasher.update(block)
+	return hasher.hexdigest()
+
+def read_manifest(fn):
+	"""Read a manifest of previous results or return an empty one if it is absent or unreadable."""
+	if not os.path.isfile(fn): return {}
+	try:
+		with open(fn) as fp: return json.load(fp)
+	except ValueError:
+		print('[WARNING] ignoring a corrupt manifest at %s'%fn)
+		return {}
+
+def write_manifest(fn,manifest):
+	"""Write a manifest atomically so an interrupted build never leaves a partial file behind."""
+	tmp_fn = fn+'.tmp'
+	with open(tmp_fn,'w') as fp: json.dump(manifest,fp,indent=1,sort_keys=True)
+	os.rename(tmp_fn,fn)
+
+def write_if_changed(fn,text):
+	"""Write text to a file only if it differs from the current contents. Returns True if we wrote."""
+	if os.path.isfile(fn):
+		with open(fn) as fp: 
+			if fp.read()==text: return False
+	with open(fn,'w') as fp: fp.write(text)
+	return True
+
+def copy_if_changed(source,dest):
+	"""Copy a file only if the destination is missing or differs. Returns True if we copied."""
+	if os.path.isdir(dest): dest = os.path.join(dest,os.path.basename(source))
+	if os.path.isfile(dest) and os.path.getsize(dest)==os.path.getsize(source) and \
+		checksum(dest)==checksum(source): return False
+	shutil.copyfile(source,dest)
+	return True
+
+def source_checksums(fns,manifest):
+	"""
+	Hash each file, reusing the previous hash when the size and modification time are unchanged.
+	"""
+	sums = {}
+	for fn in fns:
+		stat = os.stat(fn)
+		prev = manifest.get(fn,None)
+		if prev and prev['mtime']==stat.st_mtime and prev['size']==stat.st_size: sums[fn] = prev['sum']
+		else: sums[fn] = checksum(fn)
+		manifest[fn] = {'mtime':stat.st_mtime,'size':stat.st_size,'sum':sums[fn]}
+	return sums
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+"""
+Concatenate printed PDFs into the named combinations listed in dispatch.yaml.
+
+A combination is an entry with ``type: combos`` whose remaining keys name an output PDF and list the
+documents to join in order. Members can be a path to a PDF, a printed folder name like ``draft-article``, or
+the bare document name if it was only printed in one format. Pages are copied as-is (never re-rendered as
+with ghostscript) and each combination is only rebuilt when the list or contents of its members change.
+"""
+
+import os,re,glob,shutil
+from cache import checksum,read_manifest,write_manifest
+from runner import run
+
+#---prefer an in-process concatenation and otherwise use page-level command-line tools
+try: from pypdf import PdfWriter
+except ImportError: PdfWriter = None
+
+#---page-level concatenation tools in order of preference (neither re-renders the pages)
+concat_tools = [
+	('qpdf',lambda out,fns:['qpdf','--empty','--pages']+fns+['--',out]),
+	('pdfunite',lambda out,fns:['pdfunite']+fns+[out]),]
+
+def combo_member(item,print_dn='printed',root='./'):
+	"""Find the printed PDF for one member of a combination. Explicit PDF paths are relative to the root."""
+	path = os.path.normpath(os.path.join(root,item))
+	if re.search(r'\.pdf$',item) and os.path.isfile(path): return path
+	#---the original layout kept PDFs directly in the printed folder
+	if os.path.isfile(os.path.join(print_dn,'%s.pdf'%item)): return os.path.join(print_dn,'%s.pdf'%item)
+	#---documents are printed to a folder for each format named e.g. printed/<name>-<format>/<name>.pdf
+	match = re.match(r'^(.+)-([^-]+)$',item)
+	if match and os.path.isfile(os.path.join(print_dn,item,'%s.pdf'%match.group(1))):
+		return os.path.join(print_dn,item,'%s.pdf'%match.group(1))
+	candidates = glob.glob(os.path.join(print_dn,'%s-*'%item,'%s.pdf'%item))
+	if len(candidates)==1: return candidates[0]
+	elif len(candidates)>1:
+		raise Exception('combination member "%s" is ambiguous. choose one of: %s'%(item,
+			', '.join(sorted(os.path.basename(os.path.dirname(i)) for i in candidates))))
+	else: raise Exception('cannot find a printed PDF for combination member "%s"'%item)
+
+def concatenate_pdfs(out_fn,fns):
+	"""Join PDFs page by page without re-rendering them."""
+	if PdfWriter:
+		writer = PdfWriter()
+		for fn in fns: writer.append(fn)
+		with open(out_fn,'wb') as fp: writer.write(fp)
+		writer.close()
+		return
+	for name,command in concat_tools:
+		if shutil.which(name):
+			run(command(out_fn,fns),shell=False)
+			return
+	raise Exception('cannot concatenate PDFs without re-rendering them. install qpdf, poppler (pdfunite), '
+		'or the pypdf python package')
+
+def make_combos(dis,print_dn='printed',which=None,root='./'):
+	"""
+	Build every combination in dispatch.yaml whose members have changed since the last build.
+	The combinations are written to the combos folder in the printed folder.
+	"""
+	combos_dn = os.path.join(print_dn,'combos')
+	combos = {}
+	for key,val in dis.items():
+		if type(val)==dict and val.get('type',None)=='combos':
+			combos.update(**dict([(k,v) for k,v in val.items() if k!='type']))
+	if not combos: raise Exception('cannot find any entries with "type: combos" in dispatch.yaml')
+	if which and which not in combos:
+		raise Exception('cannot find combination "%s" in: %s'%(which,', '.join(sorted(combos))))
+	if not os.path.isdir(combos_dn): os.makedirs(combos_dn)
+	manifest_fn = os.path.join(combos_dn,'.combos.json')
+	manifest = read_manifest(manifest_fn)
+	for key,order in sorted(combos.items()):
+		if which and key!=which: continue
+		fns = [combo_member(i,print_dn=print_dn,root=root) for i in order]
+		state = {'members':fns,'sums':[checksum(fn) for fn in fns]}
+		out_fn = os.path.join(combos_dn,'%s.pdf'%key)
+		if manifest.get(key,None)==state and os.path.isfile(out_fn):
+			print('[STATUS] combination %s is up to date'%key)
+			continue
+		print('[STATUS] concatenating %d PDFs to %s'%(len(fns),out_fn))
+		concatenate_pdfs(out_fn,fns)
+		manifest[key] = state
+		write_manifest(manifest_fn,manifest)
@@ -1,14 +1,11 @@
 #!/usr/bin/python
 
-import os,sys,re,glob,yaml,tempfile,subprocess,shutil
-
-#---settings
-tiler_code = 'cas/parser/tiler.py'
+import os,sys,re,glob,tempfile,subprocess,shutil
+from runner import run
+from project import get_project
 
 #---parse a dispatch.yaml if exists
-dispatch_fn = 'dispatch.yaml'
-if os.path.isfile(dispatch_fn): 
-	with open(dispatch_fn) as fp: dis = yaml.load(fp.read())
+if get_project().has_dispatch: dis = get_project().dispatch
 else: sys.exit()
 
 #---extra arguments
@@ -27,31 +24,16 @@ if not any(todo.values()): raise Exception('[ERROR] nothing to dispatch')
 
 #---zip a particular article
 if todo['zipper']:
-	import pdb;pdb.set_trace()
-	os.system('rm printed/*.zip')
+	for fn in glob.glob('printed/*.zip'): os.remove(fn)
 	print_dn = 'printed'
 	printed_dns = [i for i in glob.glob(print_dn+'/*') if i!='printed/combos' and i[-4:]!='.zip']
 	for dn in printed_dns:
-		proc = subprocess.Popen('zip -r %s.zip %s'%(os.path.basename(dn),os.path.basename(dn)),
-			cwd=os.path.dirname(dn),shell=True)
-		proc.communicate()
+		run('zip -r %s.zip %s'%(os.path.basename(dn),os.path.basename(dn)),cwd=os.path.dirname(dn))
 
 #---make image galleries
 if 'gallery' in todo and todo['gallery']:
-	#---loop over image links in the dispatch.yaml file and make a tiler for each
-	for key in [key for key in dis.keys() if 'type' in dis[key] and dis[key]['type']=='image-link']:
-		val = dis[key]
-		tmpfn = tempfile.NamedTemporaryFile(delete=False)
-		maps = {'path':{
-			'dropdir':os.getcwd(),
-			'dropfile':'tile-%s.html'%key,
-			'tile-files':'cas/sources/tiler/',
-			'thumb-files':'cas/hold/thumbs-%s/'%key,
-			'images':val['location'],
-			}}
-		tmpfn.write(str.encode(str(maps)))
-		tmpfn.close()
-		os.system(tiler_code+' '+tmpfn.name)
+	from tiler import make_galleries
+	make_galleries(dis)
 
 #---assemble pull lists
 if 'pull' in todo and todo['pull']: 
@@ -108,46 +90,14 @@ for key in pulls:
 		cmd = 'rsync -ariv ' +' '.join([sourcepath+'/'+fn for fn in val['files']])+\
 			' ./%s/'%(val['to'])
 	print('[SYNC] pulling from %s to %s with "%s"'%(sourcepath,val['to'],cmd))
-	os.system(cmd)
+	run(cmd)
 
 #---compile the dissertation
 if todo['dissertation']:
-	details = dis['dissertation']
-	dn = os.path.join(details['where'],'')
-	#---for every key in "blocks", write that value to a tex file required by dissertation.tex
-	for blockkey in details['blocks']:
-		with open(dn+blockkey+'.tex','w') as fp: fp.write(details[blockkey])
-	#---write chapters and appendices to the chapterlist
-	chapters = details['chapters']
-	appendix = details['appendix']
-	with open(dn+'chapterlist.tex','w') as fp:
-		for fn in chapters:
-			fp.write(r"\input{%s.tex}"%fn+'\n')
-		if any(appendix):
-			fp.write(r"\appendix"+'\n')
-			for fn in appendix:
-				fp.write(r"\input{%s.tex}"%fn+'\n')
-	#---check for tagalongs
-	tagalongs = []
-	for chap in chapters+appendix:
-		with open(chap+'.md') as fp: text = fp.read()
-		check_tag = re.search('\ntagalongs:\s*(.+)\s*\n',text,re.MULTILINE)
-		#---! no file overwrite check here
-		if check_tag:
-			tag_fns = eval(check_tag.group(1))
-			for fn in tag_fns: shutil.copy(fn,os.path.join(dn,''))
-	with open(dn+'chapterlist.sh','w') as fp:
-		fp.write("#/bin/bash\nchapters=(%s)\n"%(' '.join(["'%s'"%i for i in chapters+appendix])))
-	proc = subprocess.Popen('./script-make.sh',cwd=dn,shell=True,executable='/bin/bash')
-	proc.communicate()
+	from dissertation import make_dissertation
+	make_dissertation(dis['dissertation'])
 
 #---concatenate PDFs
 if todo['combos']:
-	raise Exception('under development')
-	del val['type']
-	if val and not os.path.isdir('printed/combos/'): os.mkdir('printed/combos/')
-	for key,order in val.items():
-		cmd = ('gs -q -dNOPAUSE -dBATCH -sDEVICE=pdfwrite -sOutputFile=printed/combos/%s.pdf %s'%
-			(key,' '.join(['printed/%s.pdf'%i for i in order])))
-		print(cmd)
-		os.system(cmd)
+	from combos import make_combos
+	make_combos(dis)
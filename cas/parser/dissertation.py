@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+"""
+Build a dissertation from the chapters and appendices listed in dispatch.yaml.
+
+Chapters and appendices are markdown documents with ``chapter: true`` or ``appendix: true`` in their headers,
+which selects the ``NOCOMPILE`` LaTeX headers so each one is written as a bare ``.tex`` file. We render the
+chapters in parallel, skip any chapter whose inputs have the same hash as the last build, and only rewrite the
+block files and chapter list when they change. The final LaTeX run over the whole dissertation is the only
+serial step. It runs the script from dispatch.yaml, or else ./script-make.sh in the dissertation folder as
+before, or else the standard pdflatex and bibtex sequence.
+"""
+
+import os,re,glob,hashlib
+from concurrent.futures import ProcessPoolExecutor
+from cache import checksum,read_manifest,write_manifest,write_if_changed,copy_if_changed
+from parselib import TexDocument,MDHeaderText
+from runner import run
+
+#---the script in the dissertation folder which compiles it with any custom class and bibliography steps
+make_script = 'script-make.sh'
+#---the standard sequence for the final dissertation when there is no script
+final_commands = ['%(latex)s %(main)s.tex','bibtex %(main)s',
+	'%(latex)s %(main)s.tex','%(latex)s %(main)s.tex']
+
+def chapter_inputs(name,style):
+	"""List the files which determine the rendered chapter."""
+	fn = '%s.md'%name
+	with open(fn) as fp: raw = fp.read()
+	specs = MDHeaderText(raw)
+	fns = [fn,'cas/sources/header-%s.tex'%style]
+	if os.path.isfile('dispatch.yaml'): fns.append('dispatch.yaml')
+	#---figures are staged as PDFs next to the chapter so they count as inputs
+	image_spot = specs['images'] if specs['images'] else ''
+	fns.extend(os.path.join(image_spot,path) for label,path,caption in
+		re.findall(TexDocument.figure_regex,specs['body'],re.MULTILINE+re.DOTALL))
+	if specs['bibliography']: fns.append(specs['bibliography'])
+	if specs['tagalongs']: fns.extend(eval(specs['tagalongs']))
+	return fns
+
+def chapter_hash(name,style):
+	"""Hash the chapter source together with everything it depends on."""
+	hasher = hashlib.sha1(style.encode())
+	for fn in chapter_inputs(name,style):
+		hasher.update(fn.encode())
+		hasher.update((checksum(fn) if os.path.isfile(fn) else 'missing').encode())
+	return hasher.hexdigest()
+
+def render_chapter(name):
+	"""Render one chapter in a worker process."""
+	TexDocument('%s.md'%name)
+	return name
+
+def stage_chapter(name,style,dn):
+	"""Copy the rendered chapter and its figures into the dissertation folder if they changed."""
+	package_dir = os.path.join(TexDocument.package_prefix,'%s-%s'%(name,style))
+	tex_fn = os.path.join(package_dir,'%s.tex'%name)
+	if not os.path.isfile(tex_fn):
+		raise Exception('rendering %s.md did not write %s. add "%s: true" to its header'%(name,tex_fn,style))
+	changed = [fn for fn in [tex_fn]+sorted(glob.glob(os.path.join(package_dir,'fig_*')))
+		if copy_if_changed(fn,dn)]
+	return changed
+
+def make_dissertation(details,workers=None):
+	"""
+	Render changed chapters in parallel and then compile the dissertation.
+	"""
+	dn = os.path.join(details['where'],'')
+	#---for every key in "blocks", write that value to a tex file required by dissertation.tex
+	for blockkey in details['blocks']:
+		if write_if_changed(dn+blockkey+'.tex',details[blockkey]): print('[STATUS] wrote %s.tex'%blockkey)
+	#---write chapters and appendices to the chapterlist
+	chapters = details['chapters']
+	appendix = details.get('appendix',None) or []
+	chapterlist = [r"\input{%s.tex}"%fn for fn in chapters]
+	if any(appendix): chapterlist += [r"\appendix"]+[r"\input{%s.tex}"%fn for fn in appendix]
+	write_if_changed(dn+'chapterlist.tex','\n'.join(chapterlist)+'\n')
+	#---the chapter names for script-make.sh
+	write_if_changed(dn+'chapterlist.sh',"#/bin/bash\nchapters=(%s)\n"%(
+		' '.join(["'%s'"%i for i in chapters+appendix])))
+	#---check for tagalongs
+	for chap in chapters+appendix:
+		with open(chap+'.md') as fp: text = fp.read()
+		check_tag = re.search(r'\ntagalongs:\s*(.+)\s*\n',text,re.MULTILINE)
+		#---! no file overwrite check here
+		if check_tag:
+			for fn in eval(check_tag.group(1)): copy_if_changed(fn,dn)
+	#---find the chapters whose inputs changed since the last build
+	manifest_fn = dn+'.chapters.json'
+	manifest = read_manifest(manifest_fn)
+	styles = dict([(i,'chapter') for i in chapters]+[(i,'appendix') for i in appendix])
+	hashes = dict([(name,chapter_hash(name,style)) for name,style in styles.items()])
+	todo = [name for name in chapters+appendix if manifest.get(name,None)!=hashes[name]
+		or not os.path.isfile(dn+name+'.tex')]
+	for name in chapters+appendix:
+		if name not in todo: print('[STATUS] chapter %s is up to date'%name)
+	if todo:
+		print('[STATUS] rendering %d chapters: %s'%(len(todo),', '.join(todo)))
+		with ProcessPoolExecutor(max_workers=min(len(todo),workers or os.cpu_count())) as pool:
+			for name in pool.map(render_chapter,todo):
+				for fn in stage_chapter(name,styles[name],dn): print('[STATUS] staged %s'%fn)
+				#---record each chapter as it finishes so a failure does not discard finished chapters
+				manifest[name] = hashes[name]
+				write_manifest(manifest_fn,manifest)
+	#---the final LaTeX run is the only serial step
+	script = details.get('script',None)
+	if not script and os.path.isfile(dn+make_script): script = './'+make_script
+	commands = [script] if script else [i%dict(latex=details.get('latex_binary','pdflatex'),
+		main=details.get('main','dissertation')) for i in final_commands]
+	for cmd in commands:
+		print('[STATUS] running "%s" in %s'%(cmd,dn))
+		job = run(cmd,cwd=dn,check=False,log=os.path.join(dn,'cassette-%d.log'%commands.index(cmd)))
+		#---bibtex and latex return nonzero on warnings so we only report them here
+		if job.returncode!=0: print('[WARNING] returncode %d from "%s"'%(job.returncode,cmd))
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+"""
+Stage figures next to the LaTeX source in the format that pdflatex reads best.
+
+PDF, PNG and JPEG files are used as-is (hardlinked when possible, otherwise copied), so vector figures stay
+vector and no process is spent on them. Everything else is converted once with the most faithful tool we can
+find and converted again only when the source is newer than the staged copy.
+"""
+
+import os,glob,shlex,shutil
+from cache import copy_if_changed
+
+#---pdflatex reads these directly. we detect them by their leading bytes rather than trusting the extension
+native_formats = [('pdf',b'%PDF'),('png',b'\x89PNG'),('jpg',b'\xff\xd8\xff')]
+#---vector formats become PDF and raster formats become PNG so nothing is compressed twice
+vector_extensions = ['eps','ps','svg']
+
+def figure_format(fn):
+	"""Return the native format of a file which pdflatex can include directly or None."""
+	with open(fn,'rb') as fp: magic = fp.read(8)
+	return next((fmt for fmt,prefix in native_formats if magic.startswith(prefix)),None)
+
+def figure_target(label,source):
+	"""The name of the staged figure in the package folder."""
+	fmt = figure_format(source)
+	if not fmt: fmt = 'pdf' if os.path.splitext(source)[1].lstrip('.').lower() in vector_extensions else 'png'
+	return 'fig_%s.%s'%(label,fmt)
+
+def conversion_command(source,target):
+	"""The command which converts a figure pdflatex cannot read, preferring lossless vector tools."""
+	ext = os.path.splitext(source)[1].lstrip('.').lower()
+	if ext in ['eps','ps'] and shutil.which('epstopdf'):
+		command = ['epstopdf','--outfile=%s'%target,source]
+	elif ext=='svg' and shutil.which('rsvg-convert'):
+		command = ['rsvg-convert','-f','pdf','-o',target,source]
+	else: command = ['convert','%s[0]'%source,target]
+	return ' '.join(shlex.quote(i) for i in command)
+
+def link_or_copy(source,dest):
+	"""Put a file in place with a hardlink or a copy when the link fails. Returns True if we changed it."""
+	if os.path.isfile(dest):
+		if os.path.samefile(source,dest): return False
+		if os.path.getsize(source)==os.path.getsize(dest): return copy_if_changed(source,dest)
+		os.remove(dest)
+	try: os.link(source,dest)
+	except OSError: shutil.copyfile(source,dest)
+	return True
+
+def stage_figure(label,source,dn):
+	"""
+	Stage one figure in the package folder and return the staged name along with the conversion command if
+	one is needed (otherwise None).
+	"""
+	if not os.path.isfile(source): raise Exception('cannot find figure %s at %s'%(label,source))
+	target = figure_target(label,source)
+	dest = os.path.join(dn,target)
+	#---remove copies from earlier builds in other formats
+	for fn in glob.glob(os.path.join(dn,'fig_%s.*'%glob.escape(label))):
+		if os.path.basename(fn)!=target: os.remove(fn)
+	if figure_format(source):
+		link_or_copy(source,dest)
+		return target,None
+	if os.path.isfile(dest) and os.path.getmtime(dest)>=os.path.getmtime(source): return target,None
+	return target,conversion_command(source,target)
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+"""
+Compile PDFs on several machines which share the project folder.
+
+`make remake queue` writes the HTML as usual but puts one job for each document and LaTeX format in a queue in
+the hold directory instead of compiling it, and any number of `make worker` processes on this or other machines
+take the jobs and render them into the printed folders. The queue is a set of plain files so it works on any
+shared filesystem (including NFS) without a server:
+
+	cas/hold/queue/pending/<document>-<format>.<stamp>.json   one file for each request, newest last
+	cas/hold/queue/locks/<document>-<format>.json             the worker compiling a document and format
+	cas/hold/queue/status/<document>-<format>.json            the outcome of the last job
+
+A worker claims a job by creating its lock with os.link, which either succeeds or fails atomically, so only one
+worker compiles a document and format at a time. It then takes the newest request and drops the older ones. A
+request which arrives during the build waits for the lock and is compiled afterwards. Workers refresh their
+locks while they work, and a lock which has not been refreshed for stale_interval seconds belonged to a worker
+which died, so the next worker puts that job back in the queue. Keep the clocks of the machines roughly in sync.
+"""
+
+import os,re,json,time,glob,socket,threading,uuid
+from parselib import TexDocument
+from scheduler import Scheduler
+from project import get_project
+
+#---seconds between checks for new jobs, between refreshing a lock, and before a lock is stale
+poll_interval = 2.0
+heartbeat_interval = 30.0
+stale_interval = 600.0
+
+def write_json(fn,data):
+	"""Write through a unique temporary file so readers (and other writers) never see a partial file."""
+	tmp_fn = '%s.%s.tmp'%(fn,uuid.uuid4().hex)
+	with open(tmp_fn,'w') as fp: json.dump(data,fp,indent=1,sort_keys=True)
+	os.rename(tmp_fn,fn)
+
+def read_json(fn):
+	"""Read a queue file or return None if another worker removed it first."""
+	try:
+		with open(fn) as fp: return json.load(fp)
+	except (OSError,ValueError): return None
+
+def remove(fn):
+	"""Remove a file which another worker may have removed already."""
+	try: os.remove(fn)
+	except FileNotFoundError: pass
+
+class JobQueue:
+
+	"""
+	Requests to compile one document in one format, in a folder shared by every worker.
+	"""
+
+	def __init__(self,project):
+		self.project = project
+		self.dn = project.hold('queue')
+		for sub in ['pending','locks','status']:
+			if not os.path.isdir(self.path(sub)): os.makedirs(self.path(sub),exist_ok=True)
+
+	def path(self,*parts): return os.path.join(self.dn,*parts)
+
+	def submit(self,name,fmt,priority=0,**options):
+		"""
+		Ask the workers to compile a document in one format. Options go to TexDocument. The job keeps the output
+		root so every worker writes the PDF where the HTML and the index point.
+		"""
+		key = '%s-%s'%(name,fmt)
+		job = {'key':key,'document':name,'format':fmt,'priority':priority,'options':options,
+			'output_root':self.project.output_root,
+			'submitted':time.time(),'host':socket.gethostname(),'attempts':0}
+		self.add(job)
+		print('[QUEUE] queued %s'%key)
+		return key
+
+	def add(self,job):
+		"""Write a pending request. The name sorts requests for the same document and format by age."""
+		write_json(self.path('pending','%s.%.6f-%s.json'%(job['key'],job['submitted'],uuid.uuid4().hex[:8])),job)
+
+	def pending(self):
+		"""The files of the pending requests for each document and format, newest last."""
+		requests = {}
+		for fn in sorted(glob.glob(self.path('pending','*.json'))):
+			match = re.match(r'^(.+)\.[0-9]+\.[0-9]+-[0-9a-f]+\.json$',os.path.basename(fn))
+			if match: requests.setdefault(match.group(1),[]).append(fn)
+		return requests
+
+	def lock(self,key,info):
+		"""Create the lock for a document and format. Returns False if somebody else holds it."""
+		tmp_fn = self.path('locks','%s.%s.tmp'%(key,uuid.uuid4().hex))
+		with open(tmp_fn,'w') as fp: json.dump(info,fp)
+		try:
+			os.link(tmp_fn,self.path('locks',key+'.json'))
+			return True
+		except FileExistsError: return False
+		finally: remove(tmp_fn)
+
+	def claim(self,worker):
+		"""
+		Lock the document and format with the highest priority which nobody is compiling and take its newest
+		request. Returns the job or None if there is nothing to do.
+		"""
+		self.recover()
+		candidates = []
+		for key,fns in self.pending().items():
+			job = read_json(fns[-1])
+			if job: candidates.append((-(job['priority'] or 0),job['submitted'],key))
+		for priority,submitted,key in sorted(candidates):
+			if not self.lock(key,{'worker':worker,'claimed':time.time()}): continue
+			#---while we hold the lock nobody else removes these requests
+			fns = self.pending().get(key,[])
+			job = read_json(fns[-1]) if fns else None
+			if not job:
+				remove(self.path('locks',key+'.json'))
+				continue
+			for fn in fns: remove(fn)
+			job.update(worker=worker,started=time.time())
+			write_json(self.path('locks',key+'.json'),job)
+			return job
+		return None
+
+	def requeue(self,job):
+		"""Put an unfinished job back in the queue unless a newer request for it is waiting."""
+		if job['key'] in self.pending(): return
+		job = dict(job,attempts=job.get('attempts',0)+1)
+		for key in ['worker','started']: job.pop(key,None)
+		self.add(job)
+
+	def recover(self):
+		"""Return the jobs of workers which stopped refreshing their locks to the queue."""
+		for fn in glob.glob(self.path('locks','*.json')):
+			try:
+				if time.time()-os.path.getmtime(fn)<stale_interval: continue
+			except OSError: continue
+			#---only one worker can move the lock aside and we give it back if its owner refreshed it meanwhile
+			aside = '%s.%s.stale'%(fn,uuid.uuid4().hex)
+			try: os.rename(fn,aside)
+			except OSError: continue
+			if time.time()-os.path.getmtime(aside)<stale_interval:
+				try: os.link(aside,fn)
+				except FileExistsError: pass
+				remove(aside)
+				continue
+			job = read_json(aside)
+			remove(aside)
+			if job and 'key' in job:
+				print('[WARNING] %s stopped while compiling %s so the job goes back in the queue'%(
+					job.get('worker','a worker'),job['key']))
+				self.requeue(job)
+
+	def heartbeat(self,key,stop):
+		"""Refresh a lock until the event is set."""
+		while not stop.wait(heartbeat_interval):
+			try: os.utime(self.path('locks',key+'.json'))
+			except OSError: pass
+
+	def run(self,job,workers=None):
+		"""Compile one job, record the outcome, and release the lock."""
+		key,start = job['key'],time.time()
+		print('[WORKER] %s is compiling %s'%(job['worker'],key))
+		stop = threading.Event()
+		beat = threading.Thread(target=self.heartbeat,args=(key,stop))
+		beat.daemon = True
+		beat.start()
+		status = dict([(i,job[i]) for i in ['key','document','format','worker','submitted','started']])
+		try:
+			project = get_project(root=self.project.root,output_root=job.get('output_root',None))
+			doc = TexDocument(project.path(job['document']+'.md'),build=False,project=project,
+				scheduler=Scheduler(workers=workers),**job['options'])
+			if job['format'] not in doc.available_tex_formats:
+				raise Exception('unknown LaTeX format %s'%job['format'])
+			pdf = doc.compile_pdf(job['format'],wait=False)
+			doc.scheduler.run()
+			#---the LaTeX passes do not stop on errors so we check for the PDF
+			if pdf and not os.path.isfile(pdf): raise Exception('LaTeX did not write %s'%pdf)
+			status.update(state='done',pdf=os.path.relpath(pdf,self.project.root) if pdf else None)
+		except KeyboardInterrupt:
+			self.requeue(job)
+			raise
+		except Exception as e: status.update(state='failed',error=str(e))
+		finally:
+			stop.set()
+			if 'state' in status:
+				status['seconds'] = time.time()-start
+				write_json(self.path('status',key+'.json'),status)
+			remove(self.path('locks',key+'.json'))
+		print('[WORKER] %s %s %s in %.1fs%s'%(job['worker'],status['state'],key,status['seconds'],
+			': %s'%status['error'] if status['state']=='failed' else ''))
+		return status
+
+	def report(self):
+		"""Print the pending, running and finished jobs."""
+		now = time.time()
+		pending = self.pending()
+		locks = [read_json(fn) for fn in sorted(glob.glob(self.path('locks','*.json')))]
+		statuses = [read_json(fn) for fn in sorted(glob.glob(self.path('status','*.json')))]
+		print('[QUEUE] %d pending, %d running in %s'%(len(pending),len([i for i in locks if i]),self.dn))
+		for key,fns in sorted(pending.items()):
+			job = read_json(fns[-1])
+			if job: print('[QUEUE] pending  %-30s queued %.0fs ago%s'%(key,now-job['submitted'],
+				' (attempt %d)'%(job['attempts']+1) if job['attempts'] else ''))
+		for job in locks:
+			if job and 'key' in job:
+				print('[QUEUE] running  %-30s on %s for %.0fs'%(job['key'],job['worker'],now-job['started']))
+		for status in sorted([i for i in statuses if i],key=lambda x:x['started']):
+			print('[QUEUE] %-8s %-30s on %s in %.1fs, %.0fs ago%s'%(status['state'],status['key'],
+				status['worker'],status['seconds'],now-status['started']-status['seconds'],
+				': %s'%status['error'] if status['state']=='failed' else ''))
+
+def run_worker(project,workers=None,drain=False,poll=poll_interval):
+	"""
+	Compile jobs from the queue until interrupted, or until the queue is empty if drain is set.
+	Returns the number of jobs which failed.
+	"""
+	queue = JobQueue(project)
+	worker = '%s:%d'%(socket.gethostname(),os.getpid())
+	print('[WORKER] %s is waiting for jobs in %s'%(worker,queue.dn))
+	failures = 0
+	try:
+		while True:
+			job = queue.claim(worker)
+			if job: failures += queue.run(job,workers=workers)['state']=='failed'
+			elif drain: break
+			else: time.sleep(poll)
+	except KeyboardInterrupt: print('[WORKER] %s is stopping'%worker)
+	return failures
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+"""
+Render the equations in HTML output to inline SVG at build time instead of typesetting them with MathJax.
+
+Each equation is compiled with the local TeX toolchain (latex to DVI, then dvisvgm) and the SVG is cached under
+cas/hold/math by the hash of its source, so rebuilds only render new equations and the page needs no scripts or
+network access. Turn this on with ``svg_math: true`` in the document header.
+"""
+
+import os,re,html,shutil,tempfile,hashlib
+from concurrent.futures import ThreadPoolExecutor
+from cache import write_if_changed
+from runner import run
+
+#---standalone templates for display and inline equations
+template_math = '\n'.join([r"\documentclass[border=1pt]{standalone}",r"\usepackage{varwidth}",
+	r"\usepackage{amsmath,amssymb}","%(preamble)s",r"\begin{document}","%(body)s",r"\end{document}",""])
+template_display = '\n'.join([r"\begin{varwidth}{\linewidth}",r"\begin{equation*}","%s",r"\end{equation*}",
+	r"\end{varwidth}"])
+template_inline = r"$%s$"
+#---the HTML output from the rules in TexDocument looks like this after MathJax preparation
+regex_display = r'\$\$(.*?)\$\$'
+regex_inline = r'\$([^\$]+)\$'
+regex_eqref = r'\$\\eqref\{eq:([^\}]+)\}\$'
+regex_label = r'\\label\{eq:([^\}]+)\}'
+regex_mathjax_script = r'[ \t]*<script[^>]*>.*?</script>[ \t]*\n?'
+
+def strip_mathjax(lines):
+	"""Remove the MathJax scripts from the lines of an HTML header."""
+	text = re.sub(regex_mathjax_script,lambda x:'' if 'MathJax' in x.group(0) else x.group(0),
+		''.join(lines),flags=re.DOTALL)
+	return text.splitlines(True)
+
+class MathRenderer:
+
+	"""
+	Convert the MathJax-ready equations in a block of HTML into inline SVG with a cache.
+	"""
+
+	def __init__(self,cache_dn='cas/hold/math',preamble='',workers=None):
+		self.cache_dn,self.preamble,self.workers = cache_dn,preamble,workers
+		#---labeled display equations are numbered in order. the caller registers them before rendering
+		self.numbers = {}
+		missing = [i for i in ['latex','dvisvgm'] if not shutil.which(i)]
+		if missing: raise Exception('svg_math needs these TeX tools: %s'%', '.join(missing))
+		if not os.path.isdir(self.cache_dn): os.makedirs(self.cache_dn)
+
+	def register(self,label):
+		"""Number a labeled equation (in document order) so references can point to it."""
+		if label not in self.numbers: self.numbers[label] = len(self.numbers)+1
+
+	def source(self,tex,display):
+		"""The full TeX file for one equation."""
+		return template_math%dict(preamble=self.preamble,
+			body=(template_display if display else template_inline)%tex.strip())
+
+	def cache_fn(self,source):
+		return os.path.join(self.cache_dn,'%s.svg'%hashlib.sha1(source.encode()).hexdigest())
+
+	def compile(self,source):
+		"""Render one equation to SVG. Returns an error message on failure."""
+		out_fn = self.cache_fn(source)
+		tmpdir = tempfile.mkdtemp()
+		try:
+			with open(os.path.join(tmpdir,'eqn.tex'),'w') as fp: fp.write(source)
+			job = run(['latex','-interaction=nonstopmode','-halt-on-error','eqn.tex'],cwd=tmpdir,shell=False,
+				echo=False,check=False)
+			if job.returncode!=0:
+				return 'latex failed on:\n%s'%'\n'.join(i for i in job.stdout.splitlines() if i.startswith('!'))
+			job = run(['dvisvgm','--no-fonts','--exact','--zoom=1.2','-o','eqn.svg','eqn.dvi'],
+				cwd=tmpdir,shell=False,echo=False,check=False)
+			if job.returncode!=0: return 'dvisvgm failed: %s'%job.stderr.strip()
+			with open(os.path.join(tmpdir,'eqn.svg')) as fp: svg = fp.read()
+			#---inline SVG cannot carry an XML declaration and it must sit on one line in the HTML
+			svg = re.sub(r'<\?xml.*?\?>|<!--.*?-->','',svg,flags=re.DOTALL)
+			write_if_changed(out_fn,re.sub(r'\s*\n\s*',' ',svg).strip())
+		finally: shutil.rmtree(tmpdir)
+
+	def prepare(self,sources):
+		"""Render every equation which is not already in the cache."""
+		todo = sorted(set(i for i in sources if not os.path.isfile(self.cache_fn(i))))
+		if not todo: return
+		print('[STATUS] rendering %d new equations to SVG'%len(todo))
+		with ThreadPoolExecutor(max_workers=self.workers or os.cpu_count()) as pool:
+			errors = dict([(i,j) for i,j in zip(todo,pool.map(self.compile,todo)) if j])
+		for source,error in errors.items(): print('[WARNING] cannot render equation: %s'%error)
+
+	def svg(self,source,display):
+		"""Wrap the cached SVG for one equation. Failures fall back to the TeX source."""
+		fn = self.cache_fn(source)
+		if not os.path.isfile(fn):
+			return '<code class="math-error">%s</code>'%html.escape(source.split(r'\begin{document}')[-1].split(
+				r'\end{document}')[0].strip())
+		with open(fn) as fp: svg = fp.read()
+		return '<span class="math-%s">%s</span>'%('display' if display else 'inline',svg)
+
+	def display_equation(self,tex):
+		"""Split a MathJax display equation into its TeX source and its label."""
+		label = re.search(regex_label,tex)
+		tex = re.sub(r'\\(begin|end)\{equation\}|\\notag|%s'%regex_label,'',tex)
+		#---labels in the HTML rules are escaped for LaTeX so we restore the underscores
+		return tex,re.sub('ZZZ','_',label.group(1)) if label else None
+
+	def render(self,text):
+		"""
+		Replace the equations in a block of HTML with inline SVG.
+		"""
+		#---references become links to the numbered equations
+		def eqref(match):
+			number = self.numbers.get(match.group(1),None)
+			if not number: print('[WARNING] cannot find equation "%s" for a reference'%match.group(1))
+			return '<a href="#eq:%s">%s</a>'%(match.group(1),number or '??')
+		text = re.sub(regex_eqref,eqref,text)
+		displays = [self.display_equation(i) for i in re.findall(regex_display,text,re.DOTALL)]
+		parts = re.split(regex_display,text,flags=re.DOTALL)
+		#---only the text between display equations holds inline equations
+		inlines = [i for part in parts[::2] for i in re.findall(regex_inline,part)]
+		self.prepare([self.source(tex,True) for tex,label in displays]+[self.source(i,False) for i in inlines])
+		for ii,(tex,label) in enumerate(displays):
+			number = self.numbers.get(label,None) if label else None
+			parts[2*ii+1] = '<div class="equation"%s>%s%s</div>'%(' id="eq:%s"'%label if label else '',
+				self.svg(self.source(tex,True),True),
+				'<span class="equation-number">(%d)</span>'%number if number else '')
+		for ii in range(0,len(parts),2):
+			parts[ii] = re.sub(regex_inline,lambda x:self.svg(self.source(x.group(1),False),False),parts[ii])
+		return ''.join(parts)
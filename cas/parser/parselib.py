@@ -1,18 +1,39 @@
 #!/usr/bin/python
 
-import os,sys,re,subprocess,glob
+import os,sys,re,subprocess,glob,time,io
+import functools,itertools,json,hashlib
 from collections import OrderedDict as odict
 from constants import *
-from copy import deepcopy
+from runner import run
+from scheduler import Scheduler
+from mathsvg import MathRenderer,strip_mathjax
+from webimages import web_image
+from figures import stage_figure
+from bibliography import write_bbl,read_bib
+from cache import checksum,read_manifest,write_manifest,write_if_changed,source_checksums
+from copy import copy,deepcopy
 import tempfile
 import shutil
-import yaml
+import types
+from project import load_yaml,get_project
+from profiler import RuleProfiler,replace_each
+from regexguard import RegexTimeout,time_limit,unguarded,unmatched_line,source_line,snippet
+from publish import publish_html,remove_compressed
 
 #! see software.md for notes on regex. you probably need to change a lot of regexes!
 
 ###---STANDALONES
 
-def write_tex_png(formula,name,count,label=None,vectorbold=False):
+def rule_set(*parts):
+	"""
+	Merge dictionaries or lists of (pattern,replacement) pairs into a read-only, ordered rule set.
+	Later parts override earlier ones without moving them, since the order of the substitutions matters.
+	"""
+	rules = odict()
+	for part in parts: rules.update(part.items() if hasattr(part,'items') else part)
+	return types.MappingProxyType(rules)
+
+def write_tex_png(formula,name,count,label=None,vectorbold=False,dn='printed'):
 	"""
 	Convert a TeX equation to PNG.
 	Take a formula and write an equation based on the document name and an optional label. 
@@ -30,10 +51,11 @@ def write_tex_png(formula,name,count,label=None,vectorbold=False):
 		if re.match(r'^\\label',line): outtex[ll] = ''
 	print_tex = [i for i in outtex if not re.match(r'^\s*$',i)]
 	with open('%s/snaptex2.tex'%tmpdir,'w') as fp: fp.write('\n'.join(print_tex))
-	os.system('pdflatex --output-directory=%s %s/snaptex2.tex'%(tmpdir,tmpdir))
-	os.system('convert -trim -density 300 '+
-		'%s/snaptex2.pdf -quality 100 printed/%s-%s.png'%(tmpdir,name,
-			os.path.basename(tmpdir) if not label else label))
+	run('pdflatex --output-directory=%s %s/snaptex2.tex'%(tmpdir,tmpdir),check=False,
+		log=os.path.join(tmpdir,'snaptex2.out'))
+	run('convert -trim -density 300 '+
+		'%s/snaptex2.pdf -quality 100 %s/%s-%s.png'%(tmpdir,dn,name,
+			os.path.basename(tmpdir) if not label else label),check=False)
 
 def linesnip(lines,*regex,**kwargs):
 	"""
@@ -56,11 +78,200 @@ def linesnip(lines,*regex,**kwargs):
 	if is_header and len(line_nos)==2: line_nos[1] += 1
 	return line_nos
 
+def trie_pattern(words):
+	"""
+	Make a regex which matches any of a list of literal words. The words share prefixes in a trie so the
+	pattern stays fast for hundreds of words and the optional tails are greedy so the longest word wins.
+	"""
+	trie = {}
+	for word in words:
+		node = trie
+		for char in word: node = node.setdefault(char,{})
+		node[''] = True
+	def build(node):
+		branches = [re.escape(char)+build(child) for char,child in sorted(node.items()) if char!='']
+		if not branches: return ''
+		body = branches[0] if len(branches)==1 else '(?:%s)'%'|'.join(branches)
+		return '(?:%s)?'%body if '' in node else body
+	return build(trie)
+
+#---aliases never apply inside code, math, verbatim environments or link targets
+regex_alias_skip = '|'.join([r'`[^`\n]*`',r'\$\$.*?\$\$',r'\$[^\$\n]+\$',r'\\\(.*?\\\)',r'\\\[.*?\\\]',
+	r'\\begin\{(?P<env>equation|align|eqnarray|gather|multline|verbatim|minted|lstlisting)(?P<star>\*?)\}'
+	r'.*?\\end\{(?P=env)(?P=star)\}',r'\]\([^\)\s]*\)'])
+
+#---constructs which only make sense in a regex (escapes, classes, groups, alternation, anchors, repeats) so we
+#---...can tell users whose aliases were written as regexes before we matched them literally
+regex_alias_looks_like_regex = r'\\[A-Za-z.\\]|\[[^\]]+\]|\([^\)]*\)|\||^\^|\$$|\.[\*\+\?]|\{\d+(,\d*)?\}|\w\?(?=.)'
+#---aliases we already warned about so a remake over many documents says it once
+warned_aliases = set()
+
+def alias_matcher(aliases,profiler=None):
+	"""
+	Compile literal aliases into a single pattern and return a function which replaces them in a string.
+	Keys are never treated as regexes (so "C++" works) and replacements are inserted verbatim.
+	The pattern matches the regions in regex_alias_skip first so aliases inside them are left alone.
+	A profiler counts the matches for each alias and times the pattern as a whole.
+	"""
+	aliases = dict([(str(i),str(j)) for i,j in aliases.items() if str(i)])
+	if not aliases: return None
+	for key in aliases:
+		if key not in warned_aliases and re.search(regex_alias_looks_like_regex,key):
+			print('[WARNING] the alias "%s" looks like a regular expression but aliases are matched as literal '
+				'text so it only replaces those exact characters'%key)
+			warned_aliases.add(key)
+	pattern = re.compile('(?P<skip>%s)|%s'%(regex_alias_skip,trie_pattern(aliases.keys())),re.DOTALL)
+	def replace(match):
+		if match.group('skip')!=None: return match.group(0)
+		if profiler: profiler.record('alias',match.group(0),0.,matches=1,calls=0)
+		return aliases[match.group(0)]
+	if not profiler: return lambda text:pattern.sub(replace,text)
+	label = '(%d aliases)'%len(aliases)
+	return lambda text:profiler.timed('aliases',label,pattern.subn,replace,text)
+
+def renderer_version():
+	"""
+	Hash the parser sources once so cached output is dropped whenever the code changes. We hash every module
+	in the parser folder rather than a list of the ones we think matter, which would go stale.
+	"""
+	global _renderer_version
+	if not _renderer_version:
+		dn = os.path.dirname(os.path.abspath(__file__))
+		hasher = hashlib.sha1()
+		for fn in sorted(glob.glob(os.path.join(dn,'*.py'))):
+			hasher.update(('%s:%s\n'%(os.path.basename(fn),checksum(fn))).encode())
+		_renderer_version = hasher.hexdigest()
+	return _renderer_version
+_renderer_version = None
+
+def read_header(fp):
+	"""
+	Read the header block from the top of an open markdown file.
+	Returns the header through its closing dashes and the remainder of that line, so the body can be read 
+	(or streamed) separately while MDHeaderText sees the same header.
+	"""
+	first = fp.readline()
+	if not re.match(r'^-{3,}\n$',first): raise Exception('markdown files must start with a "---" header')
+	header = [first]
+	for line in iter(fp.readline,''):
+		closing = re.match(r'^-{3,}',line)
+		if closing: return ''.join(header)+closing.group(0),line[closing.end():]
+		header.append(line)
+	raise Exception('cannot find the end of the markdown header')
+
+def split_sections(lines):
+	"""
+	Group lines of markdown into top-level sections which start at a single-hash heading. We never split
+	inside a code block or a block comment. Yields the text of each section.
+	"""
+	section,fenced = [],None
+	for line in lines:
+		fence = re.match(r'^\s*(~~~|:::)\s*$',line)
+		if fenced:
+			if fence and fence.group(1)==fenced: fenced = None
+		elif fence: fenced = fence.group(1)
+		elif re.match(r'^#(?!#)',line) and section:
+			yield ''.join(section)
+			section = []
+		section.append(line)
+	if section: yield ''.join(section)
+
+def latex_sections(lines):
+	"""Group processed LaTeX lines into lists which start at each section command."""
+	section = []
+	for line in lines:
+		if re.match(r'^\\section\b',line) and section:
+			yield section
+			section = []
+		section.append(line)
+	if section: yield section
+
+class NewlineWriter:
+
+	"""
+	Write text to a file in pieces while replacing runs of newlines exactly as re.sub on the whole text would.
+	A limit replaces only the first few runs (like the count argument to re.sub).
+	"""
+
+	def __init__(self,fp,minimum,replacement,limit=None):
+		self.fp,self.minimum,self.replacement,self.limit = fp,minimum,replacement,limit
+		self.run = 0
+
+	def write(self,text):
+		for piece in re.split('(\n+)',text):
+			if not piece: continue
+			elif piece[0]=='\n': self.run += len(piece)
+			else:
+				self.flush()
+				self.fp.write(piece)
+
+	def flush(self):
+		if self.run>=self.minimum and self.limit!=0:
+			self.fp.write(self.replacement)
+			if self.limit: self.limit -= 1
+		else: self.fp.write('\n'*self.run)
+		self.run = 0
+
+	close = flush
+
 ###---CLASSES
 
+class BodyStream:
+
+	"""
+	The body of a markdown document, read from disk one top-level section at a time.
+	Processing steps are recorded as transforms which we apply to each section while iterating, so memory is 
+	bounded by the largest section rather than the whole document.
+	"""
+
+	def __init__(self,fn,offset,lead='',text=None):
+		self.fn,self.offset,self.lead,self.text = fn,offset,lead,text
+		self.transforms,self.prefix = [],[]
+
+	def copy(self):
+		"""Make a stream over the same body with its own list of transforms."""
+		other = BodyStream(self.fn,self.offset,self.lead,self.text)
+		other.transforms,other.prefix = list(self.transforms),list(self.prefix)
+		return other
+
+	def sections(self):
+		"""Yield the raw text of each section. A stream may also hold the body text in memory."""
+		if self.text!=None:
+			for section in split_sections(self.text.splitlines(True)): yield section
+			return
+		with open(self.fn) as fp:
+			fp.seek(self.offset)
+			for section in split_sections(itertools.chain([self.lead] if self.lead else [],
+				iter(fp.readline,''))): yield section
+
+	def apply(self,section):
+		"""Apply the transforms to the text of one section."""
+		lines = [section]
+		for transform in self.transforms: lines = transform(lines)
+		return lines
+
+	def chunks(self):
+		"""Yield the processed lines for each section (the prefix counts as a section)."""
+		if self.prefix: yield list(self.prefix)
+		for section in self.sections(): yield self.apply(section)
+
+	def __iter__(self): return (line for lines in self.chunks() for line in lines)
+
+	def insert(self,index,line):
+		"""Add a line before the body, for example the chapter heading."""
+		self.prefix.insert(index,line)
+
+
 class MDHeaderText:
 
-	def __init__(self,lines):
+	#---specify the formats for different items in the header block
+	regex_comment_line = r'\n\s*\!.*?\n'
+	regex_header_parse = [
+		('regex_header_block',(r"^>([ \w\@]+)\s*:\s*\n?$(.*?)\n([\.]{3,}|\n|[-]{3,})",re.M+re.DOTALL)),
+		('regex_header_yaml',(r"^(~.*?)\s*:\s*\n(.*?)\n([\.]{3,}|\n|[-]{3,})",re.M+re.DOTALL)),
+		('regex_header_single',(r"^([ \w\@]+):\s*(.*?)\s*$",re.M)),]
+
+	def __init__(self,lines,regex_time_limit=None):
 
 		"""
 		A class which holds the header information from a markdown file.
@@ -71,6 +282,7 @@ class MDHeaderText:
 			3. keys may contain spaces
 			4. keys with trailing "@template" items will only apply to those (LaTeX) templates if available
 			5. within each item, all newlines and tabs are collapsed into spaces
+		Parsing stops with an error if the rules run longer than regex_time_limit seconds.
 		"""
 
 		#---extract the header
@@ -87,19 +299,18 @@ class MDHeaderText:
 			if re.match('(True|true|yes|Y|y)',val): self.core[key] = True
 			elif re.match('^(False|false|no|N|n)$',val): self.core[key] = False
 	
-		#---regex defns
-		#---specify the formats for different items in the header block
-		regex_comment_line = r'\n\s*\!.*?\n'
-		regex_header_parse = [
-			('regex_header_block',(r"^>([ \w\@]+)\s*:\s*\n?$(.*?)\n([\.]{3,}|\n|[-]{3,})",re.M+re.DOTALL)),
-			('regex_header_yaml',(r"^(~.*?)\s*:\s*\n(.*?)\n([\.]{3,}|\n|[-]{3,})",re.M+re.DOTALL)),
-			('regex_header_single',(r"^([ \w\@]+):\s*(.*?)\s*$",re.M)),]
-
 		#---parse the header
-		self.header = re.sub(regex_comment_line,'\n\n',self.header,re.MULTILINE)
-
-		for key,(regex,flags) in regex_header_parse:
-			self.header = re.compile(regex,flags if flags else 0).sub(register_header,self.header)
+		#---an item without a terminator can make these rules backtrack so they run under a time limit
+		source,key,regex,flags = self.header,'regex_comment_line',self.regex_comment_line,0
+		try:
+			with time_limit(regex_time_limit):
+				self.header = re.sub(regex,'\n\n',self.header,re.MULTILINE)
+				for key,(regex,flags) in self.regex_header_parse:
+					self.header = re.compile(regex,flags if flags else 0).sub(register_header,self.header)
+		except RegexTimeout:
+			line = unmatched_line(re.compile(regex,flags),self.header,regex_time_limit)
+			raise Exception('the header rule %s ran for more than %ss. check for an unterminated item near line '
+				'%s of the header: "%s"'%(key,regex_time_limit,source_line(source,line),snippet(line)))
 		self.header = self.header.strip('\n-').strip()
 		if self.header: raise Exception('unprocessed header items: "%s"'%self.header)
 
@@ -108,7 +319,7 @@ class MDHeaderText:
 		#---...header style could have its own processing function like this one
 		for key in [i for i in self.core.keys() if re.match('^~',i)]:
 			x = self.core.pop(key)
-			self.core[re.sub('^~','',key)] = yaml.load(x)
+			self.core[re.sub('^~','',key)] = load_yaml(x)
 		#---clean the header items
 		for key in [i for i in self.core if i!='body']:
 			if type(self.core[key]) not in [bool,dict]:
@@ -147,6 +358,12 @@ class TexDocument:
 
 	notes on constants:
 		Class variables include both "rules" (which use lambda functions) and "subs" (substitutions).
+		These are read-only defaults. Each document builds its own rule sets in rule_sets.
+
+	usage:
+		TexDocument(fn) builds everything as always. TexDocument(fn,build=False) only parses the document, after
+		which to_latex(format) and to_html() return strings and compile_pdf(format) writes the printed package.
+		Send draft=True (or set "draft: true" in the header) for a quick PDF with placeholder figures.
 	"""
 
 	#---where to store rendered documents and paraphanalia
@@ -163,6 +380,7 @@ class TexDocument:
 	#---!temporary hack. removing the hyphen
 	#bibkey = '[a-zA-Z\-]+-[0-9]{4}[a-z]?'
 	bibkey = r'[a-zA-Z\-]+-?[0-9]{4}[a-z]?'
+	regex_citation = r'(\[?@[a-zA-Z]+-?[0-9]{4}[a-z]?\s?;?\s?)+\]?'
 	available_tex_formats = ['article']
 	author_affiliation_regex = r'^([^@]+)(?<!\s)\s*@?(.*)$'
 	equation_prefix = r"\renewcommand{\theequation}{%s\arabic{equation}}"
@@ -176,25 +394,29 @@ class TexDocument:
 	#---the following inline comment cannot start the line, otherwise use the line comment
 	regex_inline_comment = r"[^\:](?:[\:]{2})(.*?)(?:[\:]{2})"
 	puredir = 'history'
+	#---logs from external build steps
+	hold_dir = 'cas/hold'
+	#---seconds the rules may run on one document (or section in the chunked mode) before we stop the build
+	regex_time_limit = 20
 
 	#---rules for TeX documents
-	rules_tex = {
+	rules_tex = rule_set({
 		#---turn hash-prefixed headings into section delimiters with an optional label
 		r'^(#+)(\*)?\s*(.*?)\s*(?:\{#sec:(.+)\})?$':lambda s,is_num=False : r'\%s%s%s{%s%s}\n'%(
 			{1:'section',2:'subsection',3:'subsubsection',4:'paragraph',5:'subparagraph'}[len(s[0])],
-			s[1],'' if is_num else '*',s[2],'' if not s[3] else r"\label{sec:%s}"%underscore(s[3])),}
+			s[1],'' if is_num else '*',s[2],'' if not s[3] else r"\label{sec:%s}"%underscore(s[3])),})
 
 	#---replacement rules for HTML
-	rules_html = {
+	rules_html = rule_set({
 		r'^(#+)(\*)?\s*(.*?)\s*(?:\{#sec:(.+)\})?$':lambda s : '\n<br><h%d %s>%s</h%d>\n'%(
 			len(s[0])+1,'id="%s"'%('-'.join(s[2].split(' ')).lower() if not s[3] 
 			else s[3]),s[2],len(s[0])+1),
 		r'^>+\s*$':lambda s : s,
 		r'^[0-9]+\.\s?(.+)':lambda s : '<li>%s</li>\n'%s,
-		r'^\s*$':lambda s : '<p>',}
+		r'^\s*$':lambda s : '<p>',})
 
 	#---note that order matters in the following dictionary
-	subs_tex = odict([
+	subs_tex = rule_set([
 		(r'\[\[([^\]]+)\]\]',r"\\pdfmarkupcomment[markup=Highlight,color=yellow]{\1}{}"),
 		(regex_inline_comment,r""),
 		(regex_line_comment,r""),
@@ -216,17 +438,17 @@ class TexDocument:
 		(r"~(.*?)\|(.*?)~",r"\1"),])
 
 	#---multiline regex substitutions or replacements for LaTeX
-	subs_multi_tex = {
+	subs_multi_tex = rule_set({
 		r'\n\n([0-9]+\.)':r"\\begin{enumerate} \\item ",
 		r'\n([0-9]+\.\s*[^\n]+)\n\n':'\n'+r"\1"+'\n'+r"\\end{enumerate}"+'\n',
 		regex_block_comment:'\n',
 		regex_equation:
 			lambda x : '\n'+r"\begin{equation}%s"%('' if x[1] else r'\notag')+x[0]+'\n'+r"%s\\end{equation}"%
-			(r"\label{eq:%s}"%underscore(x[1])+'\n' if x[1] else '')+'\n\n',}
+			(r"\label{eq:%s}"%underscore(x[1])+'\n' if x[1] else '')+'\n\n',})
 
 	#---? figure will not be capitalized sometimes
 	#---? double asterisk may not work if dictionary in wrong order
-	subs_html = odict([
+	subs_html = rule_set([
 		(r" \\\\ ",''),
 		(r'\*\*([^\*]+)\*\*',r'<strong>\1</strong>'),
 		(r'\*([^\*]+)\*',r'<em>\1</em>'),
@@ -249,15 +471,15 @@ class TexDocument:
 		#---latex-only refs get some styling that harkens to tex
 		(r"\\ref{(.*?)}",r"@{\1}"),])
 
-	subs_multi_html = {
+	subs_multi_html = rule_set({
 		regex_block_comment:'\n',
 		r'\n\n([0-9]+\.)':'\n<ol>\n'+r"\1",
 		r'\n([0-9]+\.\s*[^\n]+)\n\n':'\n'+r"\1"+'\n</ol>\n',
 		r"(?:\\begin\{table\})(.*?)(?:\\end\{table\})":
-			'<text style="color:gray"><strong>cannot render tex table (see the PDF)</strong></text>',}
+			'<text style="color:gray"><strong>cannot render tex table (see the PDF)</strong></text>',})
 
 	#---order matters
-	special_subs_tex = odict([
+	special_subs_tex = rule_set([
 		(r'%',r'\%'),
 		(r' "',r' ``'),
 		#---! previously (r'" ',"'' "),
@@ -267,22 +489,77 @@ class TexDocument:
 		#---! an ellipses inside of a highlight causes problems
 		(r'\.\.\.',r'\\ldots'),
 		(r"([0-9]+\.?[0-9]*)%",r"\1\%"),])
-	special_subs_html = odict([
+	special_subs_html = rule_set([
 		(r'---',r'&mdash;'),])
 	
 	def __init__(self,fn,**kwargs):
 		"""
 		This constructor organizes all of the document processing. See the class docstring for details.
+		Send build=False to only parse the document and then use to_latex, to_html, and compile_pdf. Send the 
+		markdown as text to parse it without reading the file.
 		"""
 		if type(fn)==list: raise Exception('expecting a file name')
-		else: 
-			with open(fn) as fp: self.raw = fp.read()
-			self.name = re.findall(r'([^\/]+)\.md$',fn)[0]
+		else: self.name = re.findall(r'([^\/]+)\.md$',fn)[0]
+		#---project settings (dispatch.yaml) are read once per run and shared by every document
+		#---...and every path is resolved against the project root or the output root instead of the cwd
+		self.project = kwargs.pop('project',None)
+		root,output_root = kwargs.pop('root',None),kwargs.pop('output_root',None)
+		if not self.project: self.project = get_project(root=root or './',output_root=output_root)
+		elif root or output_root: raise TypeError('send either a project or the root directories')
+		self.root,self.output_root = self.project.root,self.project.output_root
+		self.hold_dir = self.project.hold()
+		fn = self.project.path(fn)
+		#---durations of the stages which run in this constructor, as (format,stage,seconds)
+		self.timings,start = [],time.time()
 		#---parse the header and store the body
-		self.specs = MDHeaderText(self.raw)
-		self.body = self.specs.core.pop('body')
+		#---the chunked mode (set by keyword or in the header) streams the body from disk one section at a time
+		#---...so it only applies when we read the markdown from a file
+		text = kwargs.pop('text',None)
+		regex_time_limit = kwargs.pop('regex_time_limit',None)
+		with (io.StringIO(text) if text!=None else open(fn)) as fp:
+			header,lead = read_header(fp)
+			self.specs = MDHeaderText(header+'\n',regex_time_limit=self.regex_time_limit 
+				if regex_time_limit==None else regex_time_limit)
+			self.specs.core.pop('body')
+			self.chunked = (kwargs.pop('chunked',False) or self.specs.bool('chunked')) and text==None
+			if self.chunked: self.body = BodyStream(fn,fp.tell(),lead)
+			else: 
+				self.body = lead+fp.read()
+				self.raw = header+self.body
+		#---the time limit for the rules may also come from the header and zero turns it off
+		self.regex_time_limit = float(self.specs.spec('regex_time_limit',self.regex_time_limit) 
+			if regex_time_limit==None else regex_time_limit)
 		#---boolean which (when false) supresses any tex comments in latex header (useful for submissions)
 		self.tex_comments = self.specs.bool('tex_comments')
+		#---external build steps go to a scheduler which the caller may share across many documents
+		self.scheduler = kwargs.pop('scheduler',None)
+		self.owns_scheduler = self.scheduler==None
+		if self.owns_scheduler: self.scheduler = Scheduler()
+		#---scheduled steps for this document start ahead of lower priorities when they are ready
+		self.priority = kwargs.pop('priority',0)
+		#---a shared job queue (see jobqueue.py) lets workers on other machines compile the PDFs
+		self.pdf_queue = kwargs.pop('pdf_queue',None)
+		build = kwargs.pop('build',True)
+		#---cache the HTML for each top-level section (on by default in the chunked mode)
+		self.section_cache = kwargs.pop('section_cache',None)
+		if self.section_cache==None: self.section_cache = self.specs.bool('section_cache',self.chunked)
+		#---count and time every rule in the substitution pipeline
+		self.profiler = RuleProfiler(self.name) if (kwargs.pop('profile',False) 
+			or self.specs.bool('profile')) else None
+		#---draft PDFs recompile only the sections which changed, with placeholder figures and one LaTeX pass
+		self.draft = kwargs.pop('draft',None)
+		if self.draft==None: self.draft = self.specs.bool('draft')
+		#---published pages are minified with the critical CSS inline and precompressed for static hosting
+		self.publish = kwargs.pop('publish',None)
+		if self.publish==None: self.publish = self.specs.bool('publish')
+		#---queued jobs only write the equation images for the first format since every format shares them
+		self.writes_equations = kwargs.pop('equation_images',True)
+		#---pdfTeX stamps the PDF with this time (by default the last edit to the markdown) instead of the clock
+		#---...so identical inputs give identical PDFs
+		self.source_date_epoch = self.specs.spec('source_date_epoch',os.environ.get('SOURCE_DATE_EPOCH',None))
+		if self.source_date_epoch==None: 
+			self.source_date_epoch = os.path.getmtime(fn) if text==None else time.time()
+		self.source_date_epoch = int(float(self.source_date_epoch))
 		if kwargs: raise TypeError('unexpected **kwargs: %r'%kwargs)
 
 		#---user may set the tex binary
@@ -290,41 +567,20 @@ class TexDocument:
 		self.latex_binary = self.specs.spec('latex_binary','pdflatex')
 
 		#---some details from dispatch.yaml e.g. global substitutions
-		dispatch_fn = 'dispatch.yaml'
-		if os.path.isfile(dispatch_fn): 
-			with open(dispatch_fn) as fp:
-				dis = yaml.load(fp.read())
-			aliases = {}
-			#---aliases that should apply to both HTML and LaTeX
-			if 'alias' in dis: aliases.update(**dis['alias'])
-			#---local alias dictionary in the header overrides dispatch
-			if self.specs['alias']: aliases.update(**eval(self.specs['alias']))
-			for subs in ['subs_tex','subs_html']:
-				tex_html_subs = [(i,j) for i,j in aliases.items()]+\
-					[(key,val) for key,val in getattr(self,subs).items()]
-				setattr(self,subs,odict(tex_html_subs))
+		#---aliases that should apply to both HTML and LaTeX run before the other substitutions
+		aliases = dict(self.project.aliases)
+		#---local alias dictionary in the header overrides dispatch (either "~alias" yaml or a python dict)
+		local_aliases = self.specs['alias']
+		if local_aliases: aliases.update(**(local_aliases if type(local_aliases)==dict else eval(local_aliases)))
+		self.alias_sub = alias_matcher(aliases,profiler=self.profiler)
 
 		#---autodetect available LaTeX headers
 		self.available_tex_formats = [re.match(r'^header-(.+)\.tex',os.path.basename(fn)).group(1)
-			for fn in glob.glob('cas/sources/header-*.tex')]
+			for fn in glob.glob(self.project.sources('header-*.tex'))]
 
 		#---figure paths and equation settings (e.g. vectorbold) must be decided on the fly
 		self.vectorbold = self.specs.bool('vectorbold')
 		self.image_location = self.specs.spec('images')
-		self.subs_multi_tex.update(**{self.figure_regex:self.figure_convert_tex})
-		self.subs_multi_html.update(**{
-			self.figure_regex:self.figure_convert_html,
-			self.regex_equation:
-				lambda x : '\n$$'+('' if not self.vectorbold else self.vector_bold_command)+
-					r"\begin{equation}%s"%('' if x[1] else r'\notag')+x[0]+r"%s\\end{equation}"%
-					(r"\label{eq:%s}"%underscore(x[1]) if x[1] else '')+'$$\n',})
-		#---handle block code here
-		self.subs_multi_html.update(**{'\n~~~\n(.*?)\n~~~\n':lambda x:
-			'<br><br><textarea style="'+
-			'width:100%;white-space: pre;overflow-wrap: normal;overflow-x: auto;resize: none;'+
-			'" rows="'+str(len(x[0].splitlines())-1+1)+'">'+x[0]+
-			'</textarea><br><br>'})
-			#---! added three rows above because it was too squished if you have overruns and the horizontal scroll
 
 		#---figure style for turning @fig:name into e.g. "figure (2)"
 		#---figure prefix for making supplements with figures numbered "S1" usw
@@ -339,126 +595,240 @@ class TexDocument:
 		self.eqnpref = self.specs.spec('eqnpref',default='')
 		self.tabpref = self.specs.spec('tabpref',default='')
 
-		#---prefixing happens live so we populate the subs here
-		self.subs_tex.update(**{'@fig:(%s+)'%self.labelchars:
-			lambda x:self.figstyle%(r"\ref{fig:%s}"%(underscore(x.group(1))))})
-			#---previously: but some texlive forbids underscores: self.figstyle%(r"\\ref{fig:\1}")})
-		self.subs_tex.update(**{'@sec:(%s+)'%self.labelchars:
-			lambda x:self.secstyle%(r"\ref{sec:%s}"%(underscore(x.group(1))))})
-			#---previously: self.secstyle%(r"\\ref{sec:\1}")})
-		self.subs_tex.update(**{'@eq:(%s+)'%self.labelchars:
-			lambda x:self.eqnstyle%(r"\ref{eq:%s}"%(underscore(x.group(1))))})
-			#---previously: self.eqnstyle%(r"\\ref{eq:\1}")})
-		self.subs_html.update(**{'@sec:(%s+)'%self.labelchars:
-			'<a href="#%s">%s</a>'%(r"\1",self.secstyle_html%(self.secpref+r"\1")),
-			'@(eq:%s+)'%self.labelchars:self.eqnstyle%r"$\\eqref{\1}$"})
+		#---each document gets its own read-only rule sets built from the class defaults and the styles above
+		self.subs_tex,self.subs_html,self.subs_multi_tex,self.subs_multi_html = self.rule_sets()
 		self.bibfile = self.specs.spec('bibliography')
-		self.write_equation_images = self.specs.bool('write_equation_images')
+		if self.bibfile: self.bibfile = self.project.path(self.bibfile)
+		self.write_equation_images = self.specs.bool('write_equation_images') and self.writes_equations
+		#---render equations to inline SVG at build time instead of using MathJax in the browser
+		self.svg_math = self.specs.bool('svg_math')
+		#---point HTML figures to downscaled copies unless the header says otherwise
+		self.web_images = self.specs.bool('web_images',True)
 
 		#---keep track of images
 		#---! some of these might be deprecated?
 		self.images,self.equation_counter,self.refs = [],0,[]
+		#---every LaTeX format sees the same equations but their images are written once per document
+		self.equations_submitted = set()
 
 		#---select latex header types and loop over requested document types
 		self.render_types = [i for i in self.available_tex_formats if self.specs.bool(i)]
-		for rt in self.render_types:
-			self.style = rt
-			if self.specs.bool(rt):
-
-				self.parts = odict()
-				self.package_dir = 'printed/'+self.name+'-'+rt
-				if not os.path.isdir('printed'): os.mkdir('printed')
-				if not os.path.isdir(self.package_dir): os.mkdir(self.package_dir)
-				#---tagalongs must be a python list of files to bring along
-				if self.specs.spec('tagalongs'):
-					along_list = eval(self.specs.spec('tagalongs'))
-					for fn in along_list: shutil.copy(fn,os.path.join(self.package_dir,''))
-				with open('./cas/sources/header-%s.tex'%rt) as fp: self.parts['header'] = fp.readlines()
-				#---the "LOCAL" keyword in a TeX header comment specifies files that must be copied
-				regex = r'^\s*%-+\s*LOCAL\s*([^\s]+)\s*$'
-				reqs = [re.match(regex,i).group(1) for i in self.parts['header'] if re.match(regex,i)]
-				for req in reqs: shutil.copy(os.path.join('cas/sources',req),self.package_dir)
-
-				self.sections = odict([(re.findall(self.latex_sectioner,i)[0],ii) 
-					for ii,i in enumerate(self.parts['header']) if re.match(self.latex_sectioner,i)])
-				#---! note this is clumsy and repetitive
-				#---mark the line number for replacements
-				self.header_replacements = odict([(re.findall(self.latex_header_replacer,i)[0],ii) 
-					for ii,i in enumerate(self.parts['header']) if re.match(self.latex_header_replacer,i)])
-
-				self.embed_bbl = self.specs.bool('embed_bbl')
-				#---! always embed BBL
-				self.embed_bbl = True
-				
-				#---cancel if necessary
-				if self.specs.bool('avoid'): continue
-
-				#---PARSERS
-				print("[STATUS] rendering to PDF in %s format"%rt)
-				self.direct()
-				self.proc()
-				self.bib()
-
-				#---the NOCOMPILE comment flag prevents compile steps in the case of e.g. chapters
-				nocompile = any([i for i in self.parts['header'] if re.match(r'^\s*%-+\s*NOCOMPILE',i)])
-
-				#---extras
-				if not nocompile:
-					if self.vectorbold: 
-						for line in self.vector_bold_command.split('\n'):
-							self.header_more(line)
-					#---! need to add header extras from specs here in a standard format
-					if self.eqnpref : self.header_more(self.equation_prefix%self.eqnpref)
-					if self.secpref: self.header_more(self.section_prefix%self.secpref)
-					if self.figpref: self.header_more(self.figure_prefix%self.figpref)
-					if self.tabpref: self.header_more(self.table_prefix%self.tabpref)
-					#---check for custom "moreheader" entries to add to the latex header
-					extras = self.specs.customs(article=self.style).get('moreheader',None) 
-					if not extras: 
-						extras_general = self.specs.spec('moreheader',None)
-						if extras_general: self.header_more(extras_general)
-					else: self.header_more(self.specs.spec(extras))
-
-				#---write and render
-				self.write_relative(fn=self.name,dn=self.package_dir,nocompile=nocompile)
-				if not nocompile: self.render()
-
-		#---! do we need at least one PDF style to get the self.parts and is this necessary?
-		#---render HTML if desired
-		if self.specs.spec('images'):
-			self.image_location = os.path.join(self.specs.spec('images'),'')
 		#---! removed the option otherwise make always makes: self.html_output = self.specs.bool('html')
 		self.html_output = True
 		self.html_template = self.specs.spec('html_template','header.html')
-		if self.html_output: 
-			self.direct_html()
-			self.proc(version='html')
-			self.bibliography_html()
-			self.write_html(fn=self.name,dn='./')
 		self.notes = self.specs.bool('notes')
-		if self.notes: self.direct_notes()
+		self.timings.append(('all','parse',time.time()-start))
+		if build: self.build()
 
+	def build(self):
+		"""
+		Write every requested format, the HTML, and the sentence-split copy to disk.
+		"""
+		for rt in self.render_types: 
+			if self.pdf_queue: self.pdf_queue.submit(self.name,rt,priority=self.priority,draft=self.draft,
+				equation_images=rt==self.render_types[0])
+			else: self.compile_pdf(rt,wait=False)
+		#---! do we need at least one PDF style to get the self.parts and is this necessary?
+		#---render HTML if desired
+		if self.html_output: 
+			start = time.time()
+			self.prepare_html()
+			self.write_html(fn=self.name,dn=self.output_root)
+			self.timings.append(('html','proc',time.time()-start))
+		if self.notes: self.direct_notes()
 		#---after all this we save a sentence-split version of the file and commit it
 		self.posterity()
+		if self.owns_scheduler: self.scheduler.run()
+		if self.profiler: self.profile_report()
+
+	def profile_report(self):
+		"""Print the slowest rules and write all of them to the hold directory. Returns the JSON file."""
+		print(self.profiler.table())
+		fn = self.profiler.write(os.path.join(self.hold_dir,'profile','%s.json'%self.name))
+		print('[STATUS] wrote the rule profile to %s'%fn)
+		return fn
+
+	def read_latex_header(self,rt):
+		"""
+		Start the parts of a LaTeX document from the header for one format.
+		"""
+		if rt not in self.available_tex_formats:
+			raise Exception('cannot find a LaTeX header for format "%s". we have: %s'%(
+				rt,', '.join(self.available_tex_formats)))
+		self.style = rt
+		self.parts = odict()
+		with open(self.project.sources('header-%s.tex'%rt)) as fp: self.parts['header'] = fp.readlines()
+		self.sections = odict([(re.findall(self.latex_sectioner,i)[0],ii) 
+			for ii,i in enumerate(self.parts['header']) if re.match(self.latex_sectioner,i)])
+		#---! note this is clumsy and repetitive
+		#---mark the line number for replacements
+		self.header_replacements = odict([(re.findall(self.latex_header_replacer,i)[0],ii) 
+			for ii,i in enumerate(self.parts['header']) if re.match(self.latex_header_replacer,i)])
+		self.embed_bbl = self.specs.bool('embed_bbl')
+		#---! always embed BBL
+		self.embed_bbl = True
+
+	def prepare_latex(self,equations=True):
+		"""
+		Fill in the LaTeX parts after read_latex_header and return True if the header says NOCOMPILE.
+		"""
+		#---PARSERS
+		self.direct()
+		self.proc(equations=equations)
+		self.bib()
+
+		#---the NOCOMPILE comment flag prevents compile steps in the case of e.g. chapters
+		nocompile = any([i for i in self.parts['header'] if re.match(r'^\s*%-+\s*NOCOMPILE',i)])
+
+		#---extras
+		if not nocompile:
+			if self.vectorbold: 
+				for line in self.vector_bold_command.split('\n'):
+					self.header_more(line)
+			#---! need to add header extras from specs here in a standard format
+			if self.eqnpref : self.header_more(self.equation_prefix%self.eqnpref)
+			if self.secpref: self.header_more(self.section_prefix%self.secpref)
+			if self.figpref: self.header_more(self.figure_prefix%self.figpref)
+			if self.tabpref: self.header_more(self.table_prefix%self.tabpref)
+			#---check for custom "moreheader" entries to add to the latex header
+			extras = self.specs.customs(article=self.style).get('moreheader',None) 
+			if not extras: 
+				extras_general = self.specs.spec('moreheader',None)
+				if extras_general: self.header_more(extras_general)
+			else: self.header_more(self.specs.spec(extras))
+		return nocompile
+
+	def to_latex(self,rt):
+		"""
+		Render the LaTeX for one format as a string without writing anything to the printed folder.
+		Figures point to the original images and the bibliography to the original bib file.
+		"""
+		self.read_latex_header(rt)
+		nocompile = self.prepare_latex(equations=False)
+		self.finish_parts(nocompile,self.bibfile)
+		self.figure_pattern,self.figure_paths = None,{}
+		buffer = io.StringIO()
+		self.write_tex(buffer)
+		return buffer.getvalue()
+
+	def compile_pdf(self,rt,wait=True):
+		"""
+		Write the self-contained LaTeX package for one format and compile it.
+		If the document owns its scheduler we wait for the PDF, otherwise the caller runs the shared scheduler.
+		Returns the path to the PDF or None if the header asks us to avoid this format.
+		Drafts are written to <name>-draft.tex beside the full copy so they share the staged figures.
+		We skip LaTeX entirely when the last successful build compiled the same inputs.
+		"""
+		start = time.time()
+		self.package_dir = self.project.output(self.package_prefix,self.name+'-'+rt)
+		if not os.path.isdir(self.package_dir): os.makedirs(self.package_dir)
+		#---tagalongs must be a python list of files to bring along
+		self.package_inputs = []
+		if self.specs.spec('tagalongs'):
+			along_list = eval(self.specs.spec('tagalongs'))
+			for fn in along_list: shutil.copy(self.project.path(fn),os.path.join(self.package_dir,''))
+			self.package_inputs.extend(os.path.basename(fn) for fn in along_list)
+		self.read_latex_header(rt)
+		#---the "LOCAL" keyword in a TeX header comment specifies files that must be copied
+		regex = r'^\s*%-+\s*LOCAL\s*([^\s]+)\s*$'
+		reqs = [re.match(regex,i).group(1) for i in self.parts['header'] if re.match(regex,i)]
+		for req in reqs: shutil.copy(self.project.sources(req),self.package_dir)
+		self.package_inputs.extend(os.path.basename(req) for req in reqs)
+
+		#---cancel if necessary
+		if self.specs.bool('avoid'): return None
+
+		print("[STATUS] rendering to PDF in %s format"%rt)
+		nocompile = self.prepare_latex()
+		jobname = self.name+'-draft' if self.draft and not nocompile else self.name
+
+		#---write and render
+		converts = self.write_relative(fn=jobname,dn=self.package_dir,nocompile=nocompile)
+		self.timings.append((rt,'proc',time.time()-start))
+		#---figures which need a conversion changed since the last build so we only check the inputs without them
+		if not nocompile and not self.draft and not converts and self.pdf_current() and self.restore_compiled():
+			print('[STATUS] the PDF of %s in %s format is up to date'%(self.name,rt))
+		#---later formats and the HTML rebind the parts so the deferred steps use a shallow copy
+		elif not nocompile: copy(self).render(deps=converts)
+		if wait and self.owns_scheduler: self.scheduler.run()
+		return os.path.join(self.package_dir,jobname+'.pdf')
+
+	def prepare_html(self):
+		"""
+		Fill in the parts of the HTML document.
+		"""
+		if self.specs.spec('images'):
+			self.image_location = os.path.join(self.specs.spec('images'),'')
+		self.direct_html()
+		self.proc(version='html')
+		self.bibliography_html()
+
+	def to_html(self):
+		"""Render the HTML document as a string without writing it."""
+		self.prepare_html()
+		return ''.join(self.html_lines())
+
+	def rule_sets(self):
+		"""
+		Build the substitutions for this document. The class defaults are read-only and every document adds
+		the rules which depend on its own styles and figures, so many documents can share one process.
+		"""
+		subs_tex = rule_set(self.subs_tex,[
+			#---prefixing happens live so we populate the subs here
+			('@fig:(%s+)'%self.labelchars,
+				lambda x:self.figstyle%(r"\ref{fig:%s}"%(underscore(x.group(1))))),
+				#---previously: but some texlive forbids underscores: self.figstyle%(r"\\ref{fig:\1}")})
+			('@sec:(%s+)'%self.labelchars,
+				lambda x:self.secstyle%(r"\ref{sec:%s}"%(underscore(x.group(1))))),
+			('@eq:(%s+)'%self.labelchars,
+				lambda x:self.eqnstyle%(r"\ref{eq:%s}"%(underscore(x.group(1))))),])
+		subs_html = rule_set(self.subs_html,[
+			('@sec:(%s+)'%self.labelchars,'<a href="#%s">%s</a>'%(r"\1",self.secstyle_html%(self.secpref+r"\1"))),
+			('@(eq:%s+)'%self.labelchars,self.eqnstyle%r"$\\eqref{\1}$"),])
+		subs_multi_tex = rule_set(self.subs_multi_tex,[(self.figure_regex,self.figure_convert_tex)])
+		subs_multi_html = rule_set(self.subs_multi_html,[
+			(self.figure_regex,self.figure_convert_html),
+			(self.regex_equation,
+				lambda x : '\n$$'+('' if not self.vectorbold else self.vector_bold_command)+
+					r"\begin{equation}%s"%('' if x[1] else r'\notag')+x[0]+r"%s\\end{equation}"%
+					(r"\label{eq:%s}"%underscore(x[1]) if x[1] else '')+'$$\n'),
+			#---handle block code here
+			('\n~~~\n(.*?)\n~~~\n',lambda x:
+				'<br><br><textarea style="'+
+				'width:100%;white-space: pre;overflow-wrap: normal;overflow-x: auto;resize: none;'+
+				'" rows="'+str(len(x[0].splitlines())-1+1)+'">'+x[0]+
+				'</textarea><br><br>'),])
+			#---! added three rows above because it was too squished if you have overruns and the horizontal scroll
+		return subs_tex,subs_html,subs_multi_tex,subs_multi_html
 
 	def posterity(self):
 		"""
 		Save a version of this file suitable for git, specifically with one sentence per line.
 		"""
-		perfect_text = self.specs.header
-		perfect_text += re.sub(r"(\.|\?|\.\")[ \t]+([^\n])",r"\1\n\2",self.body)
-		perfect_text = re.sub('[\n]{2,}','\n\n',perfect_text)
-		purename = self.puredir+'/'+self.name+'.pure'
-		with open(purename,'w') as fp: fp.write(perfect_text)
+		purename = self.project.path(self.puredir,self.name+'.pure')
+		with open(purename,'w') as fp: 
+			writer = NewlineWriter(fp,minimum=2,replacement='\n\n')
+			writer.write(self.specs.header)
+			for text in self.body_sections():
+				writer.write(re.sub(r"(\.|\?|\.\")[ \t]+([^\n])",r"\1\n\2",text))
+			writer.close()
 		print('[STATUS] wrote %s'%purename)
 
+	def body_sections(self):
+		"""Iterate over the raw body in one piece or by sections in the chunked mode."""
+		return self.body.sections() if self.chunked else [self.body]
+
+	def fresh_body(self):
+		"""Get the body for a new rendering pass. Streams are copied so each pass has its own transforms."""
+		return self.body.copy() if self.chunked else self.body
+
 	def direct(self):
 		"""
 		Prepare each section of the document according to replacement flags in the LaTeX 
 		header and a set of simple rules.
 		"""
 		#---retrieve a footer if it exists
-		footer_fn = 'cas/sources/footer-%s.tex'%self.style
+		footer_fn = self.project.sources('footer-%s.tex'%self.style)
 		if os.path.isfile(footer_fn):
 			with open(footer_fn) as fp: footer_lines = fp.readlines()
 		else: footer_lines = []
@@ -471,10 +841,8 @@ class TexDocument:
 			'abstract':('\n\\begin{abstract}\n'+
 				self.specs.spec('abstract')+'\n\\end{abstract}'
 				if self.specs.spec('abstract') else ''),
-			'body':self.body,
-			'bbl':'\\bibliography{%s}\n'%
-				os.path.abspath(self.specs.spec('bibliography')) 
-				if self.specs.spec('bibliography') else None,
+			'body':self.fresh_body(),
+			'bbl':'\\bibliography{%s}\n'%self.bibfile if self.bibfile else None,
 			'footer':footer_lines,}
 
 		#---loop over the sections marked in comments in the header
@@ -505,7 +873,11 @@ class TexDocument:
 		"""
 		#---while the direct function for latex infers sections from comments we hard-code them for html
 		self.parts = {}
-		with open('./cas/sources/%s'%self.html_template,'r') as fp: self.html_header = fp.readlines()
+		with open(self.project.sources(self.html_template),'r') as fp: self.html_header = fp.readlines()
+		#---the stylesheet link is relative to the project root so we repoint it when writing elsewhere
+		if self.output_root!=self.root:
+			self.html_header = [i.replace('"./cas/sources/','"%s/'%self.html_path(self.project.sources()))
+				for i in self.html_header]
 		#---replace title in html header
 		for ll,l in enumerate(self.html_header):
 			if re.search('@TITLE',l) != None: 
@@ -514,6 +886,9 @@ class TexDocument:
 			extra_css = "\n"
 			if re.search('@EXTRA_CSS',l) != None: 
 				self.html_header[ll] = re.sub('@EXTRA_CSS',extra_css,l)
+		if self.svg_math:
+			self.html_header = strip_mathjax(self.html_header)
+			self.math = MathRenderer(cache_dn=os.path.join(self.hold_dir,'math'))
 		self.parts['header'] = self.html_header
 
 		#---add authors
@@ -534,7 +909,10 @@ class TexDocument:
 		self.parts['abstract'] = abstract_text
 
 		#---track the parts list here in parselib rather than in the html header
-		self.parts['body'] = self.body
+		#---the section cache needs the body in sections even when we hold all of it in memory
+		if self.section_cache and not self.chunked: self.parts['body'] = BodyStream(None,0,text=self.body)
+		else: self.parts['body'] = self.fresh_body()
+		self.ordlookup = {}
 		self.parts_list = ['header','author','abstract','body']
 
 	def bibliography_html(self):
@@ -547,44 +925,35 @@ class TexDocument:
 
 		if not os.path.isfile(self.bibfile):
 			raise Exception('cannot find bibliography %s. remove it from the header or find it'%self.bibfile)
-		with open(self.bibfile,'r') as fp: biblines = fp.readlines()
-		#---entry starting line numbers
-		lnos = linesnip(biblines,'@',is_header=False)
-		#---we must exclude comments from the bib file
-		bibkeys = [re.findall(r'@[A-Za-z]+\s?\{([^,]+),',biblines[ll])[0] 
-			for ll in lnos if re.match('^@(?!comment)',biblines[ll])]
+		#---the same reader writes the bbl for LaTeX
+		entries = read_bib(self.bibfile,cache_dn=os.path.join(self.hold_dir,'bbl'))
+		bibkeys = list(entries.keys())
 
 		regex_bibref = r"\[?@(%s)(?:\s|\])?"
-		reforder_non_unique = re.findall(regex_bibref%self.bibkey,self.body)
+		reforder_non_unique = [i for text in self.body_sections() 
+			for i in re.findall(regex_bibref%self.bibkey,text)]
 		reforder = []
 		for r in reforder_non_unique:
 			if r not in reforder: reforder.append(r)
-		ordlookup = dict([(i,ii+1) for ii,i in enumerate(reforder)])
+		ordlookup = self.ordlookup = dict([(i,ii+1) for ii,i in enumerate(reforder)])
 		html.append('<br><h2>References</h2><br>\n<ol>\n')
 		html.append('<ol>\n')
 		
 		#---replace references with numbers
-		for lineno,line in enumerate(self.parts['body']):
-			if re.search('@%s'%self.bibkey,line) != None:
-				for found in re.findall('@(%s)+'%self.bibkey,line):
-					try:
-						self.parts['body'][lineno] = re.sub('@%s'%found,
-							'[<a href="#refno%d">%d</a>]'%(ordlookup[found],ordlookup[found]),
-							self.parts['body'][lineno])
-					except: raise Exception('cannot link %s'%found)
+		if isinstance(self.parts['body'],BodyStream): 
+			self.parts['body'].transforms.append(functools.partial(self.cite_html_lines,ordlookup=ordlookup))
+		else: self.parts['body'] = self.cite_html_lines(self.parts['body'],ordlookup)
 
 		details = {}
 		for key in sorted(ordlookup.keys()):
 			#---extract data from bibtex
-			dat = ''.join(biblines[slice(*linesnip(biblines,r'@[A-Za-z]+\{%s'%key,'@'))])
-			authors = ''.join(re.findall(r'(?:A|a)uthor\s*=\s*\{([^\}]+)',dat))
-			try: year = int(re.findall(r'(?:Y|y)ear\s*=\s*\{([^\}]+)',dat)[0])
+			dat = entries.get(key,{})
+			authors = dat.get('author','')
+			try: year = int(dat['year'])
 			except: raise Exception('[ERROR] cannot find bibkey "%s" in the database (check the year)'%key)
-			title = re.findall(r'(?:T|t)itle\s*=\s*\{+([^\}]+)',dat)[0]
-			try: journal = re.findall(r'Journal\s*=\s*\{([^\}]+)',dat)[0]
-			except: journal = ''
-			try: url = re.findall(r'(?:U|u)rl\s*=\s*\{([^\}]+)',dat)[0]
-			except: url = "BROKEN LINK"
+			title = dat.get('title','').strip('{}')
+			journal = dat.get('journal','')
+			url = dat.get('url',"BROKEN LINK")
 			if journal != '':
 				#! make this more concise
 				if url!='BROKEN LINK':
@@ -605,9 +974,66 @@ class TexDocument:
 		#---add html lines to the bibliography
 		self.parts['bibliography'] = html
 
-	def proc(self,part='body',version='latex'):
+	def cite_html_lines(self,lines,ordlookup):
+		"""Replace references with numbered links."""
+		prof = self.profiler
+		search,findall,sub = ((prof.wrap('cite_html',re.search),prof.wrap('cite_html',re.findall,count=len),
+			prof.sub('cite_html',label='@<key>')) if prof else (re.search,re.findall,re.sub))
+		for lineno,line in enumerate(lines):
+			if search('@%s'%self.bibkey,line) != None:
+				for found in findall('@(%s)+'%self.bibkey,line):
+					try:
+						lines[lineno] = sub('@%s'%found,
+							'[<a href="#refno%d">%d</a>]'%(ordlookup[found],ordlookup[found]),lines[lineno])
+					except: raise Exception('cannot link %s'%found)
+		return lines
+
+	def proc(self,part='body',version='latex',equations=True):
 		"""
 		Perform all text transformations for the body of a document.
+		In the chunked mode we collect figures and equations in a first pass over the raw sections and record
+		the transformations, which are applied to each section as the body is written.
+		Equation images are only written if the header asks for them and we receive equations.
+		"""
+		if version not in ['latex','html']: raise Exception('unclear rules version: %s'%version)
+		body = self.parts[part]
+		#---collect image names and paths for later
+		#---track the order of images for numbering in HTML and conversion to PDF in LaTeX
+		#---! note that we disallow the use of the regular markdown figure syntax, which must be removed
+		texts = body.sections() if isinstance(body,BodyStream) else [''.join(body)]
+		self.images = []
+		for text in texts:
+			self.images.extend([i[:2] for i in re.findall(self.figure_regex,text,re.MULTILINE+re.DOTALL)])
+			#---intervene to write all the equations to separate PNGs
+			if version == 'latex' and self.write_equation_images and equations: self.equation_images(text)
+			#---number the labeled equations before any references to them are rendered
+			if version == 'html' and self.svg_math:
+				for equation,name in re.findall(self.regex_equation,text,re.MULTILINE+re.DOTALL):
+					if name: self.math.register(name)
+		if self.images and not (self.image_location and os.path.isdir(self.project.path(self.image_location))):
+			raise Exception('invalid image location %s'%self.image_location)
+		missing_images = [fn for name,fn in self.images 
+			if not os.path.isfile(self.project.path(self.image_location,fn))]
+		if any(missing_images):
+			raise Exception('[ERROR] missing images:\n%s\n'%'\n'.join(missing_images))
+		if isinstance(body,BodyStream): 
+			body.transforms.append(functools.partial(self.proc_lines,version=version))
+		else: self.parts[part] = self.proc_lines(body,version=version)
+
+	def equation_images(self,text):
+		"""Write each display equation in the text to a PNG in a scheduled step."""
+		rule = re.compile(self.regex_equation,re.MULTILINE+re.DOTALL)
+		for equation,name in rule.findall(text):
+			if (equation,name) in self.equations_submitted: continue
+			self.equations_submitted.add((equation,name))
+			self.equation_counter += 1
+			self.submit('equation-%d'%self.equation_counter,functools.partial(write_tex_png,equation,
+				self.name,self.equation_counter,vectorbold=self.vectorbold,label=name,
+				dn=self.project.output(self.package_prefix)))
+
+	def proc_lines(self,lines,version='latex'):
+		"""
+		Apply the multiline substitutions and the line rules to a list of lines (or a string).
 		"""
 		if version == 'latex': 
 			rules = self.rules_tex
@@ -620,112 +1046,208 @@ class TexDocument:
 			subs_multi = self.subs_multi_html
 			special_subs = self.special_subs_html
 		else: raise Exception('unclear rules version: %s'%version)
+		#---the profiler swaps in versions of the regex calls which record each rule
+		suffix,prof = {'latex':'tex','html':'html'}[version],self.profiler
+		if prof:
+			match,sub,special_sub = [prof.wrap('rules_%s'%suffix,re.match),
+				prof.sub('subs_%s'%suffix),prof.sub('special_subs_%s'%suffix)]
+			multi_sub = prof.sub('subs_multi_%s'%suffix)
+			multi_each = functools.partial(prof.timed,'subs_multi_%s'%suffix)
+		else: 
+			match,sub,special_sub = re.match,re.sub,re.sub
+			multi_sub = lambda rule,convert,text:rule.sub(convert,text)
+			multi_each = lambda raw_rule,func,*args:func(*args)[0]
 
-		#---multiline substitutions
-		newlined = ''.join(self.parts[part])
-		#---collect image names and paths for later
-		#---track the order of images for numbering in HTML and conversion to PDF in LaTeX
-		#---! note that we disallow the use of the regular markdown figure syntax, which must be removed
-		self.images = [i[:2] for i in re.findall(self.figure_regex,newlined,re.MULTILINE+re.DOTALL)]
-		if self.images and not os.path.isdir(str(self.image_location)):
-			raise Exception('invalid image location %s'%self.image_location)
-		missing_images = [fn for name,fn in self.images 
-			if not os.path.isfile(os.path.join(self.image_location,fn))]
-		if any(missing_images):
-			raise Exception('[ERROR] missing images:\n%s\n'%'\n'.join(missing_images))
-		#---intervene to write all the equations to separate PNGs
-		if version == 'latex' and self.write_equation_images:
-			rule = re.compile(self.regex_equation,re.MULTILINE+re.DOTALL)
-			for ii,(equation,name) in enumerate(rule.findall(newlined)):
-				write_tex_png(equation,
-					self.name,self.equation_counter,vectorbold=self.vectorbold,label=name)
-		#---block comments only work when you compile!
-		comps = [(rule,re.compile(rule,re.MULTILINE+re.DOTALL),convert) 
-			for rule,convert in subs_multi.items()]
-		for raw_rule,rule,convert in comps:
-			if type(convert)==str:
-				try: newlined = rule.sub(convert,newlined)
-				except: raise Exception('[ERROR] failed to convert %s to %s'%(str(raw_rule),convert))
-			else:
-				caught = rule.search(newlined)
-				while caught:
-					newlined = ''.join([
-						newlined[:caught.start()],
-						convert(caught.groups()),
-						newlined[caught.end():]])
-					caught = rule.search(newlined)
-		self.parts[part] = newlined.splitlines(True)
-		
-		#---entire-line replacements in the body
-		for lineno,line in enumerate(self.parts[part]):
-			for rule in rules:
-				if re.match(rule,line):
-					self.parts[part][lineno] = rules[rule](re.findall(rule,line)[0])
-
-		#---substitution rules
-		for lineno,line in enumerate(self.parts[part]):
-			for rule,convert in subs.items():
-				self.parts[part][lineno] = re.sub(rule,convert,self.parts[part][lineno])
-		#---special latex substitutions
-		for lineno,line in enumerate(self.parts[part]):
-			for a,b in special_subs.items(): 
-				self.parts[part][lineno] = re.sub(a,b,self.parts[part][lineno])
+		#---unbalanced markup can make some rules backtrack for a long time so we stop at the time limit and 
+		#---...report the stage, rule and line which were running
+		stage,raw_rule,lineno,newlined = 'multi',None,0,''.join(lines)
+		try:
+			with time_limit(self.regex_time_limit):
+				#---multiline substitutions
+				#---block comments only work when you compile!
+				comps = [(rule,re.compile(rule,re.MULTILINE+re.DOTALL),convert) 
+					for rule,convert in subs_multi.items()]
+				for raw_rule,rule,convert in comps:
+					if type(convert)==str:
+						try: newlined = multi_sub(rule,convert,newlined)
+						except RegexTimeout: raise
+						except: raise Exception('[ERROR] failed to convert %s to %s'%(str(raw_rule),convert))
+					#---functions may create new matches so we search again from each replacement
+					#---...and they may run external tools (for example on figures) so only the matching is timed
+					else: newlined = multi_each(raw_rule,replace_each,rule,unguarded(convert),newlined)
+				lines = newlined.splitlines(True)
+				
+				#---entire-line replacements in the body
+				stage = 'rules'
+				for lineno,line in enumerate(lines):
+					for rule in rules:
+						if match(rule,line):
+							lines[lineno] = rules[rule](re.findall(rule,line)[0])
+
+				#---aliases go first in one pass over each line
+				#---the lines are joined so that math or code which spans lines is protected as a whole
+				stage = 'aliases'
+				if self.alias_sub: lines = self.alias_sub('\x00'.join(lines)).split('\x00')
+				#---substitution rules
+				stage = 'subs'
+				for lineno,line in enumerate(lines):
+					for rule,convert in subs.items():
+						lines[lineno] = sub(rule,convert,lines[lineno])
+				#---special latex substitutions
+				stage = 'special_subs'
+				for lineno,line in enumerate(lines):
+					for rule,convert in special_subs.items(): 
+						lines[lineno] = special_sub(rule,convert,lines[lineno])
 
-		#---capitalize figures
-		for lineno,line in enumerate(self.parts[part]):
-			self.parts[part][lineno] = re.sub(r'\. figure',r'. Figure',self.parts[part][lineno])
-			self.parts[part][lineno] = re.sub('^figure','Figure',self.parts[part][lineno])
+				#---capitalize figures
+				stage = 'capitalize'
+				for lineno,line in enumerate(lines):
+					lines[lineno] = re.sub(r'\. figure',r'. Figure',lines[lineno])
+					lines[lineno] = re.sub('^figure','Figure',lines[lineno])
+		except RegexTimeout:
+			if stage=='multi': 
+				self.regex_timeout(raw_rule,unmatched_line(re.compile(raw_rule,re.MULTILINE+re.DOTALL),
+					newlined,self.regex_time_limit))
+			elif stage=='aliases': self.regex_timeout('the aliases','')
+			else: self.regex_timeout(rule,lines[lineno])
+		if version == 'html' and self.svg_math: lines = self.math.render(''.join(lines)).splitlines(True)
+		return lines
+
+	def regex_timeout(self,rule,line):
+		"""Stop with the rule which ran past the time limit and the line in the markdown which probably caused it."""
+		lineno = source_line(self.source_text(),line)
+		raise Exception('%s ran for more than %ss on %s.md. check for unbalanced markup%s: "%s"'%(
+			rule if rule in ['the aliases','the citations'] else 'the rule %r'%rule,self.regex_time_limit,
+			self.name,' near line %d'%lineno if lineno else '',snippet(line)))
+
+	def source_text(self):
+		"""The markdown for error messages. In the chunked mode we read it again."""
+		if not self.chunked: return self.raw
+		with open(self.body.fn) as fp: return fp.read()
 
 	def write_html(self,fn,dn):
 		"""
-		Render markdown to HTML.
+		Render markdown to HTML. See publish.py for the published pages.
+		"""
+		if self.publish: 
+			return publish_html(os.path.join(dn,fn+'.html'),''.join(self.html_lines()),
+				os.path.join(self.hold_dir,'publish'),shared_dn=self.project.sources())
+		#---compressed copies from an earlier published build would be served instead of this page
+		remove_compressed(os.path.join(dn,fn+'.html'))
+		with open(os.path.join(dn,fn+'.html'),'w') as fp:
+			for line in self.html_lines(): fp.write(line)
+
+	def html_lines(self):
+		"""
+		Generate the HTML document after prepare_html.
 		"""
+		imagenos = list(zip(*self.images))[0] if self.images else []
 		#---make a copy of self.parts which we will make path substitutions in
 		specific_parts = {}
 		#---loop over each part and make the substitutions
 		for key in self.parts_list:
 			val = self.parts[key]
-			specific_parts[key] = val
-			#import pdb;pdb.set_trace()
-			imagenos = list(zip(*self.images))[0] if self.images else []
-			#---since figure_convert_html writes the bold figure titles carefully, we can simply replace 
-			#---...these by name. note that the greedy search in strong tags makes this precise
-			#---! switching to block of text from lines --- note that we should remove the lined versions
-			#---! ...and operate with blocks more often. we suffix the newline here so the HTML is not all on one line
-			#---! ...and also so that
-			specific_parts[key] = ['%s\n'%i for i in 
-				re.sub('<strong>@fig:(.*?)</strong>',
-				lambda x:'<strong>Figure %d. </strong>'%(imagenos.index(x.group(1))+1),
-				''.join(specific_parts[key])).split('\n')]
-			#---replace figure pointers with links
-			for ll,line in enumerate(specific_parts[key]):
-				#---search and replace figure captions made by figure_convert_html
-				if re.search('@fig',specific_parts[key][ll]) != None:
-					for figlabel in re.findall('@fig:(%s+)'%self.labelchars,specific_parts[key][ll]):
-						if figlabel not in imagenos:
-							raise Exception('figure named "%s" not found in the list of figures: %s'%(
-								figlabel,imagenos))
-						if re.search('@fig:%s([%s])'%(figlabel,self.spacing_chars),
-							specific_parts[key][ll]):
-							specific_parts[key][ll] = re.sub(
-								'@fig:(%s)([%s])'%(figlabel,self.spacing_chars),
-								lambda x:self.figstyle%(
-									r'<a href="#fig:%s">%s%d</a>%s'%(
-										figlabel,self.figpref,imagenos.index(x.group(1))+1,x.group(2))),
-								specific_parts[key][ll])
-				#---capitalize figures
-				#---! redundant with proc
-				for lineno,line in enumerate(self.parts[key]):
-					self.parts[key][lineno] = re.sub(r'\. figure',r'. Figure',self.parts[key][lineno])
-					self.parts[key][lineno] = re.sub('^figure','Figure',self.parts[key][lineno])
-		with open(os.path.join(dn,fn+'.html'),'w') as fp:
-			for key in self.parts_list:
-				if key in specific_parts:
-					val = specific_parts[key]
-					if type(val)==str: fp.write(val)
-					elif type(val)==list: fp.write(''.join(val))
-					else: raise Exception('\n[ERROR] cannot understand this part of the document: %s'%key)
-					fp.write('\n')
+			if isinstance(val,BodyStream): specific_parts[key] = (self.html_section_stream 
+				if self.section_cache and not val.prefix else self.html_figure_stream)(val,imagenos)
+			else: specific_parts[key] = self.html_figure_lines(''.join(val),imagenos)
+		for key in self.parts_list:
+			if key in specific_parts:
+				val = specific_parts[key]
+				if type(val)==str: yield val
+				elif type(val)==list: yield ''.join(val)
+				elif isinstance(val,types.GeneratorType): 
+					for line in val: yield line
+				else: raise Exception('\n[ERROR] cannot understand this part of the document: %s'%key)
+				yield '\n'
+
+	def html_figure_lines(self,text,imagenos):
+		"""
+		Number the figure captions and link the figure references in a block of HTML.
+		"""
+		#---since figure_convert_html writes the bold figure titles carefully, we can simply replace 
+		#---...these by name. note that the greedy search in strong tags makes this precise
+		#---! switching to block of text from lines --- note that we should remove the lined versions
+		#---! ...and operate with blocks more often. we suffix the newline here so the HTML is not all on one line
+		#---! ...and also so that
+		prof = self.profiler
+		sub,search,findall = ((prof.sub('figures_html'),prof.wrap('figures_html',re.search),
+			prof.wrap('figures_html',re.findall,count=len)) if prof else (re.sub,re.search,re.findall))
+		search_label,sub_label = ((prof.wrap('figures_html',re.search,label='@fig:<label>'),
+			prof.sub('figures_html',label='@fig:<label>')) if prof else (re.search,re.sub))
+		lines = ['%s\n'%i for i in 
+			sub('<strong>@fig:(.*?)</strong>',
+			lambda x:'<strong>Figure %d. </strong>'%(imagenos.index(x.group(1))+1),text).split('\n')]
+		#---replace figure pointers with links
+		for ll,line in enumerate(lines):
+			#---search and replace figure captions made by figure_convert_html
+			if search('@fig',lines[ll]) != None:
+				for figlabel in findall('@fig:(%s+)'%self.labelchars,lines[ll]):
+					if figlabel not in imagenos:
+						raise Exception('figure named "%s" not found in the list of figures: %s'%(
+							figlabel,imagenos))
+					if search_label('@fig:%s([%s])'%(figlabel,self.spacing_chars),lines[ll]):
+						lines[ll] = sub_label(
+							'@fig:(%s)([%s])'%(figlabel,self.spacing_chars),
+							lambda x:self.figstyle%(
+								r'<a href="#fig:%s">%s%d</a>%s'%(
+									figlabel,self.figpref,imagenos.index(x.group(1))+1,x.group(2))),
+							lines[ll])
+		return lines
+
+	def html_figure_stream(self,stream,imagenos,chunks=None):
+		"""
+		Apply html_figure_lines one section at a time. We carry any unterminated line into the next section 
+		so that the lines match what we would get from the whole body.
+		"""
+		carry = ''
+		for chunk in (stream.chunks() if chunks==None else chunks):
+			text = carry+''.join(chunk)
+			cut = text.rfind('\n')+1
+			text,carry = text[:cut],text[cut:]
+			#---the last item is the empty remainder after the final newline which we carry instead
+			for line in self.html_figure_lines(text,imagenos)[:-1]: yield line
+		for line in self.html_figure_lines(carry,imagenos): yield line
+
+	def section_key(self,section):
+		"""
+		Hash everything which determines the processed HTML for one section: its text, the document settings, and
+		the numbers of the citations and equations it refers to, which depend on the rest of the document.
+		Figure numbers are applied to the whole body afterwards so they are not part of the key.
+		"""
+		figures = re.findall(self.figure_regex,section,re.MULTILINE+re.DOTALL)
+		citations = sorted(set(re.findall(r"\[?@(%s)(?:\s|\])?"%self.bibkey,section)))
+		equations = sorted(set(re.findall('@eq:(%s+)'%self.labelchars,section)))
+		#---the web copies of a figure change with the image
+		stat = lambda fn:[os.path.getmtime(fn),os.path.getsize(fn)] if os.path.isfile(fn) else None
+		signature = [renderer_version(),self.specs.header,self.root,self.output_root,
+			sorted((str(i),str(j)) for i,j in self.project.aliases.items()),section,
+			[(i,self.ordlookup.get(i,None)) for i in citations],
+			[(i,self.math.numbers.get(i,None)) for i in equations] if self.svg_math else [],
+			[stat(self.project.path(self.image_location or '',path)) for label,path,caption in figures]]
+		return hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+
+	def html_section_stream(self,stream,imagenos):
+		"""
+		Render the body like html_figure_stream but reuse the processed HTML for each section whose key is 
+		unchanged since the last build, so an edit only processes the sections it touches.
+		"""
+		cache_fn = os.path.join(self.hold_dir,'sections','%s.json'%self.name)
+		cache = read_manifest(cache_fn)
+		previous = set(cache)
+		def chunks():
+			used,hits = {},0
+			for section in stream.sections():
+				key = self.section_key(section)
+				if key in cache: hits += 1
+				else: cache[key] = ''.join(stream.apply(section))
+				used[key] = cache[key]
+				yield [used[key]]
+			print('[STATUS] processed %d of %d sections of %s.html'%(len(used)-hits,len(used),self.name))
+			#---only the current sections are kept so the cache never grows past one copy of the document
+			if set(used)!=previous:
+				if not os.path.isdir(os.path.dirname(cache_fn)): os.makedirs(os.path.dirname(cache_fn))
+				write_manifest(cache_fn,used)
+		return self.html_figure_stream(stream,imagenos,chunks=chunks())
 
 	def header_more(self,line):
 		"""
@@ -769,22 +1291,81 @@ class TexDocument:
 		!LATER EXPAND THIS TO HANDLE BODY TEX FILES!
 		"""
 
-		#---convert images to PDF
+		#---stage images pdflatex can read and convert the rest in scheduled steps which are returned so the 
+		#---...LaTeX passes can wait on them
+		converts,self.staged = [],{}
 		image_spot = self.image_location if self.image_location else ''
 		for label,path in self.images:
-			image_source = os.path.join(os.getcwd(),image_spot,path)
-			if not os.path.isfile(os.path.join(dn,'fig_%s.pdf'%label)):
-				print("[STATUS] converting image to PDF: %s"%label)
-				proc = subprocess.Popen('convert %s fig_%s.pdf'%(image_source,label),shell=True,cwd=dn)
-				output,error = proc.communicate()
-				if proc.returncode!=0: 
-					raise Exception('convert failed. make sure imagemagick is installed')
+			image_source = self.project.path(image_spot,path)
+			self.staged[label],command = stage_figure(label,image_source,dn)
+			if command: converts.append(self.submit('convert-%s'%label,
+				functools.partial(self.convert_figure,label,command,dn)))
 
 		#---copy the bibfile and refer to the local copy
+		if self.bibfile: shutil.copyfile(self.bibfile,os.path.join(dn,os.path.basename(self.bibfile)))
+		self.finish_parts(nocompile,os.path.basename(self.bibfile) if self.bibfile else None)
+
+		#---figure blocks refer to the original images by absolute path so we map these to the staged copies
+		#---...with a single compiled pattern instead of one substitution per figure and line
+		#---an image used by several figures points to the copy for the first one
+		figure_paths = dict([(self.project.path(path),self.staged_path(label)) 
+			for label,path in self.images[::-1]])
+		self.figure_pattern = re.compile('|'.join(re.escape(i) 
+			for i in sorted(figure_paths,key=len,reverse=True))) if figure_paths else None
+		self.figure_paths = figure_paths
+		if self.draft and not nocompile: self.draft_sections(fn,dn)
+
+		#---stream the parts to disk and remove double newlines on the way
+		#---note that the whole-text substitution this replaces passed re.M (8) as the count so only the first 
+		#---...eight runs of newlines are collapsed and we keep that behavior
+		#---we save the position and writer state at the bibliography so embed_bibliography can splice in the
+		#---...bbl file without assembling the document again
+		with open(os.path.join(dn,fn+'.tex'),'w') as fp: self.bbl_splice = self.write_tex(fp)
+		if self.bbl_splice: self.bbl_splice['fn'] = os.path.join(dn,fn+'.tex')
+		return converts
+
+	def draft_sections(self,fn,dn):
+		"""
+		Write each top-level section of the body to its own file and include them from the main tex file.
+		Only the sections which changed since the last draft go in includeonly. LaTeX takes the numbers and
+		labels for the rest from the aux files it wrote for them last time.
+		"""
+		body = self.parts['body']
+		chunks = body.chunks() if isinstance(body,BodyStream) else latex_sections(body)
+		manifest_fn = os.path.join(dn,fn+'.sections.json')
+		previous = read_manifest(manifest_fn)
+		#---a change to the preamble invalidates every section
+		header = hashlib.sha1(''.join(map(str,self.parts['header'])).encode()).hexdigest()
+		if previous.get('header',None)!=header: previous = {}
+		manifest,includes,changed = {'header':header},[],[]
+		for index,lines in enumerate(chunks):
+			name = '%s-section%d'%(fn,index+1)
+			text = ''.join(self.relative_lines(lines))
+			manifest[name] = hashlib.sha1(text.encode()).hexdigest()
+			write_if_changed(os.path.join(dn,name+'.tex'),text)
+			if previous.get(name,None)!=manifest[name] or not os.path.isfile(os.path.join(dn,name+'.aux')):
+				changed.append(name)
+			includes.append('\\include{%s}\n'%name)
+		#---without any changes we only compile if the PDF is missing, and then we need every section
+		if not changed and not os.path.isfile(os.path.join(dn,fn+'.pdf')): 
+			changed = [i for i in manifest if i!='header']
+		self.parts['body'] = includes
+		self.header_more('\\includeonly{%s}\n'%','.join(changed))
+		#---graphicx draws a box with the file name in place of each figure
+		self.header_more('\\setkeys{Gin}{draft}\n')
+		self.draft_changed,self.draft_manifest = changed,(manifest_fn,manifest)
+		print('[STATUS] draft includes %d of %d sections'%(len(changed),len(includes)))
+
+	def finish_parts(self,nocompile,bibliography):
+		"""
+		Add the bibliography (as a path for bibtex or an embedded bbl) or the chapter heading to the parts.
+		"""
+		#---for the standard styles we write the bbl here so LaTeX never waits on bibtex
+		self.bbl_embedded = False
 		if self.bibfile:
-			local_bibfile = os.path.basename(self.bibfile)
-			shutil.copyfile(self.bibfile,os.path.join(dn,local_bibfile))
-			self.parts['bbl'] = "\\bibliography{%s}\n"%local_bibfile
+			self.parts['bbl'] = "\\bibliography{%s}\n"%bibliography
+			bbl = self.bibliography_bbl()
+			if bbl: self.parts['bbl'],self.bbl_embedded = bbl,True
 		else: self.parts['bbl'] = '\n'
 
 		#---required for multiple bibliographies if compiling chapters
@@ -796,90 +1377,250 @@ class TexDocument:
 			self.parts['body'].insert(0,r"\chapter{%s}\label{chap:%s}"%(self.specs.spec('title'),
 				self.name)+'\n')
 
-		#---make a copy of self.parts which we will make path substitutions in
-		specific_parts = odict()
-		#---loop over each part and make the substitutions
+	def write_tex(self,fp):
+		"""
+		Stream the parts to a file and return the state at the bibliography for embed_bibliography.
+		"""
+		splice = None
+		writer = NewlineWriter(fp,minimum=3,replacement='\n',limit=re.M)
 		for key,val in self.parts.items():
-			specific_parts[key] = val
-			for label,path in self.images:
-				specific_parts[key] = [
-					#---! mimic the path-making above and remove it because everything is now relative
-					#---! this is a hackish way to apply self.image_location
-					re.sub(os.path.join(os.getcwd(),path),
-						'{fig_%s}.pdf'%label,str(line)) for line in specific_parts[key]
-					if self.tex_comments or not re.match(r'\s*%',str(line))]
-
-		final_text = ''
-		for key,val in specific_parts.items():
-			if type(val)==str: final_text += val
-			elif type(val)==list: 
-				for line in val: final_text += line
-			else: 
-				import pdb;pdb.set_trace()
-				raise Exception('\n[ERROR] cannot understand this part of the document: %s'%key)
-			final_text += '\n'
+			if key=='bbl': splice = {'offset':fp.tell(),'run':writer.run,'limit':writer.limit,'tail':[]}
+			elif splice: 
+				#---the parts after the bibliography are short so we keep them for the splice
+				val = list(self.relative_lines(val))
+				splice['tail'].extend(val+['\n'])
+			self.write_part(writer,key,val)
+		writer.close()
+		return splice
+
+	def write_part(self,writer,key,val):
+		"""Write one part of the LaTeX document with relative paths."""
+		if type(val) not in [str,list] and not isinstance(val,BodyStream):
+			raise Exception('\n[ERROR] cannot understand this part of the document: %s'%key)
+		for line in self.relative_lines(val): writer.write(line)
+		writer.write('\n')
+
+	def relative_lines(self,lines):
+		"""
+		Point figures to the staged copies and drop comment lines unless the header asks for tex_comments.
+		Lists are returned as lists while streams are processed lazily.
+		"""
+		if type(lines)==str: lines = lines.splitlines(True)
+		rewrite = lambda line:(self.figure_pattern.sub(lambda x:self.figure_paths[x.group(0)],line)
+			if self.figure_pattern else line)
+		processed = (rewrite(str(line)) for line in lines 
+			if self.tex_comments or not re.match(r'\s*%',str(line)))
+		return processed if isinstance(lines,BodyStream) else list(processed)
+
+	def html_path(self,path):
+		"""Point to a file in the project from the HTML, which is written to the output root."""
+		if self.output_root==self.root and not os.path.isabs(path): return path
+		return os.path.relpath(self.project.path(path),self.output_root)
+
+	def staged_path(self,label):
+		"""The name of a staged figure for includegraphics. Braces protect any dots in the name."""
+		return '{%s}%s'%os.path.splitext(self.staged[label])
+
+	def convert_figure(self,label,command,dn):
+		"""Convert one figure which pdflatex cannot read directly."""
+		print("[STATUS] converting image: %s"%label)
+		job = self.run_step('convert-%s'%label,command,cwd=dn)
+		if job.returncode!=0: 
+			raise Exception('image conversion failed. make sure the tool is installed: %s'%command)
+
+	def submit(self,step,func,deps=None,group=None):
+		"""
+		Hand one build step for this document and format to the scheduler and return its name.
+		"""
+		#---stages are recorded without the figure or equation name so their history accumulates
+		stage = re.sub(r'^(convert|equation)-.+$',r'\1',step)
+		return self.scheduler.submit('%s-%s:%s'%(self.name,self.style,step),func,deps=deps,group=group,
+			priority=self.priority,tags={'document':self.name,'format':self.style,'stage':stage})
 
-		#---remove double newlines
-		final_text = re.sub('[\n]{3,}','\n',final_text,re.M)
+	def run_step(self,step,command,cwd=None,check=False,env=None):
+		"""
+		Run one external build step while streaming its output and logging it to the hold directory.
+		"""
+		return run(command,cwd=cwd if cwd else self.package_dir,check=check,env=env,
+			name='%s-%s'%(self.name,self.style),
+			log=os.path.join(self.hold_dir,'%s-%s-%s.log'%(self.name,self.style,step)))
 
-		with open(os.path.join(dn,fn+'.tex'),'w') as fp: fp.write(final_text)
+	def latex_env(self):
+		"""The environment for LaTeX with a fixed timestamp for the dates and the PDF metadata."""
+		env = dict(os.environ)
+		env.update(SOURCE_DATE_EPOCH=str(self.source_date_epoch),FORCE_SOURCE_DATE='1')
+		return env
 
-	def render(self):
+	def latex_pass(self,step,command,final=False):
+		"""
+		Run one LaTeX pass. After a final pass which makes the PDF we record the inputs for pdf_current.
+		"""
+		job = self.run_step(step,command,env=self.latex_env())
+		if final and job.returncode==0 and os.path.isfile(os.path.join(self.package_dir,self.name+'.pdf')):
+			manifest_fn,manifest = self.pdf_manifest
+			#---the tex may differ from the one in the signature once the bbl is embedded
+			write_manifest(manifest_fn,dict(manifest,
+				compiled=checksum(os.path.join(self.package_dir,self.name+'.tex'))))
+		return job
+
+	def restore_compiled(self):
+		"""
+		Bring the tex file we just wrote back to the one the last build compiled before we skip LaTeX. On the bibtex
+		path that means embedding the bbl from that build again. Returns False if the tex still differs, in
+		which case we compile it again.
+		"""
+		tex_fn = os.path.join(self.package_dir,self.name+'.tex')
+		compiled = read_manifest(self.pdf_manifest[0]).get('compiled',None)
+		if not compiled: return False
+		if self.bibfile and not self.bbl_embedded and self.embed_bbl:
+			if not os.path.isfile(os.path.join(self.package_dir,self.name+'.bbl')): return False
+			#---keep the tex with the bibliography command in case bibtex has to run after all
+			shutil.copyfile(tex_fn,tex_fn+'.written')
+			self.embed_bibliography()
+			if checksum(tex_fn)!=compiled:
+				os.rename(tex_fn+'.written',tex_fn)
+				return False
+			os.remove(tex_fn+'.written')
+		return compiled==checksum(tex_fn)
+
+	def pdf_current(self):
+		"""
+		Check whether the last successful build compiled the same tex file, staged figures, bibliography, class
+		and style files with the same command. Saves the manifest for latex_pass either way.
+		The timestamp is not part of the signature, otherwise every edit to the markdown would rebuild the PDF.
+		"""
+		dn = self.package_dir
+		manifest_fn = os.path.join(dn,self.name+'.build.json')
+		previous = read_manifest(manifest_fn)
+		fns = [self.name+'.tex']+list(self.staged.values())+self.package_inputs
+		if self.bibfile: fns.append(os.path.basename(self.bibfile))
+		fns += [os.path.basename(i) for ext in ['cls','sty','bst','clo','def','cfg']
+			for i in glob.glob(os.path.join(dn,'*.'+ext))]
+		fns = sorted(set(fns))
+		#---files with the same size and modification time as last time keep their hashes
+		#---...and the manifest uses names relative to the package so the folder can move
+		known = dict((os.path.join(dn,i),j) for i,j in previous.get('files',{}).items())
+		sums = source_checksums([os.path.join(dn,i) for i in fns],known)
+		files = dict((os.path.basename(i),known[i]) for i in sums)
+		signature = hashlib.sha1(json.dumps({'command':self.latex_binary,
+			'files':dict((i,j['sum']) for i,j in files.items())},sort_keys=True).encode()).hexdigest()
+		self.pdf_manifest = (manifest_fn,{'signature':signature,'files':files})
+		return previous.get('signature',None)==signature and os.path.isfile(os.path.join(dn,self.name+'.pdf'))
+
+	def bibliography_bbl(self):
+		"""
+		Write the bbl in python if the header uses a standard bibliography style, otherwise return None.
+		Set "bibtex: true" in the markdown header to always use bibtex.
+		"""
+		if self.specs.bool('bibtex'): return None
+		styles = [re.match(r'^\s*\\bibliographystyle\{([^\}]+)\}',str(i)) for i in self.parts['header']]
+		styles = [i.group(1) for i in styles if i]
+		if len(styles)!=1: return None
+		#---the citations come from the processed body except in the chunked mode where we have not seen it yet
+		if self.chunked: 
+			keys = [i for text in self.body_sections() 
+				for i in re.findall(r'\[?@(%s)(?:\s|\])?'%self.bibkey,text)]
+		else: keys = self.refs
+		keys = [i for ii,i in enumerate(keys) if i not in keys[:ii]]
+		return write_bbl(self.bibfile,keys,styles[0],cache_dn=os.path.join(self.hold_dir,'bbl'))
+
+	def embed_bibliography(self):
+		"""Replace the bibliography command with the bbl file written by bibtex and rewrite the tex file."""
+		#---drafts leave their own bbl in the same folder so we take the one for the full document
+		bbl_filename = os.path.join(self.package_dir,self.name+'.bbl')
+		with open(bbl_filename) as fp: self.parts['bbl'] = fp.readlines()
+		splice = self.bbl_splice
+		if not splice: raise Exception('cannot find the bibliography in %s.tex'%self.name)
+		#---keep everything before the bibliography and replay the writer from the same state
+		tmp_fn = splice['fn']+'.tmp'
+		with open(splice['fn'],'rb') as fp_old, open(tmp_fn,'wb') as fp:
+			remaining = splice['offset']
+			while remaining:
+				block = fp_old.read(min(remaining,2**20))
+				if not block: raise Exception('%s changed while embedding the bibliography'%splice['fn'])
+				fp.write(block)
+				remaining -= len(block)
+		with open(tmp_fn,'a') as fp:
+			writer = NewlineWriter(fp,minimum=3,replacement='\n',limit=splice['limit'])
+			writer.run = splice['run']
+			self.write_part(writer,'bbl',self.parts['bbl'])
+			for line in splice['tail']: writer.write(line)
+			writer.close()
+		os.rename(tmp_fn,splice['fn'])
+
+	def write_rerender(self,latex_command):
+		"""Write a short script to recompile everything."""
+		with open(os.path.join(self.package_dir,'rerender.sh'),'w') as fp:
+			fp.write('#!/bin/bash\n')
+			fp.write('export SOURCE_DATE_EPOCH=%d FORCE_SOURCE_DATE=1\n'%self.source_date_epoch)
+			for extension in ['.blg','.aux','.bbl','.out','Notes.bib','.log']:
+				fp.write('rm -f %s%s\n'%(self.name,extension))
+			for line in [
+				latex_command+' %s.tex\n'%self.name,
+				'bibtex %s\n'%self.name if not self.bbl_embedded else None,
+				latex_command+' %s.tex\n'%self.name,
+				latex_command+' %s.tex\n'%self.name if not self.bbl_embedded else None]:
+				if line: fp.write(line)
+
+	def render(self,deps=None):
 		"""
 		Render the LaTeX document to pdf.
 		This creates a self-contained copy of the document suitable for submission or sharing with anybody
-		who has a working TeX environment.
+		who has a working TeX environment. The steps are submitted to the scheduler in order and each one
+		waits on the previous, so a failure stops the rest of this document but not other documents.
 		"""
 		#---before rendering we execute any bash scripts
-		if self.specs.spec('bashrun'): os.system(self.specs.spec('bashrun'))
+		if self.specs.spec('bashrun'): 
+			deps = (deps or [])+[self.submit('bashrun',functools.partial(
+				self.run_step,'bashrun',self.specs.spec('bashrun'),cwd=self.root),deps=deps)]
 		#---we only render self-contained tex packages to the to printed directories now
 		#---new method is entirely local so we overwrite the bbl
 		#---! shell-escape only required for minted (for syntax highlighting)
 		latex_command = '%s -shell-escape'%self.latex_binary
-		directory = self.package_dir
-		try:
-			proc = subprocess.Popen(latex_command+' %s.tex'%self.name,shell=True,cwd=directory)
-			proc.communicate()
-			#---! need to use subprocess on os.system below and also log the results
-			if self.bibfile:
-				subprocess.check_call('bibtex %s'%self.name,cwd=directory,shell=True)
-				if self.embed_bbl:
-					#---intervene here to add the bbl file 
-					bbl_filename, = glob.glob(self.package_dir+'/*.bbl')
-					with open(bbl_filename) as fp: self.parts['bbl'] = fp.readlines()
-					#---rewrite the tex file here
-					self.write_relative(fn=self.name,dn=self.package_dir)
-			#---note that we have to run two more times per latex convetion
-			#---even if we lack a bib we still need to run twice more to render the comments
-			proc = subprocess.Popen(latex_command+' %s.tex'%self.name,shell=True,cwd=directory)
-			proc.communicate()
-			proc = subprocess.Popen(latex_command+' %s.tex'%self.name,shell=True,cwd=directory)
-			proc.communicate()
-			#---write a short script to recompile everything
-			with open(os.path.join(directory,'rerender.sh'),'w') as fp:
-				fp.write('#!/bin/bash\n')
-				for extension in ['.blg','.aux','.bbl','.out','Notes.bib','.log']:
-					fp.write('rm -f %s%s\n'%(self.name,extension))
-				for line in [
-					latex_command+' %s.tex\n'%self.name,
-					'bibtex %s\n'%self.name,
-					latex_command+' %s.tex\n'%self.name,
-					latex_command+' %s.tex\n'%self.name]:
-					fp.write(line)
-			#---after packing we zip everything
-			#---! disabled for now
-			if self.specs.spec('compress',False):
-				print("[STATUS] zipping")
-				proc = subprocess.Popen('zip -r %s.zip %s'%(directory,directory),cwd=os.getcwd(),shell=True)
-				proc.communicate()
-		except KeyboardInterrupt:
-			proc.terminate()
-			print("[STATUS] received exit signal")
-			print("[STATUS] cleaning files")
-			for fn in glob.glob('cas/hold/%s*'%self.name): os.remove(fn)
-			print("[STATUS] cancelled")
-			sys.exit(1)
-		except Exception as e: raise Exception(e)
+		if self.draft: return self.render_draft(latex_command,deps=deps)
+		latex = lambda step,final=False:functools.partial(self.latex_pass,step,
+			latex_command+' %s.tex'%self.name,final=final)
+		last = self.submit('latex-1',latex('latex-1'),deps=deps)
+		if self.bibfile and not self.bbl_embedded:
+			last = self.submit('bibtex',functools.partial(
+				self.run_step,'bibtex','bibtex %s'%self.name,check=True),deps=[last])
+			#---intervene here to add the bbl file 
+			if self.embed_bbl: last = self.submit('embed-bbl',self.embed_bibliography,deps=[last])
+		#---note that we have to run two more times per latex convetion
+		#---even if we lack a bib we still need to run twice more to render the comments
+		#---...unless the bbl was already in place for the first pass in which case one more is enough
+		last = self.submit('latex-2',latex('latex-2',final=self.bbl_embedded),deps=[last])
+		if not self.bbl_embedded: last = self.submit('latex-3',latex('latex-3',final=True),deps=[last])
+		self.write_rerender(latex_command)
+		#---after packing we zip everything
+		#---! disabled for now
+		if self.specs.spec('compress',False):
+			directory = os.path.relpath(self.package_dir,self.output_root)
+			last = self.submit('zip',functools.partial(self.run_step,'zip',
+				'zip -r %s.zip %s'%(directory,directory),cwd=self.output_root),deps=[last])
+		return last
+
+	def render_draft(self,latex_command,deps=None):
+		"""
+		Compile a draft in a single LaTeX pass. The bibliography is either embedded or taken from the bbl
+		file left by the last full build.
+		"""
+		if not self.draft_changed:
+			print('[STATUS] the draft of %s in %s format is up to date'%(self.name,self.style))
+			return None
+		return self.submit('latex-draft',functools.partial(self.compile_draft,
+			latex_command+' %s-draft.tex'%self.name),deps=deps)
+
+	def compile_draft(self,command):
+		"""Run LaTeX once and record the sections in the draft only if it succeeds."""
+		bbl_fn = os.path.join(self.package_dir,self.name+'.bbl')
+		if not self.bbl_embedded and os.path.isfile(bbl_fn): 
+			shutil.copyfile(bbl_fn,os.path.join(self.package_dir,self.name+'-draft.bbl'))
+		job = self.run_step('latex-draft',command,env=self.latex_env())
+		if job.returncode!=0: 
+			print('[WARNING] LaTeX failed on the draft of %s so we will compile these sections again: %s'%(
+				self.name,', '.join(self.draft_changed)))
+		else: write_manifest(*self.draft_manifest)
 
 	def parse_figure(self,caption):
 		"""
@@ -904,7 +1645,7 @@ class TexDocument:
 		Convert a figure block into a LaTeX figure.
 		"""
 		#---unpack the items from regex_figure (first group has the label, second has the path)
-		path = os.path.abspath(extracts[1])
+		path = self.project.path(extracts[1])
 		#---the third group is the caption from which we pop any lines solely inside braces
 		caption = extracts[2].strip('\n')
 		caption,mods = self.parse_figure(caption)
@@ -948,10 +1689,17 @@ class TexDocument:
 			elif key in ['nlines','position','wrapw']: pass
 			else: raise Exception('[ERROR] not sure how to handle figure mod: %s=%s'%(str(key),str(val)))
 		label = extracts[0] if extracts[0] else False
+		image = {'src':self.html_path(path)}
+		if self.web_images:
+			try: image = web_image(self.project.path(path),fraction=mods.get('width',1.0),
+				cache_dn=os.path.join(self.hold_dir,'web'),relative_to=self.output_root)
+			except Exception as e: print('[WARNING] using the original image for the HTML: %s'%e)
 		figure_text_html = '\n'.join([
 			'<figure %sclass="figure">'%('id="fig:%s" '%label if label else ''),
 			'<a %s></a>'%('name="fig:%s"'%label if label else ''),
-			'<img src="%s" style="%s" align="middle">'%(path,style),
+			'<img %s style="%s" align="middle" loading="lazy" decoding="async">'%(' '.join(
+				'%s="%s"'%(key,image[key]) for key in ['src','srcset','sizes','width','height'] if key in image),
+				style),
 			"<figcaption><strong>%s</strong>\n%s"%("@fig:%s"%label if label else "Figure",caption),
 			'</figcaption></figure>\n\n',
 			])
@@ -972,33 +1720,47 @@ class TexDocument:
 		"""
 		Replace markdown citations with LaTeX citations.
 		"""
-		#---use re.split and re.findall to iteratively replace references in groups
-		for lineno,line in enumerate(self.parts[part]):
-			#---! hacking the bibkey some more. see self.bibkey defn
-			if re.search(r'(\[?@[a-zA-Z]+-?[0-9]{4}[a-z]?\s?;?\s?)+\]?',line)!=None:
-				refs = re.findall(r'\[?@(%s)(?:\s\|\Z|\])?'%self.bibkey,line)
-				notrefs = re.split('@%s'%self.bibkey,line)
-				self.refs.extend(refs)
-				#---! cannot start a line with a reference
-				newline = list([notrefs[0].rstrip('[')])
-				inside_reference = False
-				for ii,i in enumerate(notrefs[1:]):
-					if inside_reference == False: 
-						newline.append(r'\%s{'%self.citation_type)
-						inside_reference = True
-					newline.append(refs[ii])
-					#---terminate the reference at the end of the line automatically
-					#---...this was added because references as the end of a line were not terminating
-					#if re.match('^\s*$',i): 
-					#	newline.append('}'+i.lstrip(']'))
-					#	inside_reference = False
-					#---! is this terminating the references? 
-					if re.match('^[ \t]*;?[ \t]$',i): 
-						#import pdb;pdb.set_trace()
-						newline.append(',')
-					#---otherwise terminate
-					elif inside_reference: 
-						newline.append('}'+i.lstrip(']'))
+		if isinstance(self.parts[part],BodyStream): self.parts[part].transforms.append(self.bib_lines)
+		else: self.parts[part] = self.bib_lines(self.parts[part])
+
+	def bib_lines(self,lines):
+		"""Replace citations in a list of lines."""
+		prof = self.profiler
+		search,findall,split = ((prof.wrap('bib',re.search),prof.wrap('bib',re.findall,count=len),
+			prof.wrap('bib',re.split,count=lambda x:len(x)-1)) if prof else (re.search,re.findall,re.split))
+		#---unbalanced citations run under the same time limit as the other rules
+		line = ''
+		try:
+			with time_limit(self.regex_time_limit):
+				#---use re.split and re.findall to iteratively replace references in groups
+				for lineno,line in enumerate(lines):
+					#---! hacking the bibkey some more. see self.bibkey defn
+					if search(self.regex_citation,line)!=None:
+						refs = findall(r'\[?@(%s)(?:\s\|\Z|\])?'%self.bibkey,line)
+						notrefs = split('@%s'%self.bibkey,line)
+						self.refs.extend(refs)
+						#---! cannot start a line with a reference
+						newline = list([notrefs[0].rstrip('[')])
 						inside_reference = False
-					else: newline.append(i.rstrip('['))
-				self.parts[part][lineno] = ''.join(newline)	
+						for ii,i in enumerate(notrefs[1:]):
+							if inside_reference == False: 
+								newline.append(r'\%s{'%self.citation_type)
+								inside_reference = True
+							newline.append(refs[ii])
+							#---terminate the reference at the end of the line automatically
+							#---...this was added because references as the end of a line were not terminating
+							#if re.match('^\s*$',i): 
+							#	newline.append('}'+i.lstrip(']'))
+							#	inside_reference = False
+							#---! is this terminating the references? 
+							if re.match('^[ \t]*;?[ \t]$',i): 
+								#import pdb;pdb.set_trace()
+								newline.append(',')
+							#---otherwise terminate
+							elif inside_reference: 
+								newline.append('}'+i.lstrip(']'))
+								inside_reference = False
+							else: newline.append(i.rstrip('['))
+						lines[lineno] = ''.join(newline)	
+		except RegexTimeout: self.regex_timeout('the citations',line)
+		return lines
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+"""
+Preview documents in a browser while editing them.
+
+A small HTTP server renders ``<name>.html`` from ``<name>.md`` on request with the staged API in TexDocument, so
+nothing is written to the printed folders and the parser stays warm between requests. Each page is cached until
+one of its inputs (the markdown, the HTML template, dispatch.yaml, the bibliography or a figure) changes, and
+then only the sections which changed are processed again. Pages hold an event stream open and reload themselves
+when that happens. Other files are only served from an allowlist (the shared sources with main.css, the web
+copies of figures in the hold directory and the folders of the figures in the documents) so a server on the
+network does not publish the repository, the silo or config.py.
+"""
+
+import os,re,glob,html,time,threading,traceback
+from http.server import ThreadingHTTPServer,SimpleHTTPRequestHandler
+from urllib.parse import urlparse,parse_qs
+from parselib import TexDocument
+from project import Project
+
+#---seconds between checks for changed inputs and between keepalive messages on the event stream
+poll_interval = 0.5
+keepalive_interval = 15.0
+#---files we never serve even inside an allowed folder
+private_names = ['history','config.py']
+#---pages open an event stream and reload when the server says the document changed
+reload_script = ('<script>(function(){var s=new EventSource("/__events?doc=%s");'
+	's.onmessage=function(){s.close();location.reload();};})();</script>\n')
+
+class Previewer:
+
+	"""
+	Render documents on request and remember each one until its inputs change.
+	"""
+
+	def __init__(self,root='./'):
+		self.root = os.path.abspath(root)
+		#---we keep a private project so an edit to dispatch.yaml can replace it
+		self.project = Project(root=self.root)
+		self.project_signature = self.signature([self.project.dispatch_fn])
+		self.cache,self.locks,self.lock = {},{},threading.Lock()
+
+	def documents(self):
+		"""Names of the markdown documents in the project."""
+		return sorted(os.path.basename(i)[:-3] for i in glob.glob(self.project.path('*.md'))
+			if os.path.basename(i)!='README.md')
+
+	def signature(self,fns):
+		"""Modification times for a list of files, with None for files which are missing."""
+		return tuple((fn,os.path.getmtime(fn) if os.path.isfile(fn) else None) for fn in fns)
+
+	def inputs(self,doc):
+		"""List the files which determine the HTML for a document."""
+		fns = [self.project.path(doc.name+'.md'),self.project.sources(doc.html_template),
+			self.project.dispatch_fn]
+		if doc.bibfile: fns.append(doc.bibfile)
+		fns.extend(self.project.path(doc.image_location or '',path) for label,path in doc.images)
+		return fns
+
+	def changed(self,name):
+		"""Check whether any input of a cached document changed since we rendered it."""
+		cached = self.cache.get(name,None)
+		return not cached or self.signature([i for i,j in cached['signature']])!=cached['signature']
+
+	def render(self,name):
+		"""Get the HTML for a document from the cache or render it again."""
+		with self.lock: lock = self.locks.setdefault(name,threading.Lock())
+		with lock:
+			if not self.changed(name): return self.cache[name]['html']
+			#---a new dispatch.yaml changes the aliases for every document
+			if self.signature([self.project.dispatch_fn])!=self.project_signature:
+				self.project = Project(root=self.root)
+				self.project_signature = self.signature([self.project.dispatch_fn])
+			fn = self.project.path(name+'.md')
+			start = time.time()
+			figures = []
+			try:
+				doc = TexDocument(fn,build=False,project=self.project,section_cache=True)
+				text,inputs = doc.to_html(),self.inputs(doc)
+				figures = [self.project.path(doc.image_location or '',path) for label,path in doc.images]
+				print('[SERVE] rendered %s.html in %.2fs'%(name,time.time()-start))
+			#---errors are shown in the page which reloads once the source changes
+			except Exception as e:
+				print('[ERROR] cannot render %s.md: %s'%(name,e))
+				text = '<html><body><h3>cannot render %s.md</h3><pre>%s</pre></body></html>\n'%(
+					html.escape(name),html.escape(traceback.format_exc()))
+				inputs = [fn,self.project.dispatch_fn]
+			#---the reload script goes at the end of the body or the end of the page
+			cut = text.rfind('</body>')
+			text = text[:cut]+reload_script%name+text[cut:] if cut>=0 else text+reload_script%name
+			self.cache[name] = {'html':text,'signature':self.signature(inputs),'figures':figures}
+			return text
+
+	def allowed(self,path):
+		"""
+		Check whether we may serve a file. Figures in the project root are allowed one by one so the root itself
+		is never on the allowlist.
+		"""
+		root = os.path.realpath(self.root)
+		path = os.path.realpath(path)
+		parts = os.path.relpath(path,root).split(os.sep)
+		if parts[0]=='..' or any(i.startswith('.') or i in private_names for i in parts): return False
+		figures = [os.path.realpath(i) for name in list(self.cache) for i in self.cache[name]['figures']]
+		folders = [self.project.sources(),self.project.hold('web')]+[os.path.dirname(i) for i in figures]
+		folders = [os.path.realpath(i) for i in folders]
+		return path in figures or any(path.startswith(os.path.join(i,'')) for i in folders if i!=root)
+
+	def index(self):
+		"""List the documents with links to their previews."""
+		return ('<html><head><title>%s</title><link rel="stylesheet" href="/cas/sources/main.css" '
+			'type="text/css"/></head><body><div id="wrapper"><div id="main_content"><h1>%s</h1><ul>\n%s\n'
+			'</ul></div></div></body></html>\n')%(os.path.basename(self.root),os.path.basename(self.root),
+			'\n'.join('<li><a href="/%s.html">%s</a></li>'%(i,i) for i in self.documents()))
+
+def preview_handler(previewer):
+	"""Make a request handler which serves previews and the allowed files in the project."""
+
+	class PreviewHandler(SimpleHTTPRequestHandler):
+
+		def __init__(self,*args,**kwargs):
+			super().__init__(*args,directory=previewer.root,**kwargs)
+
+		def log_message(self,format,*args): print('[SERVE] %s %s'%(self.address_string(),format%args))
+
+		def send_text(self,text,content_type='text/html; charset=utf-8'):
+			body = text.encode()
+			self.send_response(200)
+			self.send_header('Content-Type',content_type)
+			self.send_header('Content-Length',str(len(body)))
+			self.send_header('Cache-Control','no-store')
+			self.end_headers()
+			self.wfile.write(body)
+
+		def events(self,name):
+			"""Hold an event stream open and send one message when the document changes."""
+			self.send_response(200)
+			self.send_header('Content-Type','text/event-stream')
+			self.send_header('Cache-Control','no-store')
+			self.end_headers()
+			last = time.time()
+			try:
+				while True:
+					time.sleep(poll_interval)
+					if previewer.changed(name):
+						self.wfile.write(b'data: reload\n\n')
+						self.wfile.flush()
+						return
+					#---comments keep proxies from closing the stream and tell us when the page is gone
+					if time.time()-last>keepalive_interval:
+						self.wfile.write(b': keepalive\n\n')
+						self.wfile.flush()
+						last = time.time()
+			except (BrokenPipeError,ConnectionResetError): return
+
+		def do_GET(self):
+			url = urlparse(self.path)
+			match = re.match(r'^/([^/]+)\.html$',url.path)
+			if url.path=='/': self.send_text(previewer.index())
+			elif url.path=='/__events':
+				name = parse_qs(url.query).get('doc',[''])[0]
+				if name not in previewer.documents(): self.send_error(404,'unknown document')
+				else: self.events(name)
+			elif match and match.group(1) in previewer.documents():
+				self.send_text(previewer.render(match.group(1)))
+			elif previewer.allowed(self.translate_path(self.path)) and not url.path.endswith('/'): super().do_GET()
+			else: self.send_error(404,'not found')
+
+		def do_HEAD(self):
+			if previewer.allowed(self.translate_path(self.path)) and not urlparse(self.path).path.endswith('/'):
+				super().do_HEAD()
+			else: self.send_error(404,'not found')
+
+	return PreviewHandler
+
+def serve_previews(root='./',host='127.0.0.1',port=8000):
+	"""Serve previews until interrupted."""
+	previewer = Previewer(root=root)
+	server = ThreadingHTTPServer((host,port),preview_handler(previewer))
+	server.daemon_threads = True
+	print('[SERVE] previewing %d documents from %s at http://%s:%d/'%(
+		len(previewer.documents()),previewer.root,host,port))
+	try: server.serve_forever()
+	except KeyboardInterrupt: print('[SERVE] stopping')
+	finally: server.server_close()
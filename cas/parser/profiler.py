@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+"""
+Count and time each rule in the substitution pipeline.
+
+When a document is built with profiling on, the rule sets (rules, subs, subs_multi, special_subs), the
+citations and the HTML figure links call their regular expressions through a RuleProfiler. It records the calls,
+matches and time for every pattern in every group. The aliases share one pattern so the time is reported for all
+of them together, with the number of matches for each alias in separate rows. Sections served from the section
+cache never reach the rules and are not counted.
+"""
+
+import os,re,time,json
+
+class RuleProfiler:
+
+	"""
+	Calls, matches and seconds for each rule in one document.
+	"""
+
+	def __init__(self,name):
+		self.name = name
+		#---keys are (group,rule) and values are [calls,matches,seconds]
+		self.stats = {}
+
+	def record(self,group,rule,seconds,matches=0,calls=1):
+		"""Add one use of a rule. Compiled patterns are recorded by their source."""
+		stat = self.stats.setdefault((group,getattr(rule,'pattern',rule)),[0,0,0.0])
+		stat[0] += calls
+		stat[1] += int(matches)
+		stat[2] += seconds
+
+	def wrap(self,group,func,count=bool,label=None):
+		"""
+		Wrap a function from re which takes the pattern first so every call is recorded in a group.
+		Use count to turn the result into a number of matches and label to name patterns built on the fly.
+		"""
+		def wrapped(rule,*args,**kwargs):
+			start = time.perf_counter()
+			result = func(rule,*args,**kwargs)
+			self.record(group,label or rule,time.perf_counter()-start,count(result))
+			return result
+		return wrapped
+
+	def sub(self,group,label=None):
+		"""A replacement for re.sub which records the number of substitutions."""
+		subn = self.wrap(group,re.subn,count=lambda x:x[1],label=label)
+		return lambda rule,convert,text,**kwargs:subn(rule,convert,text,**kwargs)[0]
+
+	def timed(self,group,rule,func,*args):
+		"""Time a function which returns its result and the number of matches."""
+		start = time.perf_counter()
+		result,matches = func(*args)
+		self.record(group,rule,time.perf_counter()-start,matches)
+		return result
+
+	def rows(self):
+		"""The statistics as dictionaries with the slowest rules first."""
+		return [{'document':self.name,'group':group,'rule':rule,'calls':calls,'matches':matches,
+			'seconds':seconds} for (group,rule),(calls,matches,seconds) in
+			sorted(self.stats.items(),key=lambda x:(-x[1][2],-x[1][1]))]
+
+	def table(self,limit=20):
+		"""Format the slowest rules as a table."""
+		rows = self.rows()
+		total = sum(i['seconds'] for i in rows)
+		lines = ['[PROFILE] %d rules took %.3fs in %s'%(len(rows),total,self.name),
+			'%10s %10s %10s %6s  %-16s %s'%('seconds','calls','matches','share','group','rule')]
+		for row in rows[:limit]:
+			rule = row['rule'] if len(row['rule'])<=60 else row['rule'][:57]+'...'
+			lines.append('%10.4f %10d %10d %5.1f%%  %-16s %s'%(row['seconds'],row['calls'],row['matches'],
+				100.*row['seconds']/total if total else 0.,row['group'],rule.replace('\n','\\n')))
+		if len(rows)>limit: lines.append('%d faster rules are not shown'%(len(rows)-limit))
+		return '\n'.join(lines)
+
+	def write(self,fn):
+		"""Write every row to a JSON file."""
+		if not os.path.isdir(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+		with open(fn,'w') as fp: json.dump(self.rows(),fp,indent=1)
+		return fn
+
+def replace_each(rule,convert,text):
+	"""
+	Replace matches with a function of the groups in one pass over the text. A replacement may create a new match
+	so we search each replacement again (but not the text around it) and join the pieces once at the end.
+	Returns the text and the number of replacements.
+	"""
+	parts,count,position = [],0,0
+	for caught in rule.finditer(text):
+		replacement,more = replace_each(rule,convert,convert(caught.groups()))
+		parts.extend([text[position:caught.start()],replacement])
+		count += 1+more
+		position = caught.end()
+	parts.append(text[position:])
+	return ''.join(parts),count
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+"""
+Settings for the whole project: dispatch.yaml and where everything lives.
+
+We read each file once per run with the fastest safe YAML loader available and check its structure, then hand
+the same Project to every document and command. A remake over many documents reads dispatch.yaml only once.
+The project also resolves every path against an explicit root (the sources, the silo and the hold directory)
+and an output root (the HTML and printed folders) so documents never depend on the working directory.
+"""
+
+import os,yaml
+from yaml.constructor import ConstructorError
+
+#---the C loader is much faster for long alias lists but we never allow arbitrary python objects
+try: from yaml import CSafeLoader as BaseLoader
+except ImportError: from yaml import SafeLoader as BaseLoader
+
+class Loader(BaseLoader):
+	"""A safe loader which also rejects duplicate keys."""
+	pass
+
+def no_duplicates_constructor(loader,node,deep=False):
+	"""Check for duplicate keys."""
+	keys = set()
+	for key_node,value_node in node.value:
+		key = loader.construct_object(key_node,deep=deep)
+		if key in keys:
+			raise ConstructorError('while constructing a mapping',node.start_mark,
+				'found duplicate key "%s"'%key,key_node.start_mark)
+		keys.add(key)
+	return loader.construct_mapping(node,deep)
+
+Loader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,no_duplicates_constructor)
+
+def load_yaml(text):
+	"""Parse YAML text safely."""
+	return yaml.load(text,Loader=Loader)
+
+#---the types of entries in dispatch.yaml which the cassette reads (others are left for the project)
+dispatch_types = ['pull','sync-pull','image-link','combos']
+
+def validate_dispatch(dis,fn='dispatch.yaml'):
+	"""Check the structure of dispatch.yaml so mistakes surface before any work starts."""
+	if dis is None: return {}
+	if type(dis)!=dict: raise Exception('%s must be a dictionary at the top level'%fn)
+	aliases = dis.get('alias',{})
+	if type(aliases)!=dict: raise Exception('"alias" in %s must be a dictionary'%fn)
+	bad = [key for key,val in aliases.items() if type(val) in [dict,list]]
+	if bad: raise Exception('aliases in %s must map text to text: %s'%(fn,', '.join(map(str,bad))))
+	if 'order' in dis and type(dis['order'])!=list: raise Exception('"order" in %s must be a list'%fn)
+	if 'dissertation' in dis and type(dis['dissertation'])!=dict:
+		raise Exception('"dissertation" in %s must be a dictionary'%fn)
+	for key,val in dis.items():
+		if type(val)==dict and 'type' in val and val['type'] not in dispatch_types:
+			print('[WARNING] entry "%s" in %s has type "%s" which the cassette does not use. we only read: %s'%(
+				key,fn,val['type'],', '.join(dispatch_types)))
+	return dis
+
+class Project:
+
+	"""
+	The settings for a project which are read on first use and then kept for the rest of the run.
+	Outputs go to the root unless we receive a separate output root.
+	"""
+
+	def __init__(self,root='./',output_root=None,dispatch_fn='dispatch.yaml'):
+		self.root = os.path.abspath(root)
+		self.output_root = os.path.abspath(output_root) if output_root else self.root
+		self.dispatch_fn = os.path.join(self.root,dispatch_fn)
+		self._dispatch = None
+
+	def path(self,*parts):
+		"""A path in the project. Absolute parts are kept as they are."""
+		return os.path.normpath(os.path.join(self.root,*parts))
+
+	def output(self,*parts):
+		"""A path in the output root."""
+		return os.path.normpath(os.path.join(self.output_root,*parts))
+
+	def sources(self,*parts): return self.path('cas','sources',*parts)
+	def hold(self,*parts): return self.path('cas','hold',*parts)
+
+	@property
+	def has_dispatch(self): return os.path.isfile(self.dispatch_fn)
+
+	@property
+	def dispatch(self):
+		"""The contents of dispatch.yaml or an empty dictionary if it is absent."""
+		if self._dispatch is None:
+			if not self.has_dispatch: self._dispatch = {}
+			else:
+				with open(self.dispatch_fn) as fp: text = fp.read()
+				try: self._dispatch = validate_dispatch(load_yaml(text),fn=self.dispatch_fn)
+				except yaml.YAMLError as e: raise Exception('cannot parse %s: %s'%(self.dispatch_fn,e))
+		return self._dispatch
+
+	@property
+	def aliases(self): return self.dispatch.get('alias',{})
+
+#---one project per root and output directory for each run
+projects = {}
+
+def get_project(root='./',output_root=None):
+	"""Get the shared project for a root directory."""
+	key = (os.path.abspath(root),os.path.abspath(output_root) if output_root else None)
+	if key not in projects: projects[key] = Project(root=key[0],output_root=key[1])
+	return projects[key]
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+"""
+Prepare the HTML for static hosting.
+
+Published pages are minified and carry the rules from the stylesheets which apply to them in a style element, so
+the first paint does not wait for another request. The full stylesheet still loads afterwards without blocking
+for the elements MathJax adds later. Every page, along with the local stylesheets and SVG images it uses, gets
+gzip and brotli copies beside it (name.html.gz, name.html.br) which static hosts can serve directly. The copies
+are only written again when the contents of their source change. Files from the cassette sources (main.css) are
+copied to an assets folder beside the page first so nothing is written into the source tree, and a page written
+without publishing loses its compressed copies so hosts never serve an old page.
+"""
+
+import os,re,gzip,shutil
+from cache import read_manifest,write_manifest,write_if_changed,copy_if_changed,source_checksums
+from runner import run
+
+#---prefer the brotli module and otherwise use the command-line tool
+try: import brotli
+except ImportError: brotli = None
+
+#---the contents of these elements are kept exactly
+verbatim_tags = ['pre','textarea','script','style']
+#---assets which get compressed copies
+compress_extensions = ['html','css','svg']
+#---the folder beside the pages for the copies of shared assets
+assets_folder = 'assets'
+
+###---MINIFY
+
+def minify_html(text):
+	"""
+	Remove comments and collapse whitespace outside of the verbatim elements. A run of whitespace becomes one
+	newline (or one space if it has no newline) so text and inline markup render as before. Conditional
+	comments for old browsers stay.
+	"""
+	def squeeze(part):
+		part = re.sub(r'<!--\[if[^\]]*\]>(?:<!-->)?|<!--<!\[endif\]-->|<!--.*?-->',
+			lambda x:x.group(0) if x.group(0).startswith(('<!--[if','<!--<![')) else '',part,flags=re.S)
+		#---note that \s would also match non-breaking spaces
+		part = re.sub(r'[ \t\r]*\n[ \t\r\n]*','\n',part)
+		return re.sub(r'[ \t\r]{2,}',' ',part)
+	pattern = re.compile(r'<(%s)\b.*?</\1\s*>'%'|'.join(verbatim_tags),re.S+re.I)
+	parts,position = [],0
+	for match in pattern.finditer(text):
+		parts.extend([squeeze(text[position:match.start()]),match.group(0)])
+		position = match.end()
+	parts.append(squeeze(text[position:]))
+	return ''.join(parts).strip()+'\n'
+
+def minify_css(css):
+	"""Remove comments and unnecessary whitespace from a stylesheet without touching quoted strings."""
+	css = re.sub(r'/\*.*?\*/','',css,flags=re.S)
+	parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')',css)
+	for index in range(0,len(parts),2):
+		part = re.sub(r'[ \t\r\n]+',' ',parts[index])
+		#---a space before a colon separates a pseudo class in a selector so we only remove the one after it
+		part = re.sub(r': ',':',re.sub(r' ?([\{\};,>]) ?',r'\1',part))
+		parts[index] = re.sub(r';\}','}',part)
+	return ''.join(parts).strip()
+
+###---CRITICAL CSS
+
+def css_blocks(css):
+	"""
+	Split a minified stylesheet into statements (with a body of None) and blocks at the top level.
+	Stray closing braces are dropped as browsers do.
+	"""
+	blocks,depth,start,opened = [],0,0,0
+	for index,char in enumerate(css):
+		if char=='{':
+			if depth==0:
+				#---statements like @import end with a semicolon before the next block
+				statements = css[start:index].split(';')
+				blocks.extend((i.strip(),None) for i in statements[:-1] if i.strip())
+				prelude,opened = statements[-1].strip(),index+1
+			depth += 1
+		elif char=='}':
+			if depth==0: start = index+1
+			else:
+				depth -= 1
+				if depth==0:
+					blocks.append((prelude,css[opened:index]))
+					start = index+1
+	blocks.extend((i.strip(),None) for i in css[start:].split(';') if i.strip() and depth==0)
+	return blocks
+
+def selector_used(selector,page_names):
+	"""Check whether every element, class and id in a selector appears in the page."""
+	tags,classes,ids = page_names
+	#---pseudo classes and attributes could only make the selector narrower so we ignore them
+	selector = re.sub(r'::?[\w-]+(?:\([^\)]*\))?','',selector)
+	selector = re.sub(r'\[[^\]]*\]','',selector)
+	return (all(i in classes for i in re.findall(r'\.([\w-]+)',selector))
+		and all(i in ids for i in re.findall(r'#([\w-]+)',selector))
+		and all(i.lower() in tags for i in re.findall(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)',selector)))
+
+def critical_css(css,page):
+	"""Keep the rules in a minified stylesheet which apply to elements in the page."""
+	page_names = (set(i.lower() for i in re.findall(r'<([a-zA-Z][\w-]*)',page)),
+		set(i for j in re.findall(r'\bclass\s*=\s*["\']([^"\']*)["\']',page) for i in j.split()),
+		set(re.findall(r'\bid\s*=\s*["\']([^"\']*)["\']',page)))
+	kept = []
+	for prelude,body in css_blocks(css):
+		if body==None: kept.append(prelude+';')
+		#---conditional groups keep the rules inside them which apply
+		elif re.match(r'@(media|supports)\b',prelude):
+			inner = critical_css(body,page)
+			if inner: kept.append('%s{%s}'%(prelude,inner))
+		#---other at-rules (fonts, keyframes, pages) are kept as they are
+		elif prelude.startswith('@'): kept.append('%s{%s}'%(prelude,body))
+		else:
+			selectors = [i for i in prelude.split(',') if selector_used(i,page_names)]
+			if selectors and body: kept.append('%s{%s}'%(','.join(selectors),body))
+	return ''.join(kept)
+
+def local_path(link,dn):
+	"""The file for a link relative to the page, or None for remote or missing files."""
+	link = re.split(r'[?#]',link)[0]
+	if not link or re.match(r'^([a-zA-Z][\w+.-]*:|/)',link): return None
+	path = os.path.normpath(os.path.join(dn,link))
+	return path if os.path.isfile(path) else None
+
+def inline_css(page,dn):
+	"""
+	Replace links to local stylesheets with the rules which apply to the page. If some rules are left out the
+	full stylesheet loads afterwards without blocking the page.
+	"""
+	def replace(match):
+		href = re.search(r'\bhref\s*=\s*["\']([^"\']+)["\']',match.group(0))
+		path = local_path(href.group(1),dn) if href else None
+		if not path: return match.group(0)
+		with open(path) as fp: css = minify_css(fp.read())
+		critical = critical_css(css,page)
+		if critical==css: return '<style>%s</style>'%css
+		return ('<style>%s</style><link rel="preload" href="%s" as="style" '
+			'onload="this.onload=null;this.rel=\'stylesheet\'"><noscript><link rel="stylesheet" href="%s">'
+			'</noscript>')%(critical,href.group(1),href.group(1))
+	return re.sub(r'<link\b[^>]*\brel\s*=\s*["\']stylesheet["\'][^>]*>',replace,page,flags=re.I)
+
+###---PRECOMPRESS
+
+def stage_shared(page,dn,shared_dn):
+	"""
+	Copy the files a page links from the shared sources into the assets folder beside it and point the links
+	there, so their compressed copies stay out of the source tree.
+	"""
+	shared_dn = os.path.join(os.path.realpath(shared_dn),'')
+	def replace(match):
+		path = local_path(match.group(2),dn)
+		if not path or not os.path.realpath(path).startswith(shared_dn): return match.group(0)
+		target = os.path.join(dn,assets_folder,os.path.relpath(os.path.realpath(path),shared_dn))
+		if not os.path.isdir(os.path.dirname(target)): os.makedirs(os.path.dirname(target))
+		copy_if_changed(path,target)
+		suffix = re.search(r'[?#].*$',match.group(2))
+		return match.group(1)+os.path.relpath(target,dn)+(suffix.group(0) if suffix else '')+match.group(3)
+	return re.sub(r'(\b(?:href|src)\s*=\s*["\'])([^"\']+)(["\'])',replace,page)
+
+def remove_compressed(fn):
+	"""Remove the compressed copies of a file which is about to change without them."""
+	for suffix in ['gz','br']:
+		if os.path.isfile('%s.%s'%(fn,suffix)): os.remove('%s.%s'%(fn,suffix))
+
+def local_assets(page,dn):
+	"""Local files linked from a page which should get compressed copies."""
+	links = re.findall(r'\b(?:href|src)\s*=\s*["\']([^"\']+)["\']',page)
+	links += [i.split()[0] for j in re.findall(r'\bsrcset\s*=\s*["\']([^"\']+)["\']',page)
+		for i in j.split(',') if i.strip()]
+	paths = [local_path(i,dn) for i in links]
+	paths = [i for i in paths if i and os.path.splitext(i)[1].lstrip('.').lower() in compress_extensions]
+	return [i for ii,i in enumerate(paths) if i not in paths[:ii]]
+
+def write_gzip(fn,out):
+	"""Write the gzip copy without a timestamp so the same contents give the same file."""
+	with open(fn,'rb') as fp: data = fp.read()
+	with open(out,'wb') as fp: fp.write(gzip.compress(data,compresslevel=9,mtime=0))
+
+def write_brotli(fn,out):
+	"""Write the brotli copy with the module or the command-line tool."""
+	if brotli:
+		with open(fn,'rb') as fp: data = fp.read()
+		with open(out,'wb') as fp: fp.write(brotli.compress(data,quality=11))
+	else: run(['brotli','--quality=11','--force','--output=%s'%out,fn],shell=False,echo=False)
+
+def precompress(fns,cache_dn):
+	"""
+	Write gzip and brotli copies beside each file unless the copies already match its contents.
+	Returns the copies we wrote.
+	"""
+	if not os.path.isdir(cache_dn): os.makedirs(cache_dn)
+	manifest_fn = os.path.join(cache_dn,'manifest.json')
+	manifest = read_manifest(manifest_fn)
+	sums = source_checksums([os.path.abspath(i) for i in fns],manifest.setdefault('sources',{}))
+	copies = manifest.setdefault('copies',{})
+	methods = [('gz',write_gzip)]
+	if brotli or shutil.which('brotli'): methods.append(('br',write_brotli))
+	else: print('[NOTE] install the brotli python package or command to write .br copies')
+	written = []
+	for fn,stat_sum in sums.items():
+		for suffix,method in methods:
+			out = '%s.%s'%(fn,suffix)
+			if copies.get(out,None)==stat_sum and os.path.isfile(out): continue
+			method(fn,out)
+			copies[out] = stat_sum
+			written.append(out)
+	write_manifest(manifest_fn,manifest)
+	return written
+
+def publish_html(fn,page,cache_dn,shared_dn=None):
+	"""
+	Write a page for static hosting along with compressed copies of it and of the local CSS and SVG it uses.
+	Files from shared_dn are copied beside the page first.
+	"""
+	dn = os.path.dirname(os.path.abspath(fn))
+	if shared_dn: page = stage_shared(page,dn,shared_dn)
+	page = minify_html(inline_css(page,dn))
+	write_if_changed(fn,page)
+	written = precompress([fn]+local_assets(page,dn),cache_dn)
+	print('[STATUS] published %s%s'%(os.path.basename(fn),' and wrote %d compressed copies'%len(written)
+		if written else ''))
+	return fn
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+"""
+Keep the regular expressions in the parser from hanging on unbalanced markup.
+
+A few rules can backtrack for a long time on input they cannot match, for example a long line with many unclosed
+"~" switches or "\\ref{" commands, or many ":::" openers without a closer. The substitution pipeline runs under a
+time limit and stops with the rule and the line in the markdown which most likely caused the trouble instead of
+hanging the build. The corpus below holds adversarial inputs for the patterns we know about and benchmark
+reports how their cost grows with the size of the input, so `make regex_benchmark` shows whether a new or changed
+rule is superlinear.
+
+These rules are still quadratic on their adversarial inputs and rely on the time limit (regex_time_limit in
+TexDocument, 20s by default) rather than being fixed: unclosed block comments, blank lines before a header comment,
+header items without a terminator (regex_header_block and regex_header_yaml), and the "[...](...)", "<<...>>",
+"~...|...~" and "\\ref{...}" substitutions (for both TeX and HTML where they exist) along with the ``...'' quotes
+in HTML. On ordinary documents they are linear since the markup is balanced.
+"""
+
+import re,math,time,signal,threading,contextlib,functools
+
+class RegexTimeout(Exception):
+	"""Raised inside a guarded block which runs past its time limit."""
+	pass
+
+#---only the outermost limit sets the timer
+_active = False
+
+@contextlib.contextmanager
+def time_limit(seconds):
+	"""
+	Raise RegexTimeout if the block runs longer than a number of seconds. The regex engine checks for signals while
+	it backtracks so this also stops a single slow match. Signals only reach the main thread, so elsewhere (for
+	example in the preview server) and on platforms without SIGALRM the block runs without a limit.
+	"""
+	global _active
+	if (not seconds or _active or not hasattr(signal,'setitimer')
+		or threading.current_thread() is not threading.main_thread()):
+		yield
+		return
+	def expire(signum,frame): raise RegexTimeout('ran for more than %ss'%seconds)
+	previous = signal.signal(signal.SIGALRM,expire)
+	signal.setitimer(signal.ITIMER_REAL,float(seconds))
+	_active = True
+	try: yield
+	finally:
+		signal.setitimer(signal.ITIMER_REAL,0)
+		signal.signal(signal.SIGALRM,previous)
+		_active = False
+
+@contextlib.contextmanager
+def paused():
+	"""
+	Stop the clock of the active time limit during a block which is not regex matching, for example a converter
+	which runs an external tool on a figure, and start it again with the time which was left.
+	"""
+	if not _active or threading.current_thread() is not threading.main_thread():
+		yield
+		return
+	remaining,interval = signal.setitimer(signal.ITIMER_REAL,0)
+	try: yield
+	finally: signal.setitimer(signal.ITIMER_REAL,max(remaining,1e-6))
+
+def unguarded(func):
+	"""Wrap a function so it runs with the time limit paused."""
+	@functools.wraps(func)
+	def wrapped(*args,**kwargs):
+		with paused(): return func(*args,**kwargs)
+	return wrapped
+
+###---LOCATING
+
+def unmatched_line(rule,text,seconds):
+	"""
+	Find the line where a multiline rule stops matching. We collect matches until the time limit and then look for 
+	the first opening of the rule (the pattern before its first lazy group) after the last match which cannot be 
+	completed. Returns the first line with text at that point.
+	"""
+	position = 0
+	try:
+		with time_limit(seconds):
+			for match in rule.finditer(text): position = match.end()
+	except RegexTimeout: pass
+	try:
+		opener = re.compile(rule.pattern.split('(.*?)')[0],rule.flags)
+		with time_limit(seconds):
+			for found in opener.finditer(text,position):
+				if not rule.match(text,found.start()):
+					position = found.start()
+					break
+	except (RegexTimeout,re.error): pass
+	found = re.compile(r'\S').search(text,position)
+	if found: position = found.start()
+	start = text.rfind('\n',0,position)+1
+	end = text.find('\n',position)
+	return text[start:end if end>=0 else len(text)]
+
+def source_line(source,line):
+	"""
+	Find the line number (from one) in the markdown which most likely produced a processed line, or None.
+	Markup in the line may already be replaced so we look for the longest runs of plain text.
+	"""
+	if line.strip() and line.strip() in source: return source.count('\n',0,source.find(line.strip()))+1
+	runs = sorted(re.findall(r'[\w][\w ,\.]{11,}',line),key=len,reverse=True)
+	for run in runs[:5]:
+		index = source.find(run.strip()[:80])
+		if index>=0: return source.count('\n',0,index)+1
+	return None
+
+def snippet(line,length=60):
+	"""Shorten a line for an error message."""
+	line = line.strip()
+	return line if len(line)<=length else line[:length-3]+'...'
+
+###---BENCHMARKS
+
+#---tokens which open or close markup, for the sweep over the line rules
+tokens = ['~','*','**','`','``',"''",'[','](','<<','>>','@','$','::','\\ref{','{','\\','|','#','>','%','...',
+	' "',"' ",'@sec:','@fig:','@eq:']
+
+def corpus():
+	"""
+	Adversarial inputs for the patterns in the parser. Each item has a name, a compiled pattern, whether it is
+	applied to one line at a time, and a function which makes an input of size n.
+	"""
+	from parselib import TexDocument,MDHeaderText
+	multiline = re.M+re.DOTALL
+	cases = [
+		('figure without a blank line',TexDocument.figure_regex,multiline,False,
+			lambda n:'!figure: fig:a\na.png caption\n'+'word\n'*n),
+		('many figures',TexDocument.figure_regex,multiline,False,
+			lambda n:'!figure: fig:a\na.png caption\n\ntext\n\n'*n),
+		('unclosed inline comments',TexDocument.regex_inline_comment,0,True,lambda n:'a:: '*n),
+		('unclosed block comments',TexDocument.regex_block_comment,multiline,False,lambda n:':::\nab '*n),
+		('unclosed equations',TexDocument.regex_equation,multiline,False,lambda n:'$$\nx = 1 '*n),
+		('citations',TexDocument.regex_citation,0,True,lambda n:'[@ab1234; @cd5678] '*n),
+		('unfinished citations',TexDocument.regex_citation,0,True,lambda n:'@'+'ab-'*n),
+		('blank lines before a header comment',MDHeaderText.regex_comment_line,0,False,lambda n:'\n'*n+'x'),]
+	header_items = {'regex_header_block':'>key:\nvalue\n','regex_header_yaml':'~key\n','regex_header_single':'key '}
+	for name,(regex,flags) in MDHeaderText.regex_header_parse:
+		cases.append(('header items without a terminator (%s)'%name,regex,flags,False,
+			lambda n,item=header_items[name]:item*n))
+	#---every line rule against lines full of one token
+	for group in ['rules_tex','rules_html','subs_tex','subs_html','special_subs_tex','special_subs_html']:
+		for rule in getattr(TexDocument,group):
+			for token in tokens:
+				cases.append(('%s %s on "%s"'%(group,rule,token),rule,0,True,
+					lambda n,token=token:(token+'ab ')*n))
+	return [(name,re.compile(rule,flags),per_line,make) for name,rule,flags,per_line,make in cases]
+
+def replace_each_case(n):
+	"""The callable multiline rules (figures and equations) replace one match at a time."""
+	from profiler import replace_each
+	rule = re.compile(r'^\$\$\s*$(.*?)\n\$\$',re.M+re.DOTALL)
+	return functools.partial(replace_each,rule,lambda x:'\\begin{equation}%s\\end{equation}'%x[0],
+		'$$\nx\n$$\ntext\n'*n)
+
+def benchmark(sizes=(1000,2000,4000),limit=5.,threshold=1.5,verbose=False):
+	"""
+	Time each case at several sizes and estimate the exponent of its growth from the largest two. Cases which
+	grow faster than the threshold (and take long enough to measure) are reported. Returns all of the results.
+	"""
+	#---each case makes a job for a size so we only time the matching
+	cases = [(name,lambda n,rule=rule,per_line=per_line,make=make:functools.partial(rule.sub,'',make(n)) 
+		if per_line else functools.partial(rule.findall,make(n))) for name,rule,per_line,make in corpus()]
+	cases.append(('replace_each over many equations',replace_each_case))
+	results = []
+	for name,prepare in cases:
+		times = []
+		for size in sizes:
+			job = prepare(size)
+			start = time.perf_counter()
+			try:
+				with time_limit(limit): job()
+				times.append(time.perf_counter()-start)
+			except RegexTimeout:
+				times.append(float('inf'))
+				break
+		if times[-1]==float('inf'): exponent = float('inf')
+		elif len(times)<2 or times[-2]<=0: exponent = 0.
+		else: exponent = math.log(times[-1]/times[-2])/math.log(float(sizes[-1])/sizes[-2])
+		results.append({'case':name,'sizes':list(sizes[:len(times)]),'seconds':times,'exponent':exponent,
+			'superlinear':exponent>threshold and times[-1]>0.005})
+	flagged = sorted([i for i in results if i['superlinear']],key=lambda x:-x['seconds'][-1])
+	for item in (results if verbose else flagged):
+		print('[BENCHMARK] %s %s: %s (exponent %.1f)'%('SUPERLINEAR' if item['superlinear'] else 'ok',
+			item['case'],', '.join('%.3fs'%i for i in item['seconds']),item['exponent']))
+	print('[BENCHMARK] %d of %d cases grow faster than n^%.1f at sizes %s'%(
+		len(flagged),len(results),threshold,', '.join(map(str,sizes))))
+	return results
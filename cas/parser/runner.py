@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+"""
+Run external tools while streaming their output to the terminal and capturing it at the same time.
+
+Each command becomes a Job. Two reader threads tee stdout and stderr to the terminal, to an optional per-job
+log file, and to a bounded buffer of the most recent lines, so memory stays flat no matter how chatty the tool
+is (pdflatex easily writes thousands of lines). The job records its return code and duration and supports
+timeouts and cancellation from another thread. Build steps run detached from the terminal in their own session
+while interactive jobs (ssh, git and rsync which may ask for a password) keep the terminal and its input.
+"""
+
+import os,sys,time,signal,threading,subprocess
+from collections import deque
+
+#---the number of trailing lines we keep in memory for each stream
+tail_lines = 200
+#---jobs which are currently running so we can stop all of them at once
+active_jobs = set()
+
+def descendants(pid):
+	"""The process ids of the children of a process and their children, where /proc can tell us."""
+	try:
+		with open('/proc/%d/task/%d/children'%(pid,pid)) as fp: children = [int(i) for i in fp.read().split()]
+	except (OSError,ValueError): return []
+	return [j for i in children for j in [i]+descendants(i)]
+
+def signal_tree(pid,sig):
+	"""Send a signal to a process and everything it started."""
+	for i in [pid]+descendants(pid):
+		try: os.kill(i,sig)
+		except OSError: pass
+
+class Job:
+
+	"""
+	A single external command which is teed to the terminal, a log file, and a bounded buffer.
+	"""
+
+	def __init__(self,command,cwd=None,log=None,echo=True,name=None,timeout=None,env=None,inpipe=None,
+		shell=True,max_lines=tail_lines,interactive=False):
+		self.command,self.cwd,self.log,self.echo = command,cwd if cwd else './',log,echo
+		self.name,self.timeout,self.env,self.inpipe,self.shell = name,timeout,env,inpipe,shell
+		self.interactive = interactive
+		self.stdout_tail,self.stderr_tail = deque(maxlen=max_lines),deque(maxlen=max_lines)
+		self.returncode,self.duration,self.timed_out,self.cancelled = None,None,False,False
+		self.proc,self._lock = None,threading.Lock()
+
+	def __repr__(self):
+		return 'Job(%r, returncode=%r, duration=%r)'%(self.command,self.returncode,self.duration)
+
+	@property
+	def stdout(self): return ''.join(self.stdout_tail)
+	@property
+	def stderr(self): return ''.join(self.stderr_tail)
+
+	def _tee(self,stream,tail,terminal,log_fp):
+		"""Copy lines from one pipe to each destination until the pipe closes."""
+		prefix = '[%s] '%self.name if self.name else ''
+		for raw in iter(stream.readline,b''):
+			line = raw.decode(errors='replace')
+			tail.append(line)
+			with self._lock:
+				if log_fp: log_fp.write(line)
+				if self.echo:
+					terminal.write(prefix+line)
+					terminal.flush()
+		stream.close()
+
+	def start(self):
+		"""Launch the command and the reader threads."""
+		if self.log and os.path.dirname(self.log) and not os.path.isdir(os.path.dirname(self.log)):
+			os.makedirs(os.path.dirname(self.log))
+		self._log_fp = open(self.log,'w') if self.log else None
+		self._start_time = time.time()
+		#---each job gets its own process group so timeouts and cancellation reach the children of the shell
+		#---...except interactive jobs which need the controlling terminal to ask for passwords
+		if self.inpipe: stdin = subprocess.PIPE
+		else: stdin = None if self.interactive else subprocess.DEVNULL
+		self.proc = subprocess.Popen(self.command,cwd=self.cwd,shell=self.shell,env=self.env,
+			executable='/bin/bash' if self.shell else None,start_new_session=not self.interactive,
+			stdin=stdin,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+		active_jobs.add(self)
+		self._threads = [threading.Thread(target=self._tee,args=args) for args in [
+			(self.proc.stdout,self.stdout_tail,sys.stdout,self._log_fp),
+			(self.proc.stderr,self.stderr_tail,sys.stderr,self._log_fp)]]
+		for thread in self._threads:
+			thread.daemon = True
+			thread.start()
+		if self.inpipe:
+			self.proc.stdin.write(self.inpipe if type(self.inpipe)==bytes else self.inpipe.encode())
+			self.proc.stdin.close()
+		return self
+
+	def cancel(self):
+		"""Stop the job and every process it started. Safe to call from any thread."""
+		self.cancelled = True
+		self._kill()
+
+	def _kill(self):
+		if self.proc and self.proc.poll() is None:
+			#---interactive jobs share our process group so we signal their processes one by one
+			kill = (lambda sig:signal_tree(self.proc.pid,sig)) if self.interactive else \
+				(lambda sig:os.killpg(self.proc.pid,sig))
+			try: kill(signal.SIGTERM)
+			except OSError: pass
+			try: self.proc.wait(timeout=5)
+			except subprocess.TimeoutExpired:
+				try: kill(signal.SIGKILL)
+				except OSError: pass
+
+	def wait(self):
+		"""Wait for the job to finish (or time out) and return it."""
+		try: self.proc.wait(timeout=self.timeout)
+		except subprocess.TimeoutExpired:
+			self.timed_out = True
+			self._kill()
+		except KeyboardInterrupt:
+			self.cancel()
+			raise
+		finally:
+			for thread in self._threads: thread.join()
+			self.proc.wait()
+			self.returncode = self.proc.returncode
+			self.duration = time.time()-self._start_time
+			if self._log_fp: self._log_fp.close()
+			active_jobs.discard(self)
+		return self
+
+	def check(self):
+		"""Raise an exception with the end of the error text if the job failed."""
+		if self.timed_out:
+			raise Exception('command timed out after %.1fs: %s'%(self.timeout,self.command))
+		if self.cancelled: raise Exception('command was cancelled: %s'%self.command)
+		if self.returncode:
+			raise Exception('command failed with returncode %d: %s%s\nstderr: "%s"'%(self.returncode,
+				self.command,'\nsee %s'%self.log if self.log else '',self.stderr.strip()))
+		return self
+
+def cancel_all():
+	"""Cancel every running job, for example when the user interrupts a parallel build."""
+	for job in list(active_jobs): job.cancel()
+
+def run(command,check=True,**kwargs):
+	"""
+	Run a command to completion while streaming its output. See Job for the keyword arguments.
+	"""
+	job = Job(command,**kwargs).start().wait()
+	if check: job.check()
+	return job
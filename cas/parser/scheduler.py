@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+"""
+Run build steps (figure conversion, equation images, LaTeX passes, bibtex, zip, git) as a dependency graph.
+
+Steps are plain python callables, usually wrapping an external tool via the runner. Each step names the steps
+it depends on. Independent steps run concurrently up to a global worker limit, steps in the same serial group
+never run at the same time, and when a step fails we skip everything that depends on it while the rest of the
+graph keeps going. Among the steps which are ready, those with a higher priority (for example the documents
+which took the longest last time) start first.
+"""
+
+import os,time,threading,traceback
+from collections import OrderedDict as odict
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
+import runner
+
+class Scheduler:
+
+	"""
+	Collect build steps and run them in dependency order.
+	"""
+
+	def __init__(self,workers=None):
+		self.workers = int(workers) if workers else (os.cpu_count() or 1)
+		self.steps = odict()
+		self._lock = threading.Lock()
+
+	def submit(self,name,func,deps=None,group=None,priority=0,tags=None):
+		"""
+		Add a step. Dependencies must already be submitted (which also rules out cycles).
+		Falsy entries in deps are ignored so callers can pass optional dependencies directly.
+		Tags are kept with the step so callers can record its duration afterwards.
+		"""
+		deps = [i for i in (deps or []) if i]
+		with self._lock:
+			if name in self.steps: raise Exception('step "%s" was submitted twice'%name)
+			missing = [i for i in deps if i not in self.steps]
+			if missing: raise Exception('step "%s" depends on unknown steps: %s'%(name,missing))
+			self.steps[name] = {'func':func,'deps':deps,'group':group,'state':'waiting',
+				'error':None,'duration':None,'priority':priority,'tags':tags}
+		return name
+
+	def _call(self,name):
+		"""Run a single step and record the outcome."""
+		step = self.steps[name]
+		start = time.time()
+		try: step['func']()
+		except Exception as e:
+			step['error'] = e
+			print('[ERROR] step %s failed: %s'%(name,e))
+			if os.environ.get('PYTHON_DEBUG','no')!='no': traceback.print_exc()
+		finally: step['duration'] = time.time()-start
+		return name
+
+	def run(self):
+		"""
+		Run every waiting step and raise an exception listing the failures at the end.
+		"""
+		pending = [name for name,step in self.steps.items() if step['state']=='waiting']
+		running = {}
+		pool = ThreadPoolExecutor(max_workers=self.workers)
+		try:
+			while pending or running:
+				#---skip steps which depend on a failure and launch steps whose dependencies are done
+				#---the sort is stable so steps with the same priority start in the order we received them
+				for name in sorted(pending,key=lambda x:-self.steps[x]['priority']):
+					states = [self.steps[i]['state'] for i in self.steps[name]['deps']]
+					if any(i in ['failed','skipped'] for i in states):
+						self.steps[name]['state'] = 'skipped'
+						print('[WARNING] skipping step %s because a dependency failed'%name)
+						pending.remove(name)
+					elif all(i=='done' for i in states) and len(running)<self.workers:
+						group = self.steps[name]['group']
+						if group and any(self.steps[i]['group']==group for i in running.values()): continue
+						self.steps[name]['state'] = 'running'
+						running[pool.submit(self._call,name)] = name
+						pending.remove(name)
+				if not running: break
+				done,_ = wait(list(running.keys()),return_when=FIRST_COMPLETED)
+				for future in done:
+					name = running.pop(future)
+					self.steps[name]['state'] = 'failed' if self.steps[name]['error'] else 'done'
+		except KeyboardInterrupt:
+			#---stop the external commands so the pool can shut down
+			for future in running: future.cancel()
+			runner.cancel_all()
+			raise
+		finally: pool.shutdown(wait=True)
+		failed = [name for name,step in self.steps.items() if step['state']=='failed']
+		if failed:
+			raise Exception('%d build steps failed (%s) and %d were skipped'%(len(failed),
+				', '.join(failed),len([i for i in self.steps.values() if i['state']=='skipped'])))
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""
+Write image galleries for the ``type: image-link`` entries in dispatch.yaml.
+
+Each entry points to a ``location`` holding images. Thumbnails are written by a pool of ImageMagick workers
+and named by the hash of their source and their size so they survive renames and are only remade when an image
+or the thumbnail size changes.
+The gallery is a single ``tile-<key>.html`` file split into pages whose images are loaded lazily.
+"""
+
+import os,re,html
+from concurrent.futures import ThreadPoolExecutor
+from cache import read_manifest,write_manifest,source_checksums
+from runner import run
+
+hold_dn = 'cas/hold'
+image_extensions = ['png','jpg','jpeg','gif','tif','tiff','bmp','pdf']
+#---defaults which may be overridden in each dispatch.yaml entry
+gallery_defaults = {'per_page':200,'thumb_size':320,'workers':None}
+
+gallery_template = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<link rel="stylesheet" href="./cas/sources/main.css" type="text/css"/>
+<style>
+.tiles{display:flex;flex-wrap:wrap;gap:8px;}
+.tiles figure{margin:0;width:%(size)dpx;text-align:center;font-size:small;overflow-wrap:anywhere;}
+.tiles img{max-width:%(size)dpx;max-height:%(size)dpx;}
+.page{display:none;}
+.pager a{padding:0 4px;}
+</style></head>
+<body><div id="wrapper"><div id="main_content">
+<h1>%(title)s</h1>
+<p><code>%(count)d images from %(location)s</code></p>
+<div class="pager">%(pager)s</div>
+%(pages)s
+<div class="pager">%(pager)s</div>
+</div></div>
+<script>
+function show_page(){
+	var pages = document.getElementsByClassName('page');
+	var target = document.getElementById(location.hash.slice(1)) || pages[0];
+	for (var i=0;i<pages.length;i++) pages[i].style.display = (pages[i]===target) ? 'block' : 'none';
+}
+window.addEventListener('hashchange',show_page);
+show_page();
+</script>
+</body></html>
+"""
+
+def collect_images(location):
+	"""List the images below a location in a stable order."""
+	regex_image = r'\.(%s)$'%'|'.join(image_extensions)
+	fns = []
+	for root,dns,files in os.walk(location):
+		dns.sort()
+		fns.extend(os.path.join(root,fn) for fn in sorted(files) if re.search(regex_image,fn,re.IGNORECASE))
+	return fns
+
+def write_thumbnail(source,target,size):
+	"""Write one thumbnail with ImageMagick. We write to a temporary file so failures leave no partial."""
+	tmp_fn = target+'.tmp.jpg'
+	job = run(['convert','%s[0]'%source,'-thumbnail','%dx%d'%(size,size),
+		'-background','white','-flatten','-quality','80',tmp_fn],shell=False,echo=False,check=False)
+	if job.returncode!=0:
+		if os.path.isfile(tmp_fn): os.remove(tmp_fn)
+		return 'convert failed on %s: %s'%(source,job.stderr.strip())
+	os.rename(tmp_fn,target)
+
+def make_gallery(key,val,dropdir='./'):
+	"""
+	Make thumbnails and a paginated gallery for one image-link entry from dispatch.yaml.
+	"""
+	settings = dict(gallery_defaults,**dict([(k,v) for k,v in val.items() if k in gallery_defaults]))
+	location = val.get('location',None)
+	if not location or not os.path.isdir(location):
+		raise Exception('gallery "%s" needs a "location" which is a directory of images'%key)
+	thumbs_dn = os.path.join(hold_dn,'thumbs-%s'%key)
+	if not os.path.isdir(thumbs_dn): os.makedirs(thumbs_dn)
+	manifest_fn = os.path.join(thumbs_dn,'manifest.json')
+	manifest = read_manifest(manifest_fn)
+	fns = collect_images(location)
+	#---forget images which were removed
+	manifest = dict([(fn,manifest[fn]) for fn in fns if fn in manifest])
+	sums = source_checksums(fns,manifest)
+	size = int(settings['thumb_size'])
+	thumb_fn = lambda fn:os.path.join(thumbs_dn,'%s-%d.jpg'%(sums[fn],size))
+	#---thumbnails are named by content and size so we only make the missing ones
+	todo = dict([(thumb_fn(fn),fn) for fn in fns if not os.path.isfile(thumb_fn(fn))])
+	print('[STATUS] gallery %s has %d images and needs %d new thumbnails'%(key,len(fns),len(todo)))
+	if todo:
+		with ThreadPoolExecutor(max_workers=settings['workers'] or os.cpu_count()) as pool:
+			errors = [i for i in pool.map(lambda x:write_thumbnail(x[1],x[0],size),
+				todo.items()) if i]
+		if errors: raise Exception('failed to make %d thumbnails:\n%s'%(len(errors),'\n'.join(errors)))
+	#---remove thumbnails whose sources are gone or which have another size
+	keep = set(os.path.basename(thumb_fn(fn)) for fn in fns)
+	for fn in os.listdir(thumbs_dn):
+		if fn.endswith('.jpg') and fn not in keep: os.remove(os.path.join(thumbs_dn,fn))
+	write_manifest(manifest_fn,manifest)
+	#---write the pages
+	per_page = settings['per_page']
+	rel = lambda fn:html.escape(os.path.relpath(fn,dropdir))
+	pages,npages = [],max(1,(len(fns)+per_page-1)//per_page)
+	for pp in range(npages):
+		tiles = ['<figure><a href="%s" target="_blank"><img src="%s" loading="lazy" decoding="async" '
+			'alt="%s"></a><figcaption>%s</figcaption></figure>'%(rel(fn),rel(thumb_fn(fn)),
+			html.escape(os.path.basename(fn)),html.escape(os.path.relpath(fn,location)))
+			for fn in fns[pp*per_page:(pp+1)*per_page]]
+		pages.append('<div class="page" id="page%d"><div class="tiles">\n%s\n</div></div>'%(
+			pp+1,'\n'.join(tiles)))
+	pager = ' '.join('<a href="#page%d">%d</a>'%(pp+1,pp+1) for pp in range(npages)) if npages>1 else ''
+	out_fn = os.path.join(dropdir,'tile-%s.html'%key)
+	with open(out_fn,'w') as fp:
+		fp.write(gallery_template%dict(title=html.escape(key),size=size,count=len(fns),
+			location=html.escape(location),pager=pager,pages='\n'.join(pages)))
+	print('[GALLERY] file:///%s'%os.path.abspath(out_fn))
+
+def make_galleries(dis,which=None):
+	"""Make a gallery for each image-link entry in dispatch.yaml."""
+	keys = [key for key,val in dis.items() if type(val)==dict and val.get('type',None)=='image-link']
+	if not keys: raise Exception('cannot find any entries with "type: image-link" in dispatch.yaml')
+	if which and which not in keys:
+		raise Exception('cannot find gallery "%s" in: %s'%(which,', '.join(sorted(keys))))
+	for key in sorted(keys):
+		if not which or key==which: make_gallery(key,dis[key])
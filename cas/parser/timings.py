@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+"""
+Remember how long each stage of each build took.
+
+Every remake writes the duration of each stage (parsing, processing, figure conversion, LaTeX passes, bibtex,
+git) for each document and format to a small sqlite database in the hold directory. We use the recent history
+to estimate how long a document will take, which lets `make plan` predict a rebuild and lets the scheduler
+start the longest documents first.
+"""
+
+import os,time,sqlite3,heapq
+
+timings_fn = 'cas/hold/timings.db'
+#---estimates average this many of the most recent successful runs of each stage
+#---...where a stage with several steps in one run (figure conversions, equation images) counts as their sum
+history_depth = 5
+
+def connect(fn=timings_fn):
+	"""Open the database and make the table if this is the first use."""
+	if os.path.dirname(fn) and not os.path.isdir(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+	conn = sqlite3.connect(fn)
+	conn.execute('CREATE TABLE IF NOT EXISTS stages (run REAL, document TEXT, format TEXT, '
+		'stage TEXT, duration REAL, ok INTEGER)')
+	conn.execute('CREATE INDEX IF NOT EXISTS stages_document ON stages (document, run)')
+	return conn
+
+def record_timings(rows,fn=timings_fn):
+	"""
+	Save the stages from one build. Each row is a tuple of document, format, stage, duration and whether
+	the stage succeeded.
+	"""
+	if not rows: return
+	run = time.time()
+	conn = connect(fn)
+	with conn: conn.executemany('INSERT INTO stages VALUES (?,?,?,?,?,?)',
+		[(run,document,fmt,stage,duration,int(bool(ok))) for document,fmt,stage,duration,ok in rows])
+	conn.close()
+
+def scheduler_timings(scheduler):
+	"""Collect the durations of the steps in a scheduler which were tagged with a document and stage."""
+	rows = []
+	for name,step in scheduler.steps.items():
+		tags = step.get('tags',None)
+		if not tags or step['duration'] is None: continue
+		rows.append((tags['document'],tags.get('format','all'),tags['stage'],step['duration'],
+			step['state']=='done'))
+	return rows
+
+def estimate(document,fn=timings_fn):
+	"""
+	Estimate the total build time for a document in seconds or return None if we have never built it.
+	We only count the stages from the most recent build so removed formats and figures drop out.
+	"""
+	if not os.path.isfile(fn): return None
+	conn = connect(fn)
+	latest = conn.execute('SELECT MAX(run) FROM stages WHERE document=?',(document,)).fetchone()[0]
+	if latest is None:
+		conn.close()
+		return None
+	total = 0.0
+	for fmt,stage in conn.execute('SELECT DISTINCT format,stage FROM stages WHERE document=? AND run=?',
+		(document,latest)).fetchall():
+		durations = [i for i, in conn.execute('SELECT SUM(duration) FROM stages WHERE document=? AND format=? '
+			'AND stage=? GROUP BY run HAVING MIN(ok)=1 ORDER BY run DESC LIMIT ?',
+			(document,fmt,stage,history_depth)).fetchall()]
+		if durations: total += sum(durations)/len(durations)
+	conn.close()
+	return total
+
+def makespan(durations,workers):
+	"""Estimate the wall time for independent jobs started longest-first on a number of workers."""
+	finish = [0.0]*max(1,min(workers,len(durations)))
+	for duration in sorted(durations,reverse=True):
+		heapq.heappush(finish,heapq.heappop(finish)+duration)
+	return max(finish)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+"""
+Downscaled copies of figures for the HTML output.
+
+Figures often come straight from an analysis pipeline as huge TIFFs or PNGs. For each figure we write web
+derivatives sized to the figure width in the page (and twice that for high-density screens) with ImageMagick
+and point the HTML at them with a srcset. Derivatives are named by the hash of their source, so they are only
+made again when the image changes.
+"""
+
+import os,re
+from cache import read_manifest,write_manifest,source_checksums
+from runner import run
+
+#---the width of the main column in main.css in pixels
+column_width = 600
+#---pixel densities for the srcset
+densities = [1,2]
+#---browsers can show these directly and vector or animated images should not be resampled
+web_extensions = ['png','jpg','jpeg','gif','svg']
+keep_extensions = ['svg','gif']
+
+def image_size(fn):
+	"""Get the pixel dimensions of the first frame of an image."""
+	job = run(['identify','-format','%w %h','%s[0]'%fn],shell=False,echo=False,check=False)
+	match = re.match(r'^(\d+) (\d+)',job.stdout.strip()) if job.returncode==0 else None
+	if not match: raise Exception('cannot read the size of %s: %s'%(fn,job.stderr.strip()))
+	return [int(match.group(1)),int(match.group(2))]
+
+def write_derivative(source,target,width):
+	"""Downscale one image. We write to a temporary file so failures leave no partial."""
+	tmp_fn = '%s.%d.tmp%s'%(target,os.getpid(),os.path.splitext(target)[1])
+	job = run(['convert','%s[0]'%source,'-resize','%dx'%width,'-strip']+
+		(['-quality','85'] if target.endswith('.jpg') else [])+[tmp_fn],shell=False,echo=False,check=False)
+	if job.returncode!=0:
+		if os.path.isfile(tmp_fn): os.remove(tmp_fn)
+		raise Exception('convert failed on %s: %s'%(source,job.stderr.strip()))
+	os.rename(tmp_fn,target)
+
+def web_image(path,fraction=1.0,cache_dn='cas/hold/web',relative_to=None):
+	"""
+	Make the web derivatives for one figure and return the attributes for its img tag.
+	The fraction is the width of the figure relative to the main column. Links in the tag are relative to the 
+	directory of the HTML file if we receive it.
+	"""
+	link = lambda fn:os.path.relpath(fn,relative_to) if relative_to else fn
+	if not os.path.isdir(cache_dn): os.makedirs(cache_dn)
+	manifest_fn = os.path.join(cache_dn,'manifest.json')
+	manifest = read_manifest(manifest_fn)
+	sources,sizes = manifest.setdefault('sources',{}),manifest.setdefault('sizes',{})
+	key = os.path.abspath(path)
+	stat_sum = source_checksums([key],sources)[key]
+	if stat_sum not in sizes: sizes[stat_sum] = image_size(path)
+	write_manifest(manifest_fn,manifest)
+	width,height = sizes[stat_sum]
+	ext = os.path.splitext(path)[1].lstrip('.').lower()
+	target = int(round(column_width*min(fraction,1.0)))
+	#---never upscale and use the original when it is already small enough for the page
+	widths = sorted(set(min(target*i,width) for i in densities))
+	if ext in keep_extensions or (ext in web_extensions and width<=widths[0]):
+		return {'src':link(path),'width':min(widths[0],width),'height':int(round(height*min(widths[0],width)/width))}
+	#---photographs stay as JPEG while everything else (plots, TIFF, PDF) becomes a lossless PNG
+	suffix = 'jpg' if ext in ['jpg','jpeg'] else 'png'
+	derivatives = []
+	for w in widths:
+		fn = os.path.join(cache_dn,'%s-%d.%s'%(stat_sum,w,suffix))
+		if not os.path.isfile(fn): write_derivative(path,fn,w)
+		derivatives.append((fn,w))
+	return {'src':link(derivatives[0][0]),'width':widths[0],'height':int(round(height*widths[0]/width)),
+		'srcset':', '.join('%s %dw'%(link(fn),w) for fn,w in derivatives),
+		'sizes':'(max-width: 649px) 100vw, %dpx'%target}